@@ -4,13 +4,21 @@ CREATE TABLE location_history (
     vehicle_id UUID REFERENCES vehicles(id) ON DELETE CASCADE,
     ts TIMESTAMP NOT NULL,
     longitude FLOAT8 NOT NULL,
-    latitude FLOAT8 NOT NULL
+    latitude FLOAT8 NOT NULL,
+    event STRING
 );
 
+--Index it for the per-vehicle, most-recent-first reads:
+CREATE INDEX location_history_vehicle_id_ts_idx
+    ON location_history (vehicle_id, ts DESC)
+       STORING (longitude, latitude, event);
+
 
 --Migrate the data:
-INSERT INTO movr.location_history (id, vehicle_id, ts, longitude, latitude)
-SELECT gen_random_uuid(), id, last_checkin, last_longitude, last_latitude 
+INSERT INTO movr.location_history (id, vehicle_id, ts, longitude, latitude,
+                                   event)
+SELECT gen_random_uuid(), id, last_checkin, last_longitude, last_latitude,
+       'add_vehicle'
 FROM vehicles;
 
 
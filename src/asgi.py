@@ -0,0 +1,206 @@
+"""
+Serves MovR as a JSON API from an ASGI server, using `AsyncMovR`.
+
+While a request waits on CockroachDB, the event loop serves other requests,
+so a single process can hold thousands of requests in flight with a pool of
+a few dozen connections. Run it from the `src` directory with any ASGI
+server, e.g.:
+
+    uvicorn asgi:app --port 36258
+
+The connection string and pool settings come from the same .env file and
+environment variables as server.py (DB_URI, DB_POOL_SIZE, ...), and requests
+are checked by the same rules as /api/v1 (web/validation.py). There's no
+one to ask for a missing password or certs directory, so DB_URI must be
+complete; otherwise startup fails.
+
+Routes:
+    GET    /vehicles                 One page; ?after=, ?before=, ?limit=
+    POST   /vehicles                 Add a vehicle: {"vehicle_type",
+                                         "longitude", "latitude", "battery"}
+    GET    /vehicles/<id>            The vehicle and its recent locations.
+    DELETE /vehicles/<id>            Remove a vehicle that isn't in use.
+    POST   /vehicles/<id>/ride       Start a ride.
+    POST   /vehicles/<id>/ride/end   End a ride: {"longitude", "latitude",
+                                         "battery"}
+"""
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+from movr.async_movr import AsyncMovR
+from util.connect_with_sqlalchemy import build_sqla_connection_string
+from web.config import Config
+from web.validation import (APIError, json_default, parse_limit,
+                            parse_new_vehicle, parse_ride_end, parse_uuid)
+
+logger = logging.getLogger(__name__)
+
+_VEHICLE_ROUTE = re.compile(r'^/vehicles/(?P<vehicle_id>[^/]+)'
+                            r'(?P<action>/ride|/ride/end)?$')
+
+
+async def read_json(receive):
+    """Reads the whole request body and decodes it as a JSON object."""
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    try:
+        decoded = json.loads(body or b'{}')
+    except ValueError:
+        raise APIError(400, "The request body isn't valid JSON.")
+    if not isinstance(decoded, dict):
+        raise APIError(400, "The request body must be a JSON object.")
+    return decoded
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload, default=json_default).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def list_vehicles(movr, query):
+    after_id = query.get('after')
+    before_id = query.get('before')
+    after_id = None if after_id is None else parse_uuid(after_id)
+    before_id = None if before_id is None else parse_uuid(before_id)
+    vehicles, next_id, prev_id = await movr.get_vehicles(
+        max_vehicles=parse_limit(query, movr.max_records),
+        after_id=after_id, before_id=before_id)
+    return 200, {'vehicles': vehicles, 'next': next_id, 'prev': prev_id}
+
+
+async def add_vehicle(movr, body):
+    return 201, await movr.add_vehicle(**parse_new_vehicle(body))
+
+
+async def show_vehicle(movr, vehicle_id):
+    vehicle, location_history = await movr.get_vehicle_and_location_history(
+        vehicle_id, max_locations=movr.max_records)
+    if vehicle is None:
+        raise APIError(404, "Vehicle `{}` not found.".format(vehicle_id))
+    return 200, {'vehicle': vehicle, 'location_history': location_history}
+
+
+async def remove_vehicle(movr, vehicle_id):
+    if not await movr.remove_vehicle(vehicle_id):
+        raise APIError(409, ("Vehicle `{}` not found in database, or is "
+                             "currently in use.").format(vehicle_id))
+    return 200, {'vehicle_id': vehicle_id, 'deleted': True}
+
+
+async def start_ride(movr, vehicle_id):
+    if not await movr.start_ride(vehicle_id):
+        raise APIError(409, ("Could not start ride on vehicle `{}`. Either "
+                             "it's in use, or it has been deleted."
+                             ).format(vehicle_id))
+    return 200, {'vehicle_id': vehicle_id, 'in_use': True}
+
+
+async def end_ride(movr, vehicle_id, body):
+    vehicle_at_end = await movr.end_ride(vehicle_id, *parse_ride_end(body))
+    if not vehicle_at_end:
+        raise APIError(409, "Unable to end ride for vehicle `{}`.".format(
+            vehicle_id))
+    return 200, vehicle_at_end
+
+
+async def route(movr, scope, receive):
+    """Dispatches one request; returns (status, payload)."""
+    method = scope['method']
+    path = scope['path'].rstrip('/') or '/'
+    query = {key: values[-1] for key, values in
+             parse_qs(scope.get('query_string', b'').decode()).items()}
+
+    if path == '/vehicles':
+        if method == 'GET':
+            return await list_vehicles(movr, query)
+        if method == 'POST':
+            return await add_vehicle(movr, await read_json(receive))
+        raise APIError(405, "Method not allowed.")
+
+    match = _VEHICLE_ROUTE.match(path)
+    if match is None:
+        raise APIError(404, "Not found.")
+    vehicle_id = parse_uuid(match.group('vehicle_id'))
+    action = match.group('action')
+    if action is None and method == 'GET':
+        return await show_vehicle(movr, vehicle_id)
+    if action is None and method == 'DELETE':
+        return await remove_vehicle(movr, vehicle_id)
+    if action == '/ride' and method == 'POST':
+        return await start_ride(movr, vehicle_id)
+    if action == '/ride/end' and method == 'POST':
+        return await end_ride(movr, vehicle_id, await read_json(receive))
+    raise APIError(405, "Method not allowed.")
+
+
+class MovRApp:
+    """
+    The ASGI application. The `AsyncMovR` (and its pool) is created on the
+        server's lifespan startup, inside the running event loop, and closed
+        on shutdown.
+    """
+    def __init__(self, config=Config):
+        self.config = config
+        self.movr = None
+
+    def connect(self):
+        """
+        Builds the `AsyncMovR`. Raises a ValueError, rather than prompting,
+            if DB_URI is incomplete.
+        """
+        self.movr = AsyncMovR(
+            build_sqla_connection_string(self.config.DB_URI,
+                                         interactive=False),
+            max_records=self.config.MAX_RECORDS,
+            pool_size=self.config.DB_POOL_SIZE,
+            max_overflow=self.config.DB_MAX_OVERFLOW,
+            pool_pre_ping=self.config.DB_POOL_PRE_PING,
+            pool_recycle=self.config.DB_POOL_RECYCLE,
+            statement_timeout=self.config.DB_STATEMENT_TIMEOUT)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.connect()
+                except ValueError as error:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.movr is not None:
+                    await self.movr.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        try:
+            if self.movr is None:  # Server without lifespan support.
+                self.connect()
+            status, payload = await route(self.movr, scope, receive)
+        except APIError as error:
+            status, payload = error.status, {'error': error.message}
+        except Exception:
+            logger.exception("Error serving %s %s", scope['method'],
+                             scope['path'])
+            status, payload = 500, {'error': "Internal server error."}
+        await send_json(send, status, payload)
+
+
+app = MovRApp()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Measures per-vehicle history latency and insert throughput for three
+location_history layouts.
+
+Builds three scratch copies of location_history, loaded with the same
+generated data:
+
+    before       no secondary index (the original schema)
+    after        INDEX (vehicle_id, ts DESC) STORING (longitude, latitude,
+                     event), as in migrations/0004
+    hash         the same index, hash-sharded (USING HASH)
+
+then, for each, times the read MovR does for a vehicle's page
+(`WHERE vehicle_id = ... ORDER BY ts DESC LIMIT ...`) and runs concurrent
+single-row check-in inserts. The scratch tables are dropped afterwards
+unless --keep is passed. Point it at a local cluster (CockroachDB 22.1 or
+later, for `USING HASH` without a bucket count):
+
+    cockroach start-single-node --insecure --listen-addr=localhost:26257
+
+Run from the `src` directory:
+    python -m benchmarks.location_history_benchmark --url <url> [options]
+
+Usage:
+    location_history_benchmark.py --url <url> [options]
+    location_history_benchmark.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             SQLAlchemy connection string, e.g.
+                                cockroachdb://root@localhost:26257/movr?sslmode=disable
+    --vehicles <number>     Vehicles in the generated data [default: 2000]
+    --points <number>       location_history rows per vehicle [default: 100]
+    --reads <number>        History reads timed per layout [default: 500]
+    --limit <number>        Rows per history read [default: 20]
+    --threads <number>      Concurrent inserting clients [default: 16]
+    --duration <secs>       Seconds of inserts per layout [default: 10]
+    --keep                  Don't drop the scratch tables.
+"""
+
+import random
+import threading
+import time
+from uuid import uuid4
+
+import numpy as np
+from docopt import docopt
+from sqlalchemy import text
+
+from movr.movr import MovR
+
+_COLUMNS = """
+    id UUID PRIMARY KEY,
+    vehicle_id UUID NOT NULL,
+    ts TIMESTAMP NOT NULL,
+    longitude FLOAT8 NOT NULL,
+    latitude FLOAT8 NOT NULL,
+    event STRING"""
+
+LAYOUTS = [
+    ('before', ''),
+    ('after', (",\n    INDEX (vehicle_id, ts DESC) "
+               "STORING (longitude, latitude, event)")),
+    ('hash', (",\n    INDEX (vehicle_id, ts DESC) USING HASH "
+              "STORING (longitude, latitude, event)")),
+]
+
+_SEED = """
+INSERT INTO {table} (id, vehicle_id, ts, longitude, latitude, event)
+     SELECT gen_random_uuid(), v.id,
+            now() - g * INTERVAL '1 minute',
+            random() * 360 - 180, random() * 180 - 90, 'end_ride'
+       FROM (SELECT gen_random_uuid() AS id
+               FROM generate_series(1, :vehicles)) AS v,
+            generate_series(1, :points) AS g
+"""
+
+_HISTORY = """
+SELECT ts, longitude, latitude FROM {table}
+ WHERE vehicle_id = CAST(:vehicle_id AS UUID)
+ ORDER BY ts DESC LIMIT :limit
+"""
+
+_CHECK_IN = """
+INSERT INTO {table} (id, vehicle_id, ts, longitude, latitude, event)
+     VALUES (CAST(:id AS UUID), CAST(:vehicle_id AS UUID), now(),
+             :longitude, :latitude, 'end_ride')
+"""
+
+
+def table_name(layout):
+    return 'location_history_bench_{}'.format(layout)
+
+
+def create_table(engine, layout, index, vehicles, points):
+    """Creates and loads one scratch table; returns its vehicle ids."""
+    table = table_name(layout)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS {}".format(table)))
+        connection.execute(text("CREATE TABLE {} ({}{})".format(
+            table, _COLUMNS, index)))
+    # One INSERT ... SELECT per 100 vehicles keeps each transaction small.
+    for start in range(0, vehicles, 100):
+        with engine.begin() as connection:
+            connection.execute(text(_SEED.format(table=table)),
+                               vehicles=min(100, vehicles - start),
+                               points=points)
+    with engine.connect() as connection:
+        return [str(row[0]) for row in connection.execute(text(
+            "SELECT DISTINCT vehicle_id FROM {}".format(table)))]
+
+
+def time_history_reads(engine, layout, vehicle_ids, reads, limit):
+    """
+    Returns
+    -------
+    Latencies of `reads` random per-vehicle history reads, in milliseconds.
+    """
+    statement = text(_HISTORY.format(table=table_name(layout)))
+    latencies = []
+    with engine.connect() as connection:
+        for _ in range(reads):
+            start = time.perf_counter()
+            connection.execute(statement,
+                               vehicle_id=random.choice(vehicle_ids),
+                               limit=limit).fetchall()
+            latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def run_inserts(engine, layout, vehicle_ids, threads, duration):
+    """
+    Inserts check-ins from `threads` threads for `duration` seconds.
+
+    Returns
+    -------
+    (inserts, errors, elapsed_seconds)
+    """
+    statement = text(_CHECK_IN.format(table=table_name(layout)))
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.monotonic() + duration
+
+    def client(index):
+        while time.monotonic() < deadline:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        statement, id=str(uuid4()),
+                        vehicle_id=random.choice(vehicle_ids),
+                        longitude=random.uniform(-180, 180),
+                        latitude=random.uniform(-90, 90))
+                counts[index] += 1
+            except Exception:  # Count it and keep the load steady.
+                errors[index] += 1
+
+    workers = [threading.Thread(target=client, args=(i,))
+               for i in range(threads)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts), sum(errors), time.monotonic() - start
+
+
+def report(layout, latencies, inserts, errors, elapsed):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print("{layout:<8} history p50 {p50:>7.2f} ms  p95 {p95:>7.2f} ms  "
+          "p99 {p99:>7.2f} ms  |  {ips:>8.1f} inserts/sec "
+          "({errors} errors)".format(layout=layout, p50=p50, p95=p95,
+                                     p99=p99, ips=inserts / elapsed,
+                                     errors=errors))
+
+
+def main():
+    opts = docopt(__doc__)
+    threads = int(opts['--threads'])
+    movr = MovR(opts['--url'], pool_size=threads, max_overflow=0)
+    engine = movr.engine
+
+    print("{} vehicles x {} points; {} reads, {} threads x {}s of inserts "
+          "per layout.".format(opts['--vehicles'], opts['--points'],
+                               opts['--reads'], threads, opts['--duration']))
+    try:
+        for layout, index in LAYOUTS:
+            vehicle_ids = create_table(engine, layout, index,
+                                       int(opts['--vehicles']),
+                                       int(opts['--points']))
+            latencies = time_history_reads(engine, layout, vehicle_ids,
+                                           int(opts['--reads']),
+                                           int(opts['--limit']))
+            report(layout, latencies,
+                   *run_inserts(engine, layout, vehicle_ids, threads,
+                                float(opts['--duration'])))
+    finally:
+        if not opts['--keep']:
+            with engine.begin() as connection:
+                for layout, _ in LAYOUTS:
+                    connection.execute(text("DROP TABLE IF EXISTS {}".format(
+                        table_name(layout))))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Measures MovR requests/sec with per-call and shared sessionmakers.
+
+Runs the same read workload twice: first with a MovR that builds a new
+sessionmaker for every transaction and uses SQLAlchemy's default pool (how
+MovR used to behave), then with the shared sessionmaker and the pool settings
+given below. Point it at a local, Postgres-compatible stand-in loaded with
+`dbinit.sql`, for example an insecure single-node CockroachDB:
+
+    cockroach start-single-node --insecure --listen-addr=localhost:26257
+
+Run from the `src` directory:
+    python -m benchmarks.pool_benchmark --url <url> [options]
+
+Usage:
+    pool_benchmark.py --url <url> [options]
+    pool_benchmark.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             SQLAlchemy connection string, e.g.
+                                cockroachdb://root@localhost:26257/movr?sslmode=disable
+    --threads <number>      Concurrent clients [default: 16]
+    --duration <secs>       Seconds to run each configuration [default: 10]
+    --pool-size <number>    Pool size for the tuned run [default: 16]
+    --max-overflow <n>      Pool overflow for the tuned run [default: 0]
+    --pool-pre-ping         Enable pre-ping for the tuned run.
+    --statement-timeout <ms>  Statement timeout for the tuned run.
+"""
+
+import random
+import threading
+import time
+
+from docopt import docopt
+from sqlalchemy.orm import sessionmaker
+
+from movr.movr import MovR
+
+
+class PerCallSessionMovR(MovR):
+    """
+    MovR as it was before the sessionmaker was shared: every transaction
+        builds a new one.
+    """
+    @property
+    def sessionmaker(self):
+        return sessionmaker(bind=self.engine)
+
+
+def run_workload(movr, vehicle_ids, threads, duration):
+    """
+    Calls `get_vehicle` from `threads` threads for `duration` seconds.
+
+    Returns
+    -------
+    (requests, errors, elapsed_seconds)
+    """
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.monotonic() + duration
+
+    def client(index):
+        while time.monotonic() < deadline:
+            try:
+                movr.get_vehicle(random.choice(vehicle_ids))
+                counts[index] += 1
+            except Exception:  # Count it and keep the load steady.
+                errors[index] += 1
+
+    workers = [threading.Thread(target=client, args=(i,))
+               for i in range(threads)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts), sum(errors), time.monotonic() - start
+
+
+def report(label, requests, errors, elapsed):
+    print("{label:<10} {rps:>10.1f} requests/sec "
+          "({requests} requests, {errors} errors, {elapsed:.1f}s)".format(
+              label=label, rps=requests / elapsed, requests=requests,
+              errors=errors, elapsed=elapsed))
+
+
+def main():
+    opts = docopt(__doc__)
+    url = opts['--url']
+    threads = int(opts['--threads'])
+    duration = float(opts['--duration'])
+    statement_timeout = opts['--statement-timeout']
+
+    before = PerCallSessionMovR(url)
+    vehicle_ids = [vehicle['id'] for vehicle in
+                   before.get_vehicles(max_vehicles=1000)[0]]
+    if not vehicle_ids:
+        raise SystemExit("No vehicles found; load dbinit.sql first.")
+
+    after = MovR(url, pool_size=int(opts['--pool-size']),
+                 max_overflow=int(opts['--max-overflow']),
+                 pool_pre_ping=opts['--pool-pre-ping'],
+                 statement_timeout=(int(statement_timeout)
+                                    if statement_timeout else None))
+
+    print("{} threads, {}s per run, {} vehicles.".format(
+        threads, duration, len(vehicle_ids)))
+    report('before', *run_workload(before, vehicle_ids, threads, duration))
+    before.engine.dispose()
+    report('after', *run_workload(after, vehicle_ids, threads, duration))
+    after.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
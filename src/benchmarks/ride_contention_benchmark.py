@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Measures start/end ride transactions when many riders want the same vehicle.
+
+Each rider thread repeatedly tries to start a ride on one of a few "hot"
+vehicles and, when it gets one, ends the ride a short distance away. Two
+implementations are compared on the same vehicles:
+
+    conditional         `start_ride_txn` / `end_ride_txn` from
+                            movr/transactions.py: one guarded
+                            UPDATE ... RETURNING statement each, with the
+                            check-in inserted by the same statement
+    read-modify-write   the previous versions, which SELECT the vehicle
+                            (and its location) before updating it
+
+and, for each, reports rides completed per second, start attempts that
+found the vehicle taken, retries CockroachDB forced (SQLSTATE 40001), start
+latency percentiles, and double starts (a vehicle's 'start_ride' check-in
+followed by another 'start_ride' rather than an 'end_ride'), which should
+always be 0. The hot vehicles are removed afterwards unless --keep is
+passed.
+
+Point it at a local, Postgres-compatible stand-in loaded with `dbinit.sql`:
+
+    cockroach start-single-node --insecure --listen-addr=localhost:26257
+
+Run from the `src` directory:
+    python -m benchmarks.ride_contention_benchmark --url <url> [options]
+
+Usage:
+    ride_contention_benchmark.py --url <url> [options]
+    ride_contention_benchmark.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             SQLAlchemy connection string, e.g.
+                                cockroachdb://root@localhost:26257/movr?sslmode=disable
+    --riders <number>       Concurrent riders [default: 32]
+    --vehicles <number>     Hot vehicles they compete for [default: 1]
+    --duration <secs>       Seconds per implementation [default: 20]
+    --keep                  Don't remove the hot vehicles.
+"""
+
+import random
+import threading
+import time
+
+import numpy as np
+from docopt import docopt
+from sqlalchemy import event, text
+from sqlalchemy_cockroachdb import run_transaction
+
+from movr.models import CurrentLocation, Vehicle
+from movr.movr import RETRY_SQLSTATE, MovR
+from movr.transactions import (end_ride_txn, record_check_in_txn,
+                               start_ride_txn)
+
+
+def read_modify_write_start_ride_txn(session, vehicle_id):
+    """The previous `start_ride_txn`: read the vehicle, then write it."""
+    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id). \
+                                     filter(Vehicle.in_use == False).first()
+    if vehicle is None:
+        return None
+    last_chx = session.query(CurrentLocation). \
+                       filter(CurrentLocation.vehicle_id == vehicle_id). \
+                       first()
+    vehicle.in_use = True
+    record_check_in_txn(session, vehicle_id, last_chx.longitude,
+                        last_chx.latitude, 'start_ride')
+    return True
+
+
+def read_modify_write_end_ride_txn(session, vehicle_id, new_longitude,
+                                   new_latitude, new_battery):
+    """The previous `end_ride_txn`: read the vehicle, then write it."""
+    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id). \
+                                     filter(Vehicle.in_use == True).first()
+    if vehicle is None:
+        return False
+    vehicle.battery = new_battery
+    vehicle.in_use = False
+    record_check_in_txn(session, vehicle_id, new_longitude, new_latitude,
+                        'end_ride')
+    return True
+
+
+IMPLEMENTATIONS = [
+    ('conditional', start_ride_txn, end_ride_txn),
+    ('read-modify-write', read_modify_write_start_ride_txn,
+     read_modify_write_end_ride_txn),
+]
+
+_DOUBLE_STARTS = """
+SELECT count(*) FROM (
+    SELECT event, lag(event) OVER (PARTITION BY vehicle_id
+                                   ORDER BY ts) AS previous
+      FROM location_history
+     WHERE vehicle_id IN ({ids})
+       AND event IN ('start_ride', 'end_ride')
+       AND ts >= :since) AS events
+ WHERE event = 'start_ride' AND previous = 'start_ride'
+"""
+
+
+class Counters:
+    """Outcomes for one implementation, shared by the rider threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rides = 0
+        self.taken = 0
+        self.errors = 0
+        self.retries = 0
+        self.start_latencies = []
+
+
+def run_riders(movr, vehicle_ids, start_ride, end_ride, riders, duration):
+    """
+    Runs `riders` threads for `duration` seconds.
+
+    Returns
+    -------
+    (counters, elapsed_seconds)
+    """
+    counters = Counters()
+    deadline = time.monotonic() + duration
+
+    def on_error(context):
+        sqlstate = getattr(context.original_exception, 'pgcode', None)
+        if sqlstate == RETRY_SQLSTATE:
+            with counters.lock:
+                counters.retries += 1
+
+    def rider(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            vehicle_id = rng.choice(vehicle_ids)
+            start = time.perf_counter()
+            try:
+                started = run_transaction(
+                    movr.sessionmaker,
+                    lambda session: start_ride(session, vehicle_id))
+                seconds = time.perf_counter() - start
+                if started:
+                    where = (rng.uniform(-74.1, -73.9),
+                             rng.uniform(40.6, 40.8), rng.randint(0, 100))
+                    run_transaction(
+                        movr.sessionmaker,
+                        lambda session: end_ride(session, vehicle_id,
+                                                 *where))
+            except Exception:  # Count it and keep the load steady.
+                with counters.lock:
+                    counters.errors += 1
+                continue
+            with counters.lock:
+                counters.start_latencies.append(seconds * 1000)
+                if started:
+                    counters.rides += 1
+                else:
+                    counters.taken += 1
+
+    event.listen(movr.engine, 'handle_error', on_error)
+    threads = [threading.Thread(target=rider, args=(i,))
+               for i in range(riders)]
+    start = time.monotonic()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(movr.engine, 'handle_error', on_error)
+    return counters, time.monotonic() - start
+
+
+def count_double_starts(engine, vehicle_ids, since):
+    ids = ', '.join("'{}'".format(vehicle_id) for vehicle_id in vehicle_ids)
+    with engine.connect() as connection:
+        return connection.execute(text(_DOUBLE_STARTS.format(ids=ids)),
+                                  since=since).scalar()
+
+
+def report(name, counters, elapsed, double_starts):
+    p50, p95, p99 = (np.percentile(counters.start_latencies, [50, 95, 99])
+                     if counters.start_latencies else (0, 0, 0))
+    print("{name:<18} {rps:>7.1f} rides/sec  {taken:>6} taken  "
+          "{retries:>5} retries  {errors:>4} errors  |  start p50 "
+          "{p50:>6.2f} ms  p95 {p95:>7.2f} ms  p99 {p99:>7.2f} ms  |  "
+          "{double} double starts".format(
+              name=name, rps=counters.rides / elapsed, taken=counters.taken,
+              retries=counters.retries, errors=counters.errors, p50=p50,
+              p95=p95, p99=p99, double=double_starts))
+
+
+def main():
+    opts = docopt(__doc__)
+    riders = int(opts['--riders'])
+    movr = MovR(opts['--url'], pool_size=riders, max_overflow=0)
+
+    vehicle_ids = [movr.add_vehicle('scooter', -74.0, 40.7, 100)['vehicle_id']
+                   for _ in range(int(opts['--vehicles']))]
+    print("{} riders competing for {} vehicle(s), {}s per "
+          "implementation.".format(riders, len(vehicle_ids),
+                                   opts['--duration']))
+    try:
+        for name, start_ride, end_ride in IMPLEMENTATIONS:
+            with movr.engine.connect() as connection:
+                since = connection.execute(text("SELECT now()")).scalar()
+            counters, elapsed = run_riders(movr, vehicle_ids, start_ride,
+                                           end_ride, riders,
+                                           float(opts['--duration']))
+            report(name, counters, elapsed,
+                   count_double_starts(movr.engine, vehicle_ids, since))
+    finally:
+        if not opts['--keep']:
+            for vehicle_id in vehicle_ids:
+                movr.remove_vehicle(vehicle_id)
+        movr.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+"""
+Simulates concurrent MovR riders and reports throughput, latency percentiles
+and transaction retries.
+
+Each rider repeatedly picks a scenario by weight (--mix):
+
+    browse   list the first page of vehicles
+    view     look at one vehicle and its location history
+    ride     open the ride page, start a ride, then end it nearby
+    add      add a new vehicle
+
+and times every step. With `--target movr` the steps call the `MovR` methods
+directly, and CockroachDB retry errors (SQLSTATE 40001) are counted on the
+engine. With `--target http` they're requests to the Flask routes of a
+running `./server.py run` (/vehicles, /vehicle/<id>, /ride/start/<id>,
+/ride/<id>, /vehicles/add); retries then happen inside the server, and
+aren't counted here.
+
+Point it at a local, Postgres-compatible stand-in loaded with `dbinit.sql`,
+for example:
+
+    cockroach start-single-node --insecure --listen-addr=localhost:26257
+
+Results can be saved as JSON (--output) and compared with an earlier run
+(--compare), e.g. before and after a change to movr/transactions.py.
+
+Run from the `src` directory:
+    python -m benchmarks.workload --url <url> [options]
+
+Usage:
+    workload.py --url <url> [options]
+    workload.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             SQLAlchemy connection string for `--target movr`
+                                (e.g. cockroachdb://root@localhost:26257/movr?sslmode=disable),
+                                or the server's base URL for `--target http`
+                                (e.g. http://localhost:36257).
+    --target <target>       movr or http [default: movr]
+    --riders <number>       Concurrent simulated riders [default: 16]
+    --duration <secs>       Seconds to measure [default: 30]
+    --warmup <secs>         Seconds to run before measuring [default: 5]
+    --mix <weights>         Scenario weights
+                                [default: browse=40,view=30,ride=25,add=5]
+    --think-ms <ms>         Pause between a rider's scenarios [default: 0]
+    --seed <number>         Random seed, for repeatable scenario choices.
+    --output <file>         Save the results as JSON.
+    --compare <file>        Print the change from an earlier JSON result.
+"""
+
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+from datetime import datetime
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                            build_opener)
+
+import numpy as np
+from docopt import docopt
+from sqlalchemy import event
+
+from movr.movr import RETRY_SQLSTATE, MovR
+
+SCENARIOS = ('browse', 'view', 'ride', 'add')
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"'
+                         r'|value="([^"]+)"[^>]*name="csrf_token"')
+
+
+def parse_mix(mix):
+    """
+    Parses `browse=40,view=30,...` into (scenarios, probabilities).
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError("Unknown scenario `{}`; use one of {}.".format(
+                name, ', '.join(SCENARIOS)))
+        weights[name.strip()] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("The scenario weights must add up to more than 0.")
+    names = sorted(weights)
+    return names, [weights[name] / total for name in names]
+
+
+class Recorder:
+    """
+    Collects per-step latencies and outcomes from every rider thread.
+
+    Steps and retries recorded outside the measured period (such as during
+        the warm-up) are discarded.
+    """
+    def __init__(self):
+        self.measuring = False
+        self.latencies = {}
+        self.errors = {}
+        self.conflicts = {}
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def start_measuring(self):
+        with self._lock:
+            self.latencies.clear()
+            self.errors.clear()
+            self.conflicts.clear()
+            self.retries = 0
+            self.measuring = True
+
+    def stop_measuring(self):
+        with self._lock:
+            self.measuring = False
+
+    def retry(self):
+        with self._lock:
+            if self.measuring:
+                self.retries += 1
+
+    def record(self, step, seconds, outcome='ok'):
+        """`outcome` is 'ok', 'conflict' (e.g. vehicle in use) or 'error'."""
+        with self._lock:
+            if not self.measuring:
+                return
+            if outcome == 'error':
+                self.errors[step] = self.errors.get(step, 0) + 1
+                return
+            if outcome == 'conflict':
+                self.conflicts[step] = self.conflicts.get(step, 0) + 1
+            self.latencies.setdefault(step, []).append(seconds * 1000)
+
+    def timed(self, step, function, *args, **kwargs):
+        """
+        Calls `function`, recording how long it took. A False or None result
+            is recorded as a conflict, and an exception as an error.
+        """
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record(step, time.perf_counter() - start, 'error')
+            return None
+        outcome = 'conflict' if result in (None, False) else 'ok'
+        self.record(step, time.perf_counter() - start, outcome)
+        return result
+
+
+class VehiclePool:
+    """The vehicle ids riders choose from; grows as vehicles are added."""
+    def __init__(self, vehicle_ids):
+        self.vehicle_ids = list(vehicle_ids)
+        self._lock = threading.Lock()
+
+    def choose(self, rng):
+        with self._lock:
+            return rng.choice(self.vehicle_ids)
+
+    def add(self, vehicle_id):
+        with self._lock:
+            self.vehicle_ids.append(vehicle_id)
+
+
+def random_position(rng):
+    return round(rng.uniform(-74.05, -73.90), 6), round(
+        rng.uniform(40.60, 40.85), 6)
+
+
+class MovRClient:
+    """Runs the scenarios as direct `MovR` calls."""
+    def __init__(self, movr, recorder, vehicles):
+        self.movr = movr
+        self.recorder = recorder
+        self.vehicles = vehicles
+
+    def browse(self, rng):
+        self.recorder.timed('get_vehicles', self.movr.get_vehicles)
+
+    def view(self, rng):
+        self.recorder.timed('get_vehicle_and_location_history',
+                            self.movr.get_vehicle_and_location_history,
+                            self.vehicles.choose(rng))
+
+    def ride(self, rng):
+        vehicle_id = self.vehicles.choose(rng)
+        self.recorder.timed('get_vehicle', self.movr.get_vehicle, vehicle_id)
+        if not self.recorder.timed('start_ride', self.movr.start_ride,
+                                   vehicle_id):
+            return
+        longitude, latitude = random_position(rng)
+        self.recorder.timed('end_ride', self.movr.end_ride, vehicle_id,
+                            longitude, latitude, rng.randint(10, 100))
+
+    def add(self, rng):
+        longitude, latitude = random_position(rng)
+        new_info = self.recorder.timed('add_vehicle', self.movr.add_vehicle,
+                                       'scooter', longitude, latitude,
+                                       rng.randint(50, 100))
+        if new_info:
+            self.vehicles.add(new_info['vehicle_id'])
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    """Returns redirects to the caller, so each route is timed on its own."""
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient:
+    """
+    Runs the scenarios as requests to the Flask routes.
+
+    Each rider has its own cookie jar, like a browser, so the CSRF tokens
+        scraped from one page are accepted by the form it posts.
+    """
+    def __init__(self, base_url, recorder, vehicles):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.vehicles = vehicles
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()),
+                                   _NoRedirect())
+
+    def request(self, path, form=None):
+        """
+        Returns:
+            (status, body) -- Redirects come back as their 3xx status.
+        """
+        data = None if form is None else urlencode(form).encode()
+        try:
+            with self.opener.open(self.base_url + path, data=data,
+                                  timeout=30) as response:
+                return response.status, response.read().decode()
+        except HTTPError as error:
+            if 300 <= error.code < 400:
+                return error.code, error.headers.get('Location', '')
+            raise
+
+    def timed_request(self, step, path, form=None, expect=None):
+        """
+        Times one request. A redirect to somewhere other than `expect` (how
+            the app reports a failed action) is recorded as a conflict.
+        """
+        start = time.perf_counter()
+        try:
+            status, body = self.request(path, form)
+        except Exception:
+            self.recorder.record(step, time.perf_counter() - start, 'error')
+            return None
+        outcome = 'ok'
+        if expect is not None and (status >= 400 or expect not in body):
+            outcome = 'conflict'
+        self.recorder.record(step, time.perf_counter() - start, outcome)
+        return body if outcome == 'ok' else None
+
+    @staticmethod
+    def csrf_token(page):
+        match = _CSRF_TOKEN.search(page or '')
+        return None if match is None else (match.group(1) or match.group(2))
+
+    def browse(self, rng):
+        self.timed_request('GET /vehicles', '/vehicles')
+
+    def view(self, rng):
+        self.timed_request('GET /vehicle/<id>',
+                           '/vehicle/{}'.format(self.vehicles.choose(rng)))
+
+    def ride(self, rng):
+        vehicle_id = self.vehicles.choose(rng)
+        if self.timed_request('POST /ride/start/<id>',
+                              '/ride/start/{}'.format(vehicle_id), form={},
+                              expect='/ride/') is None:
+            return
+        page = self.timed_request('GET /ride/<id>',
+                                  '/ride/{}'.format(vehicle_id))
+        longitude, latitude = random_position(rng)
+        form = {'longitude': longitude, 'latitude': latitude,
+                'battery': rng.randint(10, 100),
+                'csrf_token': self.csrf_token(page) or ''}
+        self.timed_request('POST /ride/<id>', '/ride/{}'.format(vehicle_id),
+                           form=form, expect='/vehicle/')
+
+    def add(self, rng):
+        page = self.timed_request('GET /vehicles/add', '/vehicles/add')
+        longitude, latitude = random_position(rng)
+        form = {'vehicle_type': 'scooter', 'longitude': longitude,
+                'latitude': latitude, 'battery': rng.randint(50, 100),
+                'csrf_token': self.csrf_token(page) or ''}
+        location = self.timed_request('POST /vehicles/add', '/vehicles/add',
+                                      form=form, expect='/vehicle/')
+        if location:
+            self.vehicles.add(location.rstrip('/').rsplit('/', 1)[-1])
+
+
+def count_retries(engine, recorder):
+    """
+    Records every CockroachDB retry error (SQLSTATE 40001) on `engine`'s
+        connections. `run_transaction` and `run_read_only_transaction` retry
+        each one, so this is the number of retries.
+    """
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        sqlstate = getattr(context.original_exception, 'pgcode', None)
+        if sqlstate == RETRY_SQLSTATE:
+            recorder.retry()
+
+
+def run_riders(clients, names, probabilities, recorder, warmup, duration,
+               think_seconds, seed):
+    """
+    Runs one thread per client until the warm-up and measured period are
+        over.
+
+    Returns:
+        {float} -- Seconds measured.
+    """
+    stop = threading.Event()
+
+    def rider(index, client):
+        rng = random.Random(None if seed is None else seed + index)
+        choices = np.random.RandomState(None if seed is None
+                                        else seed + index)
+        while not stop.is_set():
+            getattr(client, choices.choice(names, p=probabilities))(rng)
+            if think_seconds:
+                stop.wait(think_seconds)
+
+    threads = [threading.Thread(target=rider, args=(index, client))
+               for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(warmup)
+    recorder.start_measuring()
+    start = time.monotonic()
+    time.sleep(duration)
+    elapsed = time.monotonic() - start
+    recorder.stop_measuring()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return elapsed
+
+
+def summarize(recorder, elapsed):
+    """
+    Returns:
+        {dict} -- Per step, and in total: count, errors, conflicts,
+            throughput (per second) and p50/p95/p99 latency (ms).
+    """
+    steps = {}
+    for step in sorted(set(recorder.latencies) | set(recorder.errors)):
+        latencies = np.array(recorder.latencies.get(step, []))
+        p50, p95, p99 = (np.percentile(latencies, [50, 95, 99])
+                         if latencies.size else (np.nan,) * 3)
+        steps[step] = {'count': int(latencies.size),
+                       'errors': recorder.errors.get(step, 0),
+                       'conflicts': recorder.conflicts.get(step, 0),
+                       'throughput': latencies.size / elapsed,
+                       'p50_ms': float(p50), 'p95_ms': float(p95),
+                       'p99_ms': float(p99)}
+    every = np.concatenate([np.array(values) for values in
+                            recorder.latencies.values()] or [np.array([])])
+    p50, p95, p99 = (np.percentile(every, [50, 95, 99]) if every.size
+                     else (np.nan,) * 3)
+    total = {'count': int(every.size),
+             'errors': sum(recorder.errors.values()),
+             'conflicts': sum(recorder.conflicts.values()),
+             'throughput': every.size / elapsed,
+             'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+    return steps, total
+
+
+def print_table(steps, total, retries):
+    row = ("{step:<34} {count:>8} {throughput:>9.1f}/s {p50_ms:>8.2f} "
+           "{p95_ms:>8.2f} {p99_ms:>8.2f} {errors:>7} {conflicts:>9}")
+    print("{:<34} {:>8} {:>11} {:>8} {:>8} {:>8} {:>7} {:>9}".format(
+        'step', 'count', 'throughput', 'p50 ms', 'p95 ms', 'p99 ms',
+        'errors', 'conflicts'))
+    for step, stats in steps.items():
+        print(row.format(step=step, **stats))
+    print(row.format(step='total', **total))
+    if retries is not None:
+        print("Transaction retries (40001): {}".format(retries))
+
+
+def print_comparison(result, baseline):
+    """Prints each step's change in throughput and p95/p99 latency."""
+    print("\nCompared with {} ({}):".format(
+        baseline.get('commit') or 'baseline', baseline.get('started_at')))
+    old_steps = dict(baseline['steps'], total=baseline['total'])
+    new_steps = dict(result['steps'], total=result['total'])
+    for step, new in new_steps.items():
+        old = old_steps.get(step)
+        if old is None:
+            continue
+        changes = []
+        for key in ('throughput', 'p95_ms', 'p99_ms'):
+            if old[key]:
+                changes.append("{} {:+.1f}%".format(
+                    key, 100 * (new[key] - old[key]) / old[key]))
+        print("  {:<34} {}".format(step, ', '.join(changes)))
+
+
+def current_commit():
+    """The checked-out git commit, or None outside a repository."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    opts = docopt(__doc__)
+    names, probabilities = parse_mix(opts['--mix'])
+    riders = int(opts['--riders'])
+    seed = None if opts['--seed'] is None else int(opts['--seed'])
+    recorder = Recorder()
+
+    if opts['--target'] == 'movr':
+        movr = MovR(opts['--url'], pool_size=riders, max_overflow=0)
+        count_retries(movr.engine, recorder)
+        vehicles = VehiclePool(vehicle['id'] for vehicle in
+                               movr.get_vehicles(max_vehicles=1000)[0])
+        clients = [MovRClient(movr, recorder, vehicles)
+                   for _ in range(riders)]
+    elif opts['--target'] == 'http':
+        movr = None
+        listing = HTTPClient(opts['--url'], recorder, None).request(
+            '/vehicles')[1]
+        vehicles = VehiclePool(set(re.findall(
+            r'action="/vehicle/([0-9a-f-]{36})"', listing)))
+        clients = [HTTPClient(opts['--url'], recorder, vehicles)
+                   for _ in range(riders)]
+    else:
+        raise SystemExit("--target must be movr or http.")
+    if not vehicles.vehicle_ids:
+        raise SystemExit("No vehicles found; load dbinit.sql first.")
+
+    started_at = datetime.now().isoformat(timespec='seconds')
+    print("{} riders, {} target, {}s warm-up, {}s measured, mix {}.".format(
+        riders, opts['--target'], opts['--warmup'], opts['--duration'],
+        opts['--mix']))
+    elapsed = run_riders(clients, names, probabilities, recorder,
+                         float(opts['--warmup']), float(opts['--duration']),
+                         int(opts['--think-ms']) / 1000, seed)
+    steps, total = summarize(recorder, elapsed)
+    retry_count = recorder.retries if movr is not None else None
+    print_table(steps, total, retry_count)
+    if movr is not None:
+        movr.engine.dispose()
+
+    result = {'commit': current_commit(), 'started_at': started_at,
+              'config': {key.lstrip('-'): value for key, value in opts.items()
+                         if key not in ('--help', '--output', '--compare')},
+              'elapsed_seconds': elapsed, 'retries': retry_count,
+              'steps': steps, 'total': total}
+    if opts['--output']:
+        with open(opts['--output'], 'w') as output:
+            json.dump(result, output, indent=2)
+        print("Saved results to {}.".format(opts['--output']))
+    if opts['--compare']:
+        with open(opts['--compare']) as baseline:
+            print_comparison(result, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
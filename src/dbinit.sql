@@ -22,21 +22,70 @@ CREATE TABLE movr.location_history(
     vehicle_id UUID REFERENCES movr.vehicles(id) ON DELETE CASCADE,
     ts TIMESTAMP NOT NULL,
     longitude FLOAT8 NOT NULL,
-    latitude FLOAT8 NOT NULL
+    latitude FLOAT8 NOT NULL,
+    event STRING,
+    INDEX location_history_vehicle_id_ts_idx (vehicle_id, ts DESC)
+        STORING (longitude, latitude, event),
+    INDEX location_history_vehicle_id_ts_id_idx (vehicle_id, ts, id)
+        STORING (longitude, latitude, event)
 );
 
 INSERT INTO movr.location_history (id,
                                    vehicle_id,
                                    ts,
                                    longitude,
-                                   latitude)
+                                   latitude,
+                                   event)
      SELECT gen_random_uuid(),
             id,
             last_checkin,
             last_longitude,
-            last_latitude
+            last_latitude,
+            'add_vehicle'
        FROM movr.vehicles;
 
+CREATE TABLE movr.current_locations(
+    vehicle_id UUID PRIMARY KEY REFERENCES movr.vehicles(id) ON DELETE CASCADE,
+    ts TIMESTAMP NOT NULL,
+    longitude FLOAT8 NOT NULL,
+    latitude FLOAT8 NOT NULL,
+    geohash STRING,
+    INDEX current_locations_geohash_idx (geohash) STORING (longitude, latitude)
+);
+
+INSERT INTO movr.current_locations (vehicle_id, ts, longitude, latitude,
+                                    geohash)
+     SELECT id,
+            last_checkin,
+            last_longitude,
+            last_latitude,
+            st_geohash(st_makepoint(last_longitude, last_latitude), 9)
+       FROM movr.vehicles;
+
+CREATE TABLE movr.schema_migrations(
+    version INT8 PRIMARY KEY,
+    description STRING NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE movr.ride_summaries(
+    vehicle_id UUID REFERENCES movr.vehicles(id) ON DELETE CASCADE,
+    start_ts TIMESTAMP NOT NULL,
+    end_ts TIMESTAMP NOT NULL,
+    distance_km FLOAT8 NOT NULL,
+    duration_minutes FLOAT8 NOT NULL,
+    average_speed_kmh FLOAT8,
+    points INT8 NOT NULL,
+    PRIMARY KEY (vehicle_id, start_ts)
+);
+
+INSERT INTO movr.schema_migrations (version, description)
+     VALUES (1, 'current_locations projection'),
+            (2, 'location_history.event and ride_summaries'),
+            (3, 'current_locations.geohash'),
+            (4, 'location_history (vehicle_id, ts DESC) index'),
+            (5, 'location_history (vehicle_id, ts, id) index');
+
 SET sql_safe_updates = false;
 
 ALTER TABLE movr.vehicles
@@ -0,0 +1,33 @@
+"""
+gunicorn settings for `gunicorn wsgi:app`.
+
+Each can be overridden with the environment variable named below, or on
+the command line. Size DB_POOL_SIZE + DB_MAX_OVERFLOW for one worker: the
+cluster sees that many connections per worker process.
+"""
+import multiprocessing
+from os import environ
+
+bind = environ.get('BIND', '0.0.0.0:36257')
+
+# Build the app once, in the master, and fork the workers from it. Nothing
+# connects while it's built, so no connection is shared across the fork.
+preload_app = True
+
+workers = int(environ.get('WEB_CONCURRENCY',
+                          multiprocessing.cpu_count() * 2 + 1))
+# Threads let a worker keep serving while requests wait on the database or
+# stream long NDJSON listings.
+worker_class = 'gthread'
+threads = int(environ.get('WEB_THREADS', 4))
+
+timeout = int(environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+def worker_exit(server, worker):
+    """Writes the worker's buffered location pings before it exits."""
+    app = getattr(worker, 'wsgi', None)
+    if app is not None:
+        app.extensions['movr_location_buffer'].close()
@@ -0,0 +1,23 @@
+-- Adds the current_locations projection: one row per vehicle holding its
+-- most recent location_history check-in.
+--
+-- Apply with:
+--     cat migrations/0001_current_locations.sql | cockroach sql --url <url>
+-- then populate it from the existing history with:
+--     python -m util.backfill_current_locations --url <url>
+
+CREATE TABLE IF NOT EXISTS movr.schema_migrations (
+    version INT8 PRIMARY KEY,
+    description STRING NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS movr.current_locations (
+    vehicle_id UUID PRIMARY KEY REFERENCES movr.vehicles(id) ON DELETE CASCADE,
+    ts TIMESTAMP NOT NULL,
+    longitude FLOAT8 NOT NULL,
+    latitude FLOAT8 NOT NULL
+);
+
+UPSERT INTO movr.schema_migrations (version, description)
+     VALUES (1, 'current_locations projection');
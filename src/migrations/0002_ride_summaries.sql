@@ -0,0 +1,26 @@
+-- Marks which location_history rows start and end rides, and adds the
+-- ride_summaries table that util/ride_statistics.py fills in.
+--
+-- Apply with:
+--     cat migrations/0002_ride_summaries.sql | cockroach sql --url <url>
+-- then build the summaries with:
+--     python -m util.ride_statistics --url <url>
+--
+-- Adding a nullable column is an online schema change; rows written before
+-- it have a NULL event, and rides made of them can't be rebuilt.
+
+ALTER TABLE movr.location_history ADD COLUMN IF NOT EXISTS event STRING;
+
+CREATE TABLE IF NOT EXISTS movr.ride_summaries (
+    vehicle_id UUID REFERENCES movr.vehicles(id) ON DELETE CASCADE,
+    start_ts TIMESTAMP NOT NULL,
+    end_ts TIMESTAMP NOT NULL,
+    distance_km FLOAT8 NOT NULL,
+    duration_minutes FLOAT8 NOT NULL,
+    average_speed_kmh FLOAT8,
+    points INT8 NOT NULL,
+    PRIMARY KEY (vehicle_id, start_ts)
+);
+
+UPSERT INTO movr.schema_migrations (version, description)
+     VALUES (2, 'location_history.event and ride_summaries');
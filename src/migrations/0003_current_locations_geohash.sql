@@ -0,0 +1,24 @@
+-- Adds a geohash cell id to current_locations, and an index on it, for
+-- MovR.find_nearby_vehicles.
+--
+-- Apply with:
+--     cat migrations/0003_current_locations_geohash.sql | cockroach sql --url <url>
+--
+-- The app writes the geohash on every check-in once this is applied. The
+-- UPDATE fills in rows written before it; on a large table, re-running
+-- `python -m util.backfill_current_locations --url <url>` does the same
+-- work in small batches instead. Vehicles without a geohash don't show up
+-- in nearby searches.
+
+ALTER TABLE movr.current_locations ADD COLUMN IF NOT EXISTS geohash STRING;
+
+UPDATE movr.current_locations
+   SET geohash = st_geohash(st_makepoint(longitude, latitude), 9)
+ WHERE geohash IS NULL;
+
+CREATE INDEX IF NOT EXISTS current_locations_geohash_idx
+    ON movr.current_locations (geohash)
+       STORING (longitude, latitude);
+
+UPSERT INTO movr.schema_migrations (version, description)
+     VALUES (3, 'current_locations.geohash');
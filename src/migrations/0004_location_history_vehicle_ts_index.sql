@@ -0,0 +1,25 @@
+-- Indexes location_history on (vehicle_id, ts DESC), storing the columns the
+-- read paths use, so a vehicle's recent history is one short range scan of
+-- the index instead of a full table scan and sort.
+--
+-- Apply with:
+--     cat migrations/0004_location_history_vehicle_ts_index.sql | cockroach sql --url <url>
+--
+-- CREATE INDEX is an online schema change: the table stays readable and
+-- writable while the index backfills.
+--
+-- The index isn't hash-sharded. Its leading column is a random UUID, so
+-- inserts are already spread across ranges and there's no hotspot to
+-- remove; sharding would put a hash of (vehicle_id, ts) in front of the key,
+-- and every per-vehicle read would have to scan all of the buckets. (The
+-- primary key, a random UUID, doesn't hotspot either.) Hash-sharding only
+-- pays off for an index led by a sequential column, such as `ts` alone:
+--     CREATE INDEX ON movr.location_history (ts) USING HASH;
+-- benchmarks/location_history_benchmark.py measures all three layouts.
+
+CREATE INDEX IF NOT EXISTS location_history_vehicle_id_ts_idx
+    ON movr.location_history (vehicle_id, ts DESC)
+       STORING (longitude, latitude, event);
+
+UPSERT INTO movr.schema_migrations (version, description)
+     VALUES (4, 'location_history (vehicle_id, ts DESC) index');
@@ -0,0 +1,19 @@
+-- Indexes location_history on (vehicle_id, ts, id), ascending, which is the
+-- order util/ride_statistics.py reads the table in. Each of its chunks
+-- (`WHERE (vehicle_id, ts, id) > <last row> ORDER BY vehicle_id, ts, id
+-- LIMIT <n>`) is then one range scan of the index. Without it, every chunk
+-- scans and sorts the rest of the table.
+--
+-- Apply with:
+--     cat migrations/0005_location_history_ride_order_index.sql | cockroach sql --url <url>
+--
+-- The (vehicle_id, ts DESC) index from 0004 can't serve this: it runs the
+-- other way on `ts`, and a reverse scan of it would reverse `vehicle_id`
+-- too. Like 0004, this is an online schema change.
+
+CREATE INDEX IF NOT EXISTS location_history_vehicle_id_ts_id_idx
+    ON movr.location_history (vehicle_id, ts, id)
+       STORING (longitude, latitude, event);
+
+UPSERT INTO movr.schema_migrations (version, description)
+     VALUES (5, 'location_history (vehicle_id, ts, id) index');
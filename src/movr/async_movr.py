@@ -0,0 +1,324 @@
+"""
+Defines an asyncio version of the MovR database connection.
+
+`AsyncMovR` has the same methods as `MovR`, as coroutines, and runs the same
+`*_txn` functions from movr/transactions.py through `AsyncSession.run_sync`,
+so there's a single copy of every query. It uses SQLAlchemy 1.4's asyncio
+extension, asyncpg, and sqlalchemy-cockroachdb's `cockroachdb+asyncpg`
+dialect (1.4.4 or later); requirement.txt pins all three.
+"""
+import asyncio
+import ssl
+from contextlib import nullcontext
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from movr.movr import (MAX_HISTORY_POINTS, as_of_system_time, is_retryable,
+                       location_history_points, location_history_reader,
+                       set_transaction_statement)
+from movr.transactions import (add_vehicle_txn, end_ride_txn,
+                               find_nearby_vehicles_txn, get_vehicle_txn,
+                               get_vehicles_txn, record_locations_txn,
+                               remove_vehicle_txn, start_ride_txn,
+                               get_vehicle_and_location_history_txn)
+
+
+def build_async_connection(conn_string):
+    """
+    Converts a `cockroachdb://` connection string (as built by
+        `build_sqla_connection_string`) for the asyncpg driver.
+
+    asyncpg doesn't take libpq's `sslmode`, `sslrootcert` or
+        `connect_timeout` parameters, so they're removed from the URL and
+        turned into the equivalent `connect_args`.
+
+    Arguments:
+        conn_string {String} -- CockroachDB connection string.
+
+    Returns:
+        (url, connect_args): The `cockroachdb+asyncpg` URL, and the keyword
+            arguments asyncpg should connect with.
+    """
+    url = make_url(conn_string)
+    query = dict(url.query)
+    sslmode = query.pop('sslmode', None)
+    sslrootcert = query.pop('sslrootcert', None)
+    connect_timeout = query.pop('connect_timeout', None)
+
+    connect_args = {}
+    if sslmode == 'disable':
+        connect_args['ssl'] = False
+    elif sslmode is not None:
+        context = ssl.create_default_context(cafile=sslrootcert)
+        if sslmode in ('require', 'prefer', 'allow'):
+            context.check_hostname = False
+            if sslrootcert is None:
+                context.verify_mode = ssl.CERT_NONE
+        elif sslmode == 'verify-ca':
+            context.check_hostname = False
+        connect_args['ssl'] = context
+    if connect_timeout is not None:
+        connect_args['timeout'] = float(connect_timeout)
+
+    url = url.set(drivername='cockroachdb+asyncpg', query=query)
+    return url, connect_args
+
+
+async def run_transaction_async(session_factory, callback, max_retries=10,
+                                set_transaction=None):
+    """
+    The asyncio counterpart of `sqlalchemy_cockroachdb.run_transaction`.
+
+    Runs `callback(session)` (a synchronous `*_txn` function) in a
+        transaction on an `AsyncSession`, and commits it. When CockroachDB
+        asks for a retry (SQLSTATE 40001), the whole transaction is rolled
+        back and run again from the start, after an exponential backoff that
+        yields to the event loop instead of blocking it.
+
+    Arguments:
+        session_factory {sessionmaker} -- Builds `AsyncSession`s.
+        callback {function} -- The `*_txn` function to run.
+        max_retries {int} -- Attempts before giving up on retryable errors.
+        set_transaction {TextClause} -- Optional `SET TRANSACTION` statement
+            run first, e.g. from `set_transaction_statement`.
+    """
+    for retries in range(max_retries + 1):
+        async with session_factory() as session:
+            try:
+                async with session.begin():
+                    if set_transaction is not None:
+                        await session.execute(set_transaction)
+                    return await session.run_sync(callback)
+            except DBAPIError as error:
+                if not is_retryable(error) or retries == max_retries:
+                    raise
+        await asyncio.sleep(0.01 * 2 ** retries)
+
+
+class AsyncMovR:
+    """
+    Wraps an asyncio database connection. The coroutine methods wrap
+        transactions, and return the same values as `MovR`'s.
+    """
+    def __init__(self, conn_string, max_records=20, pool_size=5,
+                 max_overflow=10, pool_pre_ping=False, pool_recycle=-1,
+                 statement_timeout=None, staleness=None,
+                 instrumentation=None):
+        """
+        Creates the async engine and its connection pool. Nothing connects
+            until the first transaction runs.
+
+        Arguments:
+            conn_string {String} -- CockroachDB connection string.
+            max_records {int} -- Default page size for listings.
+            pool_size {int} -- Connections kept open in the pool.
+            max_overflow {int} -- Connections allowed beyond `pool_size`.
+            pool_pre_ping {bool} -- Test connections before handing them out.
+            pool_recycle {int} -- Seconds before a connection is replaced
+                (-1 never replaces them).
+            statement_timeout {int} -- Per-statement timeout, in milliseconds,
+                set on every new connection (None keeps the server default).
+            staleness {String} -- Default staleness for the read-only
+                methods. See `as_of_system_time`.
+            instrumentation {Instrumentation} -- Optional per-transaction
+                metrics; see movr/instrumentation.py.
+        """
+        as_of_system_time(staleness)  # Fail fast on a bad mode.
+        url, connect_args = build_async_connection(conn_string)
+        if statement_timeout is not None:
+            connect_args['server_settings'] = {
+                'statement_timeout': str(int(statement_timeout))}
+        self.engine = create_async_engine(url, pool_size=pool_size,
+                                          max_overflow=max_overflow,
+                                          pool_pre_ping=pool_pre_ping,
+                                          pool_recycle=pool_recycle,
+                                          connect_args=connect_args)
+        self.sessionmaker = sessionmaker(bind=self.engine, class_=AsyncSession,
+                                         expire_on_commit=False)
+        self.connection_string = conn_string
+        self.max_records = max_records
+        self.staleness = staleness
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            instrumentation.instrument(self.engine.sync_engine)
+
+    async def close(self):
+        """Closes every pooled connection."""
+        await self.engine.dispose()
+
+    def _track(self, name):
+        """Records the enclosed transaction's metrics under `name`."""
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.track(name)
+
+    async def _write(self, name, callback):
+        with self._track(name):
+            return await run_transaction_async(self.sessionmaker, callback)
+
+    async def _read(self, name, callback, staleness):
+        """
+        Runs a read-only transaction at `staleness`, or at the default
+            staleness if that's None, recording it as `name`.
+        """
+        if staleness is None:
+            staleness = self.staleness
+        with self._track(name):
+            return await run_transaction_async(
+                self.sessionmaker, callback,
+                set_transaction=set_transaction_statement(staleness))
+
+    async def start_ride(self, vehicle_id):
+        """
+        Starts a ride. See `MovR.start_ride`.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+        """
+        return await self._write(
+            'start_ride_txn',
+            lambda session: start_ride_txn(session, vehicle_id))
+
+    async def end_ride(self, vehicle_id, new_longitude, new_latitude,
+                       new_battery):
+        """
+        Ends a ride. See `MovR.end_ride`.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+            new_longitude {float} -- Vehicle's new longitude coordinate
+            new_latitude {float} -- Vehicle's new latitude coordinate
+            new_battery {int} -- Vehicle's new battery reading
+
+        Returns:
+            {dict} or {False} -- The vehicle's state at the end of the ride,
+                or False if the ride couldn't be ended.
+        """
+        return await self._write(
+            'end_ride_txn',
+            lambda session: end_ride_txn(session, vehicle_id, new_longitude,
+                                         new_latitude, new_battery))
+
+    async def remove_vehicle(self, vehicle_id):
+        """
+        "Removes" a vehicle. See `MovR.remove_vehicle`.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+        """
+        return await self._write(
+            'remove_vehicle_txn',
+            lambda session: remove_vehicle_txn(session, vehicle_id))
+
+    async def add_vehicle(self, vehicle_type, longitude, latitude, battery):
+        """
+        Adds a vehicle. See `MovR.add_vehicle`.
+
+        Arguments:
+            vehicle_type {String} -- The type of vehicle.
+
+        Returns:
+            {dict} -- {'vehicle_id': <UUID>, 'vehicle': <dict>}
+        """
+        return await self._write(
+            'add_vehicle_txn',
+            lambda session: add_vehicle_txn(session, vehicle_type, longitude,
+                                            latitude, battery))
+
+    async def record_locations(self, locations, rows_per_transaction=1000):
+        """
+        Writes a batch of location pings. See `MovR.record_locations`.
+
+        Returns:
+            (written, rejected)
+        """
+        written = rejected = 0
+        for start in range(0, len(locations), rows_per_transaction):
+            chunk = locations[start:start + rows_per_transaction]
+            chunk_written, chunk_rejected = await self._write(
+                'record_locations_txn',
+                lambda session: record_locations_txn(session, chunk))
+            written += chunk_written
+            rejected += chunk_rejected
+        return written, rejected
+
+    async def get_vehicles(self, max_vehicles=None, after_id=None,
+                           before_id=None, staleness=None):
+        """
+        Gets one page of vehicles. See `MovR.get_vehicles`.
+
+        Returns:
+            (vehicles, next_id, prev_id)
+        """
+        if max_vehicles is None:
+            max_vehicles = self.max_records
+        return await self._read(
+            'get_vehicles_txn',
+            lambda session: get_vehicles_txn(session, max_vehicles,
+                                             after_id=after_id,
+                                             before_id=before_id),
+            staleness)
+
+    async def find_nearby_vehicles(self, longitude, latitude, radius_km,
+                                   limit=None, available_only=True,
+                                   staleness=None):
+        """
+        Finds the vehicles nearest a point. See `MovR.find_nearby_vehicles`.
+        """
+        if limit is None:
+            limit = self.max_records
+        return await self._read(
+            'find_nearby_vehicles_txn',
+            lambda session: find_nearby_vehicles_txn(
+                session, longitude, latitude, radius_km, limit,
+                available_only=available_only),
+            staleness)
+
+    async def get_vehicle(self, vehicle_id, staleness=None):
+        """
+        Gets a single vehicle from its id, or None.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+            staleness {String} -- Overrides the default staleness.
+        """
+        return await self._read(
+            'get_vehicle_txn',
+            lambda session: get_vehicle_txn(session, vehicle_id), staleness)
+
+    async def get_vehicle_and_location_history(self, vehicle_id,
+                                               max_locations=None,
+                                               staleness=None):
+        """
+        Gets vehicle info AND recent locations. See
+            `MovR.get_vehicle_and_location_history`.
+
+        Returns:
+            (vehicle, location_history), or (None, []) if the vehicle isn't
+                in the database.
+        """
+        if max_locations is None:
+            max_locations = self.max_records
+        return await self._read(
+            'get_vehicle_and_location_history_txn',
+            lambda session: get_vehicle_and_location_history_txn(
+                session, vehicle_id, max_locations),
+            staleness)
+
+    async def get_location_history(self, vehicle_id, start=None, end=None,
+                                   resolution=None, tolerance_km=None,
+                                   staleness=None,
+                                   max_points=MAX_HISTORY_POINTS):
+        """
+        Gets a vehicle's path over a time window, bucketed and simplified.
+            See `MovR.get_location_history`.
+        """
+        rows = await self._read('get_location_history_txn',
+                                location_history_reader(
+                                    vehicle_id, start, end, resolution,
+                                    max_points),
+                                staleness)
+        return location_history_points(rows, tolerance_km, max_points)
@@ -0,0 +1,200 @@
+"""
+Read-through caching for MovR's vehicle lookups.
+
+`VehicleCache` sits in front of `get_vehicle` and `get_vehicles` and is
+invalidated by the write paths. Where entries live is up to its backend:
+`InProcessCache` for a single server process, or `RedisCache` to share one
+cache between processes.
+"""
+import pickle
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# Returned by backends on a miss, so a cached `None` (vehicle not found) can
+# be told apart from no entry at all.
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """
+    Storage interface used by `VehicleCache`.
+
+    Implement all four methods to plug in another shared cache. Counters
+        (`incr`) must not be evicted: `VehicleCache` keys listings on one.
+    """
+    @abstractmethod
+    def get(self, key):
+        """Returns the cached value, or `MISSING`."""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Stores `value` for `ttl` seconds."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Removes `key`, if present."""
+
+    @abstractmethod
+    def incr(self, key):
+        """Atomically adds 1 to a counter (missing counts as 0); returns it."""
+
+
+class InProcessCache(CacheBackend):
+    """
+    Thread-safe in-memory cache with per-entry TTLs and LRU eviction.
+
+    Counters are kept apart from the entries, and are never evicted.
+
+    Arguments:
+        max_entries {int} -- Least recently used entries are evicted past
+            this size.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._counters = {}  # key -> int
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._counters.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._counters.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(CacheBackend):
+    """
+    Adapts a redis-py style client (`get`, `set(ex=...)`, `delete`, `incr`)
+        so several server processes can share one cache.
+
+    The listing generation is stored without an expiry, so configure Redis
+        with a `volatile-*` or `noeviction` maxmemory policy; an
+        `allkeys-*` policy could evict it.
+
+    Arguments:
+        client -- A connected client, e.g. `redis.Redis(...)`.
+        prefix {String} -- Namespace for MovR's keys.
+    """
+    def __init__(self, client, prefix='movr:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return MISSING
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value),
+                        ex=None if ttl is None else max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return int(self.client.incr(self.prefix + key))
+
+
+class VehicleCache:
+    """
+    Caches single-vehicle and listing results, and counts hits and misses.
+
+    Listing keys include a generation number that every write bumps, so one
+    write invalidates every cached page without having to find them. Entries
+    also expire after `ttl` seconds, which bounds how long a read that raced
+    a write can keep serving the old row.
+
+    Arguments:
+        backend {CacheBackend} -- Where entries are stored.
+        ttl {float} -- Seconds an entry stays valid.
+    """
+    GENERATION_KEY = 'vehicles:generation'
+
+    def __init__(self, backend, ttl=5):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get_or_load(self, key, loader):
+        value = self.backend.get(key)
+        hit = value is not MISSING
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            return value
+        value = loader()
+        self.backend.set(key, value, self.ttl)
+        return value
+
+    def vehicle(self, vehicle_id, loader):
+        """Returns the cached vehicle, calling `loader()` on a miss."""
+        return self._get_or_load('vehicle:{}'.format(vehicle_id), loader)
+
+    def listing(self, max_vehicles, after_id, before_id, loader):
+        """Returns a cached page of vehicles, calling `loader()` on a miss."""
+        generation = self.backend.get(self.GENERATION_KEY)
+        if generation is MISSING:
+            generation = 0
+        key = 'vehicles:{}:{}:{}:{}'.format(generation, max_vehicles,
+                                            after_id, before_id)
+        return self._get_or_load(key, loader)
+
+    def invalidate(self, vehicle_id):
+        """Drops a vehicle's entry and every cached listing."""
+        self.backend.delete('vehicle:{}'.format(vehicle_id))
+        self.backend.incr(self.GENERATION_KEY)
+
+    def invalidate_many(self, vehicle_ids):
+        """Drops several vehicles' entries, bumping the generation once."""
+        for vehicle_id in vehicle_ids:
+            self.backend.delete('vehicle:{}'.format(vehicle_id))
+        self.backend.incr(self.GENERATION_KEY)
+
+    def stats(self):
+        """
+        Returns:
+            {dict} -- Hit and miss counts, and the hit ratio.
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses,
+                'hit_ratio': hits / lookups if lookups else 0.0}
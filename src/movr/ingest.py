@@ -0,0 +1,227 @@
+"""
+Bulk ingest of vehicle location pings.
+
+`parse_locations` turns a JSON or NDJSON request body into ping dictionaries,
+and `LocationBuffer` collects pings from many requests and writes them with
+`MovR.record_locations`, so thousands of pings share one transaction instead
+of each taking its own.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from uuid import UUID
+
+logger = logging.getLogger(__name__)
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson',
+                        'application/jsonl')
+
+
+class IngestError(ValueError):
+    """A ping, or the request body holding it, is malformed."""
+
+
+class BufferFull(RuntimeError):
+    """The buffer is at capacity; the client should back off and retry."""
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 timestamp (or Unix seconds) into a naive UTC datetime,
+        the way `ts` columns are stored.
+    """
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value)
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def parse_location(item, received_at):
+    """
+    Validates one ping.
+
+    Arguments:
+        item {dict} -- `vehicle_id`, `longitude`, `latitude`, and optionally
+            `ts` (when the device took the reading).
+        received_at {datetime} -- Used when the ping has no `ts`.
+
+    Returns:
+        {dict} -- The ping, ready for `MovR.record_locations`.
+    """
+    if not isinstance(item, dict):
+        raise IngestError("Each ping must be a JSON object.")
+    try:
+        vehicle_id = str(UUID(item['vehicle_id']))
+        longitude = float(item['longitude'])
+        latitude = float(item['latitude'])
+        ts = (received_at if item.get('ts') is None
+              else parse_timestamp(item['ts']))
+    except KeyError as error:
+        raise IngestError("Missing `{}`.".format(error.args[0]))
+    except (TypeError, ValueError, OverflowError) as error:
+        raise IngestError(str(error))
+    if not -180 <= longitude <= 180:
+        raise IngestError("Longitude must be between -180 and 180.")
+    if not -90 <= latitude <= 90:
+        raise IngestError("Latitude must be between -90 and 90.")
+    return {'vehicle_id': vehicle_id, 'longitude': longitude,
+            'latitude': latitude, 'ts': ts}
+
+
+def parse_locations(body, content_type):
+    """
+    Parses a request body of pings.
+
+    Arguments:
+        body {bytes} -- Either NDJSON (one ping per line), or JSON: a list of
+            pings, or {"locations": [...]}.
+        content_type {String} -- The request's mimetype; picks the format.
+
+    Returns:
+        {list} -- Validated pings.
+
+    Raises:
+        IngestError -- Naming the first bad ping (1-based).
+    """
+    received_at = datetime.utcnow()
+    try:
+        if content_type in NDJSON_CONTENT_TYPES:
+            items = [json.loads(line) for line in body.splitlines()
+                     if line.strip()]
+        else:
+            items = json.loads(body)
+            if isinstance(items, dict):
+                items = items.get('locations')
+    except ValueError as error:
+        raise IngestError("Invalid JSON: {}".format(error))
+    if not isinstance(items, list):
+        raise IngestError("Expected a list of pings.")
+
+    locations = []
+    for number, item in enumerate(items, start=1):
+        try:
+            locations.append(parse_location(item, received_at))
+        except IngestError as error:
+            raise IngestError("Ping {}: {}".format(number, error))
+    return locations
+
+
+class LocationBuffer:
+    """
+    Buffers pings in memory and writes them in batches.
+
+    Background writer threads take a batch as soon as `batch_size` pings
+        are waiting, and otherwise every `flush_interval` seconds, so a ping
+        waits at most about that long. The threads start with the first
+        ping in each process, since threads don't survive a `fork`. Pings
+        are acknowledged once buffered, so a crash loses at most what's
+        waiting; clients that need confirmation should call
+        `MovR.record_locations` directly.
+
+    Arguments:
+        movr {MovR} -- Where pings are written.
+        batch_size {int} -- Pings per write.
+        flush_interval {float} -- Longest a ping waits, in seconds.
+        max_pending {int} -- `add` raises `BufferFull` past this many waiting
+            pings, so a slow database pushes back on clients instead of
+            growing the buffer without bound.
+        writers {int} -- Writer threads; more keep up with a slower database.
+    """
+    def __init__(self, movr, batch_size=1000, flush_interval=0.2,
+                 max_pending=50000, writers=2):
+        self.movr = movr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self._pending = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._writers = writers
+        self._threads = []
+        self._pid = None
+
+    def _start(self):
+        """Starts this process's writer threads; call holding the lock."""
+        self._pending = []  # Anything inherited is the parent's to write.
+        self._threads = [threading.Thread(target=self._run,
+                                          name='location-buffer-{}'.format(i),
+                                          daemon=True)
+                         for i in range(self._writers)]
+        for thread in self._threads:
+            thread.start()
+        self._pid = os.getpid()
+
+    def add(self, locations):
+        """Queues pings for the next batch."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The location buffer is closed.")
+            if self._pid != os.getpid():
+                self._start()
+            if len(self._pending) + len(locations) > self.max_pending:
+                raise BufferFull("{} pings are already waiting.".format(
+                    len(self._pending)))
+            self._pending.extend(locations)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def _take_batch(self):
+        """Waits until a batch is due, then removes it from the buffer."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self._pending) >= self.batch_size or self._closed,
+                timeout=self.flush_interval)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            return batch
+
+    def _write(self, batch):
+        try:
+            written, rejected = self.movr.record_locations(batch)
+        except Exception:  # Keep the writer alive; the batch is lost.
+            with self._stats_lock:
+                self.failed += len(batch)
+            logger.exception("Dropped %d location pings.", len(batch))
+            return
+        with self._stats_lock:
+            self.written += written
+            self.rejected += rejected
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+            elif self._closed:
+                return
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def stats(self):
+        """
+        Returns:
+            {dict} -- Pings waiting, written, rejected (unknown vehicle) and
+                failed (dropped after a database error).
+        """
+        return {'pending': self.pending(), 'written': self.written,
+                'rejected': self.rejected, 'failed': self.failed}
+
+    def close(self):
+        """Writes whatever is waiting, then stops the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._pid != os.getpid():  # Started by another process, or never.
+            return
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,222 @@
+"""
+Per-transaction metrics for MovR.
+
+`Instrumentation` times every transaction `MovR` runs, and, through engine
+events, counts the statements it executed, the rows they returned or
+changed, and the retries CockroachDB forced, all broken down by transaction
+name (`start_ride_txn`, `get_vehicles_txn`, ...). `render` formats them in
+the Prometheus text exposition format, and transactions slower than a
+threshold are logged.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from movr.movr import RETRY_SQLSTATE
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# The transaction running in this thread (or asyncio task), if any.
+_current = ContextVar('movr_transaction', default=None)
+
+
+class TransactionStats:
+    """
+    Running totals for one transaction name, and its latency histogram.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.retries = 0
+        self.statements = 0
+        self.rows = 0
+
+    def observe(self, seconds, call):
+        self.count += 1
+        self.seconds += seconds
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[index] += 1
+                break
+        self.errors += call.failed
+        self.retries += call.retries
+        self.statements += call.statements
+        self.rows += call.rows
+
+
+class _Call:
+    """What one transaction did; filled in by the engine events."""
+    __slots__ = ('name', 'statements', 'rows', 'retries', 'failed')
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.rows = 0
+        self.retries = 0
+        self.failed = False
+
+
+class Instrumentation:
+    """
+    Collects per-transaction metrics.
+
+    Call `instrument(engine)` once for each engine, and wrap every
+        transaction in `track(<name>)`.
+
+    Arguments:
+        slow_threshold {float} -- Transactions that take longer than this
+            many seconds are logged with their statement, row and retry
+            counts. None turns the log off.
+        buckets {tuple} -- Latency histogram bucket bounds, in seconds.
+    """
+    def __init__(self, slow_threshold=None, buckets=DEFAULT_BUCKETS):
+        self.slow_threshold = slow_threshold
+        self.buckets = buckets
+        self.transactions = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def instrument(self, engine):
+        """Counts statements, rows and retries on `engine`'s connections."""
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+        event.listen(engine, 'after_cursor_execute', self._on_executed)
+        event.listen(engine, 'handle_error', self._on_error)
+
+    @staticmethod
+    def _on_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+        call = _current.get()
+        if call is not None:
+            call.statements += 1
+
+    @staticmethod
+    def _on_executed(conn, cursor, statement, parameters, context,
+                     executemany):
+        call = _current.get()
+        if call is not None and cursor.rowcount is not None \
+                and cursor.rowcount > 0:
+            call.rows += cursor.rowcount
+
+    @staticmethod
+    def _on_error(context):
+        call = _current.get()
+        if call is None:
+            return
+        error = context.original_exception
+        sqlstate = (getattr(error, 'pgcode', None)
+                    or getattr(error, 'sqlstate', None))
+        if sqlstate == RETRY_SQLSTATE:
+            call.retries += 1
+
+    @contextmanager
+    def track(self, name):
+        """
+        Times the transaction run inside the block, under `name`.
+
+        Retries happen inside the block, so they're part of its latency.
+        """
+        call = _Call(name)
+        token = _current.set(call)
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            _current.reset(token)
+            self._observe(call, seconds)
+
+    def _observe(self, call, seconds):
+        with self._lock:
+            stats = self.transactions.get(call.name)
+            if stats is None:
+                stats = self.transactions[call.name] = TransactionStats(
+                    self.buckets)
+            stats.observe(seconds, call)
+        if self.slow_threshold is not None and seconds > self.slow_threshold:
+            logger.warning(
+                "Slow transaction %s: %.1f ms, %d statements, %d rows, "
+                "%d retries%s", call.name, seconds * 1000, call.statements,
+                call.rows, call.retries, " (failed)" if call.failed else "")
+
+    def add_collector(self, collector):
+        """
+        Adds extra metrics to `render`.
+
+        Arguments:
+            collector {function} -- Called on every render; returns a list of
+                (metric name, type, help text, values) metrics, where type is
+                'gauge' for a current level or 'counter' for a total since
+                start (named `..._total`), and `values` maps a tuple of
+                (label, value) pairs (or None) to a number.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        Returns:
+            {String} -- Every metric, in the Prometheus text format.
+        """
+        with self._lock:
+            snapshot = [(name, stats.count, stats.seconds,
+                         list(stats.bucket_counts), stats.errors,
+                         stats.retries, stats.statements, stats.rows)
+                        for name, stats in sorted(self.transactions.items())]
+
+        lines = ["# HELP movr_transaction_duration_seconds Time spent in each "
+                 "transaction, including retries.",
+                 "# TYPE movr_transaction_duration_seconds histogram"]
+        for name, count, seconds, bucket_counts, *_ in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(
+                    'movr_transaction_duration_seconds_bucket{{transaction='
+                    '"{}",le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('movr_transaction_duration_seconds_bucket{{'
+                         'transaction="{}",le="+Inf"}} {}'.format(name, count))
+            lines.append('movr_transaction_duration_seconds_sum{{'
+                         'transaction="{}"}} {}'.format(name, seconds))
+            lines.append('movr_transaction_duration_seconds_count{{'
+                         'transaction="{}"}} {}'.format(name, count))
+
+        counters = [
+            ('movr_transaction_errors_total', 4,
+             "Transactions that raised an error."),
+            ('movr_transaction_retries_total', 5,
+             "Retries CockroachDB forced (SQLSTATE 40001)."),
+            ('movr_transaction_statements_total', 6,
+             "Statements executed, including retried ones."),
+            ('movr_transaction_rows_total', 7,
+             "Rows returned or changed by those statements."),
+        ]
+        for metric, column, help_text in counters:
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} counter".format(metric))
+            for row in snapshot:
+                lines.append('{}{{transaction="{}"}} {}'.format(
+                    metric, row[0], row[column]))
+
+        for collector in self.collectors:
+            for metric, metric_type, help_text, values in collector():
+                lines.append("# HELP {} {}".format(metric, help_text))
+                lines.append("# TYPE {} {}".format(metric, metric_type))
+                for labels, value in values.items():
+                    label_text = '' if not labels else '{{{}}}'.format(
+                        ','.join('{}="{}"'.format(key, label)
+                                 for key, label in labels))
+                    lines.append('{}{} {}'.format(metric, label_text, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,147 @@
+"""
+Cached cluster metadata, and the live checks behind /serverstatus.
+
+Catalog lookups (the table list, row-count estimates, the schema version)
+are refreshed at most once per `refresh_interval`, by one caller at a time;
+everyone else gets the cached value. When a refresh fails the previous value
+is kept until the next interval, so a burst of error pages (which all list
+the tables) can't turn into a burst of catalog queries.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+_ROW_ESTIMATES = text(
+    "SELECT table_name, estimated_row_count "
+    "FROM crdb_internal.table_row_statistics")
+
+_SCHEMA_VERSION = text("SELECT max(version) FROM schema_migrations")
+
+
+class CachedValue:
+    """
+    A value that's reloaded by `loader()` when it's older than
+        `refresh_interval` seconds.
+
+    Arguments:
+        loader {function} -- Fetches a fresh value.
+        refresh_interval {float} -- Seconds a value (or a failure) is kept.
+        default -- Returned until the first load has finished.
+    """
+    def __init__(self, loader, refresh_interval, default=None):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.value = default
+        self.error = None
+        self.fetched_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the cached value, refreshing it first if it's due."""
+        with self._lock:
+            fresh = (self.fetched_at is not None and time.monotonic()
+                     - self.fetched_at < self.refresh_interval)
+            if fresh or self._refreshing:  # Someone else is reloading it.
+                return self.value
+            self._refreshing = True
+        value, error = self.value, None
+        try:
+            value = self.loader()
+        except Exception as exception:  # Keep serving the last good value.
+            error = exception
+            logger.warning("Couldn't refresh %s: %s", self.loader.__name__,
+                           exception)
+        with self._lock:
+            self.value, self.error = value, error
+            self.fetched_at = time.monotonic()
+            self._refreshing = False
+        return value
+
+    def age(self):
+        """Seconds since the last refresh, or None before the first one."""
+        if self.fetched_at is None:
+            return None
+        return time.monotonic() - self.fetched_at
+
+
+class ClusterMetadata:
+    """
+    Cached catalog information for one engine.
+
+    Arguments:
+        engine {Engine} -- The app's engine.
+        refresh_interval {float} -- Seconds between catalog queries.
+    """
+    def __init__(self, engine, refresh_interval=60):
+        self.engine = engine
+        self._tables = CachedValue(self.load_tables, refresh_interval,
+                                   default=[])
+        self._row_estimates = CachedValue(self.load_row_estimates,
+                                          refresh_interval, default={})
+        self._schema_version = CachedValue(self.load_schema_version,
+                                           refresh_interval)
+
+    def load_tables(self):
+        return inspect(self.engine).get_table_names()
+
+    def load_row_estimates(self):
+        with self.engine.connect() as connection:
+            return {row.table_name: row.estimated_row_count
+                    for row in connection.execute(_ROW_ESTIMATES)}
+
+    def load_schema_version(self):
+        with self.engine.connect() as connection:
+            return connection.execute(_SCHEMA_VERSION).scalar()
+
+    def tables(self):
+        """Returns the (cached) list of tables in the database."""
+        return self._tables.get()
+
+    def row_estimates(self):
+        """Returns the (cached) {table: estimated row count} statistics."""
+        return self._row_estimates.get()
+
+    def schema_version(self):
+        """Returns the (cached) newest applied migration, or None."""
+        return self._schema_version.get()
+
+    def cache_ages(self):
+        """Seconds since each cached value was refreshed."""
+        return {'tables': self._tables.age(),
+                'row_estimates': self._row_estimates.age(),
+                'schema_version': self._schema_version.age()}
+
+
+def measure_round_trip(engine):
+    """
+    Times a `SELECT 1`, including the pool checkout.
+
+    Returns:
+        {tuple} -- (milliseconds, None), or (None, error text) if it failed.
+    """
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1")).scalar()
+    except Exception as error:
+        return None, str(error)
+    return (time.perf_counter() - start) * 1000, None
+
+
+def pool_status(engine, capacity):
+    """
+    Returns:
+        {dict} -- Connections checked out, idle and in overflow, and the
+            share of `capacity` (pool_size + max_overflow) in use.
+    """
+    pool = engine.pool
+    checked_out = pool.checkedout()
+    return {'size': pool.size(), 'checked_out': checked_out,
+            'idle': pool.checkedin(), 'overflow': max(pool.overflow(), 0),
+            'capacity': capacity,
+            'utilization': checked_out / capacity if capacity else None}
@@ -1,11 +1,11 @@
 """
-Aligns sqlalchemy's schema for the "vehicles" table with the database.
+Aligns sqlalchemy's schema for the MovR tables with the database.
 """
 
-from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Integer,
-                        PrimaryKeyConstraint, String)
+from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Index,
+                        Integer, PrimaryKeyConstraint, String)
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql.expression import func
 
 Base = declarative_base()
@@ -53,9 +53,74 @@ class LocationHistory(Base):
     ts = Column(DateTime, default=func.now)
     longitude = Column(Float)
     latitude = Column(Float)
+    # What wrote the row: 'add_vehicle', 'start_ride' or 'end_ride'. NULL for
+    # rows written before the column existed.
+    event = Column(String)
     PrimaryKeyConstraint(id)
+    # Every read filters on vehicle_id and wants the newest rows first. The
+    # index also STOREs longitude, latitude and event (see dbinit.sql and
+    # migrations/0004), which SQLAlchemy 1.3 can't express.
+    Index('location_history_vehicle_id_ts_idx', vehicle_id, ts.desc())
+    # util/ride_statistics.py reads the whole table oldest-first, in this
+    # order (migrations/0005).
+    Index('location_history_vehicle_id_ts_id_idx', vehicle_id, ts, id)
     def __repr__(self):
         return (("<Vehicle(id='{0}', vehicle_id='{1}', ts='{2}', "
-                 "longitude='{3}', latitude='{4}')>"
+                 "longitude='{3}', latitude='{4}', event='{5}')>"
                  ).format(self.id, self.vehicle_id, self.ts, self.longitude,
-                          self.latitude))
+                          self.latitude, self.event))
+
+
+class CurrentLocation(Base):
+    """
+    Projection of the most recent location_history row for each vehicle.
+
+    Written in the same transaction as every location_history insert, so
+    reads can look up one row per vehicle instead of aggregating the whole
+    history.
+
+    Arguments:
+        Base {DeclarativeMeta} -- Base class for declarative SQLAlchemy class
+                that produces appropriate `sqlalchemy.schema.Table` objects.
+    """
+    __tablename__ = 'current_locations'
+    vehicle_id = Column(UUID, ForeignKey('vehicles.id', ondelete='CASCADE'))
+    ts = Column(DateTime, nullable=False)
+    longitude = Column(Float, nullable=False)
+    latitude = Column(Float, nullable=False)
+    # Geohash of (longitude, latitude) at `GEOHASH_PRECISION`; indexed so
+    # nearby-vehicle searches can scan a few cells instead of the table.
+    geohash = Column(String)
+    PrimaryKeyConstraint(vehicle_id)
+
+    def __repr__(self):
+        return (("<CurrentLocation(vehicle_id='{0}', ts='{1}', "
+                 "longitude='{2}', latitude='{3}', geohash='{4}')>"
+                 ).format(self.vehicle_id, self.ts, self.longitude,
+                          self.latitude, self.geohash))
+
+
+class RideSummary(Base):
+    """
+    Per-ride trip statistics, rebuilt from location_history by
+        `util/ride_statistics.py`.
+
+    Arguments:
+        Base {DeclarativeMeta} -- Base class for declarative SQLAlchemy class
+                that produces appropriate `sqlalchemy.schema.Table` objects.
+    """
+    __tablename__ = 'ride_summaries'
+    vehicle_id = Column(UUID, ForeignKey('vehicles.id', ondelete='CASCADE'))
+    start_ts = Column(DateTime)
+    end_ts = Column(DateTime, nullable=False)
+    distance_km = Column(Float, nullable=False)
+    duration_minutes = Column(Float, nullable=False)
+    average_speed_kmh = Column(Float)  # NULL for zero-length rides.
+    points = Column(Integer, nullable=False)
+    PrimaryKeyConstraint(vehicle_id, start_ts)
+
+    def __repr__(self):
+        return (("<RideSummary(vehicle_id='{0}', start_ts='{1}', "
+                 "end_ts='{2}', distance_km='{3}')>"
+                 ).format(self.vehicle_id, self.start_ts, self.end_ts,
+                          self.distance_km))
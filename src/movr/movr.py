@@ -1,34 +1,324 @@
 """
 Defines the connection to the database for the MovR app.
 """
-from cockroachdb.sqlalchemy import run_transaction
-from sqlalchemy import create_engine
-from sqlalchemy.dialects import registry
+import os
+import re
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy_cockroachdb import run_transaction
+
+from movr.metadata import (ClusterMetadata, measure_round_trip,
+                           pool_status)
+from movr.transactions import (add_vehicle_txn, end_ride_txn,
+                               find_nearby_vehicles_txn,
+                               get_location_history_txn, get_vehicle_txn,
+                               get_vehicles_txn, record_locations_txn,
+                               remove_vehicle_txn, start_ride_txn,
+                               get_vehicle_and_location_history_txn,
+                               vehicle_from_row, vehicles_query)
+from util.calculations import simplify_path
+
+def statement_timeout_listener(timeout_ms):
+    """
+    Builds a `connect` event listener that sets `statement_timeout`.
+
+    Arguments:
+        timeout_ms {int} -- Timeout in milliseconds.
+    """
+    statement = "SET statement_timeout = {:d}".format(int(timeout_ms))
+
+    def set_statement_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(statement)
+        cursor.close()
+        dbapi_connection.commit()
+
+    return set_statement_timeout
+
+
+# SQLSTATE CockroachDB uses to ask the client to retry the transaction.
+RETRY_SQLSTATE = '40001'
+
+# Most points `get_location_history` returns before asking for a coarser
+# resolution or a shorter window.
+MAX_HISTORY_POINTS = 10000
+
+# A negative interval such as '-10s' or '-1.5m'.
+_STALENESS_INTERVAL = re.compile(r'^-\d+(\.\d+)?(us|ms|s|m|h)$')
+
+
+def as_of_system_time(staleness):
+    """
+    Translates a staleness mode into an `AS OF SYSTEM TIME` expression.
+
+    Arguments:
+        staleness {String} -- One of:
+            None or 'strong': read the latest data (returns None).
+            'follower': `follower_read_timestamp()`, the most recent time any
+                replica can serve, so reads avoid the leaseholder.
+            an interval such as '-5s': read as of that long ago.
+    """
+    if staleness in (None, 'strong'):
+        return None
+    if staleness == 'follower':
+        return 'follower_read_timestamp()'
+    if _STALENESS_INTERVAL.match(staleness):
+        return "'{}'".format(staleness)
+    raise ValueError(("Unknown staleness `{}`. Use 'strong', 'follower' or a "
+                      "negative interval such as '-5s'.").format(staleness))
+
+
+def set_transaction_statement(staleness=None):
+    """
+    Builds the statement that opens a read-only transaction.
+
+    Arguments:
+        staleness {String} -- See `as_of_system_time`.
+
+    Returns:
+        {TextClause} -- `SET TRANSACTION READ ONLY`, plus
+            `AS OF SYSTEM TIME ...` for a stale read.
+    """
+    as_of = as_of_system_time(staleness)
+    if as_of is None:
+        return text("SET TRANSACTION READ ONLY")
+    return text("SET TRANSACTION READ ONLY, AS OF SYSTEM TIME {}".format(
+        as_of))
 
-from movr.transactions import (add_vehicle_txn, end_ride_txn, get_vehicle_txn,
-                               get_vehicles_txn, remove_vehicle_txn,
-                               start_ride_txn,
-                               get_vehicle_and_location_history_txn)
 
-registry.register("cockroachdb", "cockroachdb.sqlalchemy.dialect",
-                  "CockroachDBDialect")
+def is_retryable(error):
+    """
+    Checks if a DBAPIError is CockroachDB asking for the transaction to be
+        retried. psycopg2 reports the SQLSTATE as `pgcode`, asyncpg as
+        `sqlstate`.
+    """
+    sqlstate = (getattr(error.orig, 'pgcode', None)
+                or getattr(error.orig, 'sqlstate', None))
+    return sqlstate == RETRY_SQLSTATE
+
+
+def run_read_only_transaction(session_factory, callback, staleness=None,
+                              max_retries=10):
+    """
+    Runs `callback(session)` in a `READ ONLY` transaction, optionally as of a
+        past system time.
+
+    Unlike `run_transaction`, this doesn't open a `cockroach_restart`
+        savepoint, because `SET TRANSACTION` has to be the transaction's first
+        statement. Retryable errors (rare for read-only transactions, and not
+        expected for historical ones) restart the whole transaction instead.
+
+    Arguments:
+        session_factory {sessionmaker} -- Builds the session.
+        callback {function} -- The read-only `*_txn` function to run.
+        staleness {String} -- See `as_of_system_time`.
+        max_retries {int} -- Attempts before giving up on retryable errors.
+    """
+    set_transaction = set_transaction_statement(staleness)
+
+    for retries in range(max_retries + 1):
+        session = session_factory()
+        try:
+            session.execute(set_transaction)
+            result = callback(session)
+            session.commit()
+            return result
+        except DBAPIError as error:
+            session.rollback()
+            if not is_retryable(error) or retries == max_retries:
+                raise
+            time.sleep(0.01 * 2 ** retries)
+        finally:
+            session.close()
+
+
+def resolution_seconds(resolution):
+    """
+    Accepts a bucket width as a timedelta or a number of seconds.
+
+    Returns:
+        {float} -- Seconds, or None for raw points.
+    """
+    if resolution is None:
+        return None
+    if isinstance(resolution, timedelta):
+        resolution = resolution.total_seconds()
+    if resolution <= 0:
+        raise ValueError("The resolution must be positive.")
+    return float(resolution)
+
+
+def location_history_points(rows, tolerance_km=None, max_points=None):
+    """
+    Turns `get_location_history_txn` rows into dictionaries, dropping the
+        points a `tolerance_km` Douglas-Peucker simplification doesn't need.
+
+    Raises a ValueError if there are more than `max_points` rows (fetch one
+        more than that to find out).
+    """
+    if max_points is not None and len(rows) > max_points:
+        raise ValueError("The window has more than {} points; use a coarser "
+                         "resolution or a shorter window.".format(max_points))
+    if tolerance_km and len(rows) > 2:
+        keep = simplify_path([row[1] for row in rows],
+                             [row[2] for row in rows], tolerance_km)
+        rows = [rows[index] for index in keep]
+    return [{'ts': ts, 'longitude': longitude, 'latitude': latitude,
+             'points': points} for ts, longitude, latitude, points in rows]
+
+
+def location_history_reader(vehicle_id, start=None, end=None,
+                            resolution=None, max_points=MAX_HISTORY_POINTS):
+    """
+    Checks `get_location_history`'s arguments, and builds its read for
+        `MovR` and `AsyncMovR` alike.
+
+    Returns:
+        {function} -- Reads the rows for `location_history_points` from a
+            session: one more than `max_points`, so a window with too many
+            can be told apart, or all of them if `max_points` is None.
+    """
+    seconds = resolution_seconds(resolution)
+    limit = None if max_points is None else max_points + 1
+    return lambda session: get_location_history_txn(
+        session, vehicle_id, start, end, seconds, limit=limit)
 
 
 class MovR:
     """
     Wraps the database connection. The class methods wrap transactions.
     """
-    def __init__(self, conn_string, max_records=20):
+    def __init__(self, conn_string, max_records=20, pool_size=5,
+                 max_overflow=10, pool_pre_ping=False, pool_recycle=-1,
+                 statement_timeout=None, cache=None, staleness=None,
+                 instrumentation=None, metadata_refresh=60):
         """
-        Establish a connection to the database, creating an Engine instance.
+        Configures the connection to the database.
+
+        The engine (with its connection pool) and the sessionmaker are built
+            on first use, once per process, and shared by every transaction
+            in that process. Nothing connects here, so a server can build
+            MovR before forking its workers, and each worker opens its own
+            connections.
 
         Arguments:
             conn_string {String} -- CockroachDB connection string.
+            max_records {int} -- Default page size for listings.
+            pool_size {int} -- Connections kept open in the pool.
+            max_overflow {int} -- Connections allowed beyond `pool_size`.
+            pool_pre_ping {bool} -- Test connections before handing them out.
+            pool_recycle {int} -- Seconds before a connection is replaced
+                (-1 never replaces them).
+            statement_timeout {int} -- Per-statement timeout, in milliseconds,
+                set on every new connection (None keeps the server default).
+            cache {VehicleCache} -- Optional read-through cache for
+                `get_vehicle` and `get_vehicles`; invalidated by the writes.
+            staleness {String} -- Default staleness for the read-only
+                methods: 'strong' (None), 'follower', or an interval such as
+                '-5s'. See `as_of_system_time`.
+            instrumentation {Instrumentation} -- Optional per-transaction
+                metrics; see movr/instrumentation.py.
+            metadata_refresh {float} -- Seconds between catalog lookups for
+                `show_tables` and `status`; see movr/metadata.py.
         """
-        self.engine = create_engine(conn_string, convert_unicode=True)
+        as_of_system_time(staleness)  # Fail fast on a bad mode.
         self.connection_string = conn_string
         self.max_records = max_records
+        self.cache = cache
+        self.staleness = staleness
+        self.instrumentation = instrumentation
+        self.pool_capacity = pool_size + max(max_overflow, 0)
+        self.metadata_refresh = metadata_refresh
+        self._engine_options = {'pool_size': pool_size,
+                                'max_overflow': max_overflow,
+                                'pool_pre_ping': pool_pre_ping,
+                                'pool_recycle': pool_recycle}
+        self._statement_timeout = statement_timeout
+        self._engine_lock = threading.Lock()
+        self._pid = None
+        self._engine = None
+        self._inherited_engine = None
+        self._sessionmaker = None
+        self._metadata = None
+
+    def _connect(self):
+        """
+        Builds this process's engine, sessionmaker and metadata cache.
+
+        An engine inherited through `fork` is kept, not disposed: its pooled
+            connections belong to the parent, and closing them here would
+            close them for the parent too.
+        """
+        self._inherited_engine = self._engine
+        engine = create_engine(self.connection_string, **self._engine_options)
+        if self._statement_timeout is not None:
+            event.listen(engine, 'connect',
+                         statement_timeout_listener(self._statement_timeout))
+        if self.instrumentation is not None:
+            self.instrumentation.instrument(engine)
+        self._engine = engine
+        self._sessionmaker = sessionmaker(bind=engine)
+        self._metadata = ClusterMetadata(engine, self.metadata_refresh)
+        self._pid = os.getpid()
+
+    def _ensure_engine(self):
+        if self._pid != os.getpid():
+            with self._engine_lock:
+                if self._pid != os.getpid():
+                    self._connect()
+
+    @property
+    def engine(self):
+        """This process's engine, built on first use."""
+        self._ensure_engine()
+        return self._engine
+
+    @property
+    def sessionmaker(self):
+        """This process's sessionmaker, bound to `engine`."""
+        self._ensure_engine()
+        return self._sessionmaker
+
+    @property
+    def metadata(self):
+        """This process's catalog cache; see movr/metadata.py."""
+        self._ensure_engine()
+        return self._metadata
+
+    def _track(self, name):
+        """Records the enclosed transaction's metrics under `name`."""
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.track(name)
+
+    def _run(self, name, callback):
+        """
+        Runs `callback` with `run_transaction`, recording it as `name`.
+        """
+        with self._track(name):
+            return run_transaction(self.sessionmaker, callback)
+
+    def _read(self, name, callback, staleness):
+        """
+        Runs a read-only transaction at `staleness`, or at the default
+            staleness if that's None, recording it as `name`.
+        """
+        if staleness is None:
+            staleness = self.staleness
+        with self._track(name):
+            return run_read_only_transaction(self.sessionmaker, callback,
+                                             staleness=staleness)
+
+    def _invalidate(self, vehicle_id):
+        """Drops cached entries a write to `vehicle_id` made stale."""
+        if self.cache is not None:
+            self.cache.invalidate(vehicle_id)
 
     def start_ride(self, vehicle_id):
         """
@@ -37,9 +327,11 @@ class MovR:
         Arguments:
             vehicle_id {UUID} -- The vehicle's unique ID.
         """
-        return run_transaction(
-            sessionmaker(bind=self.engine),
+        started = self._run(
+            'start_ride_txn',
             lambda session: start_ride_txn(session, vehicle_id))
+        self._invalidate(vehicle_id)
+        return started
 
     def end_ride(self, vehicle_id, new_longitude, new_latitude, new_battery):
         """
@@ -54,12 +346,16 @@ class MovR:
             new_battery {int} -- Vehicle's new battery reading
 
         Returns:
-            {datetime} -- Timestamp of the end of the ride from the server.
+            {dict} or {False} -- The vehicle's state at the end of the ride,
+                including the server's timestamp, or False if the ride
+                couldn't be ended.
         """
-        return run_transaction(
-            sessionmaker(bind=self.engine),
+        vehicle_at_end = self._run(
+            'end_ride_txn',
             lambda session: end_ride_txn(session, vehicle_id, new_longitude,
                                          new_latitude, new_battery))
+        self._invalidate(vehicle_id)
+        return vehicle_at_end
 
     def remove_vehicle(self, vehicle_id):
         """
@@ -68,9 +364,11 @@ class MovR:
         Arguments:
             id {UUID} -- The vehicle's unique ID.
         """
-        return run_transaction(
-            sessionmaker(bind=self.engine),
+        deleted = self._run(
+            'remove_vehicle_txn',
             lambda session: remove_vehicle_txn(session, vehicle_id))
+        self._invalidate(vehicle_id)
+        return deleted
 
     def add_vehicle(self, vehicle_type, longitude, latitude, battery):
         """
@@ -78,37 +376,172 @@ class MovR:
 
         Arguments:
             vehicle_type {String} -- The type of vehicle.
+
+        Returns:
+            {dict} -- {'vehicle_id': <UUID>, 'vehicle': <dict>}, with the new
+                vehicle's state as written.
+        """
+        new_info = self._run('add_vehicle_txn',
+                             lambda session: add_vehicle_txn(
+                                 session, vehicle_type, longitude, latitude,
+                                 battery))
+        self._invalidate(new_info['vehicle_id'])
+        return new_info
+
+    def record_locations(self, locations, rows_per_transaction=1000):
+        """
+        Writes a batch of location pings with multi-row INSERTs.
+
+        Arguments:
+            locations {list} -- Dictionaries with `vehicle_id`, `longitude`,
+                `latitude` and `ts` (a naive UTC datetime) keys.
+            rows_per_transaction {int} -- Larger batches are split into
+                transactions of at most this many pings.
+
+        Returns:
+            {tuple} -- (written, rejected): pings inserted, and pings
+                dropped because their vehicle doesn't exist.
         """
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: add_vehicle_txn(session,
-                                                               vehicle_type,
-                                                               longitude,
-                                                               latitude,
-                                                               battery))
+        written = rejected = 0
+        for start in range(0, len(locations), rows_per_transaction):
+            chunk = locations[start:start + rows_per_transaction]
+            chunk_written, chunk_rejected = self._run(
+                'record_locations_txn',
+                lambda session: record_locations_txn(session, chunk))
+            written += chunk_written
+            rejected += chunk_rejected
+        if self.cache is not None and locations:
+            self.cache.invalidate_many({str(location['vehicle_id'])
+                                        for location in locations})
+        return written, rejected
 
-    def get_vehicles(self, max_vehicles=None):
+    def get_vehicles(self, max_vehicles=None, after_id=None, before_id=None,
+                     staleness=None):
         """
-        Wraps a `run_transaction` call that gets all vehicle.
+        Wraps a read-only transaction that gets one page of vehicles.
+
+        Arguments:
+            max_vehicles {int} -- Page size; defaults to `max_records`.
+            after_id {UUID} -- Cursor: return the page after this vehicle.
+            before_id {UUID} -- Cursor: return the page before this vehicle.
+            staleness {String} -- Overrides the default staleness.
 
         Returns:
-            A list of dictionaries containing vehicle data.
+            (vehicles, next_id, prev_id): A list of dictionaries containing
+                vehicle data, and the cursors for the next and previous
+                pages (None when there's no such page).
         """
         if max_vehicles is None:
             max_vehicles = self.max_records
 
-        return run_transaction(
-            sessionmaker(bind=self.engine),
-            lambda session: get_vehicles_txn(session, max_vehicles))
+        def load():
+            return self._read(
+                'get_vehicles_txn',
+                lambda session: get_vehicles_txn(session, max_vehicles,
+                                                 after_id=after_id,
+                                                 before_id=before_id),
+                staleness)
+
+        if self.cache is None:
+            return load()
+        return self.cache.listing(max_vehicles, after_id, before_id, load)
 
-    def get_vehicle(self, vehicle_id):
+    def iter_vehicles(self, after_id=None, limit=None, staleness=None,
+                      chunk_size=500):
+        """
+        Streams vehicles in id order from a server-side cursor, for exports
+            and streamed API responses.
+
+        The read-only transaction stays open until the generator is
+            exhausted or closed. Unlike the other reads it isn't retried,
+            since rows may already have been sent.
+
+        Only database work is timed, so a slow consumer doesn't show up as
+            a slow transaction: connecting and running the query (up to the
+            first chunk) is recorded as `iter_vehicles`, and each later
+            chunk as `iter_vehicles_fetch`.
+
+        Arguments:
+            after_id {UUID} -- Start after this vehicle; None for the first.
+            limit {int} -- Most vehicles to yield; None for all of them.
+            staleness {String} -- Overrides the default staleness.
+            chunk_size {int} -- Rows fetched from the cursor at a time.
+
+        Yields:
+            {dict} -- The same vehicle dictionaries as `get_vehicles`.
+        """
+        if staleness is None:
+            staleness = self.staleness
+        with self._track('iter_vehicles'):
+            connection = self.engine.connect()
+            try:
+                connection.begin()
+                connection.execute(set_transaction_statement(staleness))
+                result = connection.execution_options(
+                    stream_results=True).execute(
+                        vehicles_query(after_id, limit))
+                rows = result.fetchmany(chunk_size)
+            except Exception:
+                connection.close()
+                raise
+        # Closing the connection ends the read-only transaction.
+        try:
+            while rows:
+                for row in rows:
+                    yield vehicle_from_row(row)
+                with self._track('iter_vehicles_fetch'):
+                    rows = result.fetchmany(chunk_size)
+        finally:
+            connection.close()
+
+    def find_nearby_vehicles(self, longitude, latitude, radius_km,
+                             limit=None, available_only=True,
+                             staleness=None):
+        """
+        Wraps a read-only transaction that finds the vehicles nearest a point.
+
+        Arguments:
+            longitude {float} -- Longitude of the search center.
+            latitude {float} -- Latitude of the search center.
+            radius_km {float} -- Search radius, in kilometers.
+            limit {int} -- Maximum vehicles returned; defaults to
+                `max_records`.
+            available_only {bool} -- Skip vehicles that are in use.
+            staleness {String} -- Overrides the default staleness.
+
+        Returns:
+            {list} -- Vehicle dictionaries with a `distance_km` key, nearest
+                first.
+        """
+        if limit is None:
+            limit = self.max_records
+        return self._read(
+            'find_nearby_vehicles_txn',
+            lambda session: find_nearby_vehicles_txn(
+                session, longitude, latitude, radius_km, limit,
+                available_only=available_only),
+            staleness)
+
+    def get_vehicle(self, vehicle_id, staleness=None):
         """
         Get a single vehicle from its id.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+            staleness {String} -- Overrides the default staleness.
         """
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: get_vehicle_txn(session,
-                                                               vehicle_id))
+        def load():
+            return self._read('get_vehicle_txn',
+                              lambda session: get_vehicle_txn(session,
+                                                              vehicle_id),
+                              staleness)
 
-    def get_vehicle_and_location_history(self, vehicle_id, max_locations=None):
+        if self.cache is None:
+            return load()
+        return self.cache.vehicle(vehicle_id, load)
+
+    def get_vehicle_and_location_history(self, vehicle_id, max_locations=None,
+                                         staleness=None):
         """
         Gets vehicle info AND recent locations.
 
@@ -117,6 +550,7 @@ class MovR:
 
         vehicle_id (str(uuid)): ID of the vehicle we want
         max_locations (int): Number of points in location_history to show
+        staleness (str): Overrides the default staleness.
 
         Returns
         -------
@@ -126,18 +560,78 @@ class MovR:
           vehicle: dictionary representation of the row of the vehicles table
           location_history: list of dictionaries, each representing a row in
               location_history, ordered by timestamp starting at most recent.
+
+        (None, []) if the vehicle isn't in the database.
         """
         if max_locations is None:
             max_locations = self.max_records
 
-        return run_transaction(
-            sessionmaker(bind=self.engine),
+        return self._read(
+            'get_vehicle_and_location_history_txn',
             lambda session: get_vehicle_and_location_history_txn(
-                session, vehicle_id, max_locations))
+                session, vehicle_id, max_locations),
+            staleness)
+
+    def get_location_history(self, vehicle_id, start=None, end=None,
+                             resolution=None, tolerance_km=None,
+                             staleness=None, max_points=MAX_HISTORY_POINTS):
+        """
+        Gets a vehicle's path over a time window, e.g. the last 7 days at
+            1-minute resolution.
+
+        Arguments:
+            vehicle_id {UUID} -- The vehicle's unique ID.
+            start {DateTime} -- Start of the window (naive UTC, inclusive);
+                None for the beginning of the history.
+            end {DateTime} -- End of the window (exclusive); None for now.
+            resolution {timedelta} -- Average the points in buckets this wide
+                (in the database); also accepts seconds. None returns raw
+                points.
+            tolerance_km {float} -- Simplify the path (Douglas-Peucker) to
+                within this many kilometers; None keeps every point.
+            staleness {String} -- Overrides the default staleness.
+            max_points {int} -- Most points (buckets, before simplifying)
+                read; a window with more raises a ValueError. None reads
+                every point.
+
+        Returns:
+            {list} -- Dictionaries with `ts`, `longitude`, `latitude` and
+                `points` (readings averaged), oldest first.
+        """
+        rows = self._read('get_location_history_txn',
+                          location_history_reader(vehicle_id, start, end,
+                                                  resolution, max_points),
+                          staleness)
+        return location_history_points(rows, tolerance_km, max_points)
 
     def show_tables(self):
         """
         Returns:
-            List -- A list of tables in the database it's connected to.
+            List -- A list of tables in the database it's connected to,
+                refreshed at most every `metadata_refresh` seconds.
+        """
+        return self.metadata.tables()
+
+    def status(self):
+        """
+        Checks the database, for /serverstatus.
+
+        The round trip is measured on every call; the schema version, table
+            list and row-count estimates come from the metadata cache.
+
+        Returns:
+            {dict} -- `reachable`, `latency_ms` (and `error` if the round
+                trip failed), `pool`, `schema_version`, `tables`,
+                `row_estimates` and `metadata_age_seconds`.
         """
-        return self.engine.table_names()
+        latency_ms, error = measure_round_trip(self.engine)
+        estimates = self.metadata.row_estimates()
+        tables = self.metadata.tables()
+        return {'reachable': error is None, 'latency_ms': latency_ms,
+                'error': error,
+                'pool': pool_status(self.engine, self.pool_capacity),
+                'schema_version': self.metadata.schema_version(),
+                'tables': tables,
+                'row_estimates': {table: estimates.get(table)
+                                  for table in tables},
+                'metadata_age_seconds': self.metadata.cache_ages()}
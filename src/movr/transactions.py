@@ -4,58 +4,269 @@ Defines the transactions that are performed by movr.
 This is where the python code meets the database.
 """
 
+import math
 from uuid import uuid4
 
+import numpy as np
+from sqlalchemy import (BigInteger, Float, cast, exists, extract, literal, or_,
+                        select, true)
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql.expression import func
 
-from movr.models import LocationHistory, Vehicle
+from movr.models import CurrentLocation, LocationHistory, Vehicle
+from util.calculations import EARTH_RADIUS_KM, haversine_km
+from util.geohash import covering_cells, encode
 
 
-def start_ride_txn(session, vehicle_id):
+def upsert_current_location_txn(session, vehicle_id, longitude, latitude,
+                                ts):
     """
-    Start a vehicle ride (or continue if the vehicle is already in use).
+    Point a vehicle's current_locations row at its newest check-in.
+
+    Must run in the same transaction as the matching location_history insert
+    so the projection never disagrees with the history.
+
+    # INSERT INTO current_locations (vehicle_id, ts, longitude, latitude,
+    #                                geohash)
+    #      VALUES (<vehicle_id>, <ts>, <longitude>, <latitude>, <geohash>)
+    # ON CONFLICT (vehicle_id) DO UPDATE
+    #         SET ts = excluded.ts, longitude = excluded.longitude,
+    #             latitude = excluded.latitude, geohash = excluded.geohash;
 
     Arguments:
         session {.Session} -- The active session for the database connection.
         vehicle_id {String} -- The vehicle's `id` column.
+        longitude {Float} -- Longitude of the check-in.
+        latitude {Float} -- Latitude of the check-in.
+        ts {DateTime} -- Timestamp of the check-in (may be `func.now()`).
     """
-    # find the row where we want to start the ride.
-    # SELECT * FROM vehicles WHERE id = <vehicle_id> AND in_use = false
-    #         LIMIT 1;
-    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id). \
-                                     filter(Vehicle.in_use == False).first()
+    statement = insert(CurrentLocation.__table__).values(
+        vehicle_id=vehicle_id, ts=ts, longitude=longitude, latitude=latitude,
+        geohash=encode(float(longitude), float(latitude)))
+    statement = statement.on_conflict_do_update(
+        index_elements=[CurrentLocation.vehicle_id],
+        set_={'ts': statement.excluded.ts,
+              'longitude': statement.excluded.longitude,
+              'latitude': statement.excluded.latitude,
+              'geohash': statement.excluded.geohash})
+    session.execute(statement)
+
+
+def record_check_in_txn(session, vehicle_id, longitude, latitude, event):
+    """
+    Insert a location_history row stamped now(), and update the projection.
 
-    if vehicle is None:
-        return None
+    # INSERT INTO location_history (id, vehicle_id, ts, longitude, latitude,
+    #                               event)
+    #      VALUES (<uuid>, <vehicle_id>, now(), <longitude>, <latitude>,
+    #              <event>)
+    #   RETURNING ts;
 
-    # SELECT * FROM location_history WHERE vehicle_id = <vehicle_id>
-    #      ORDER BY ts DESC LIMIT 1;
-    last_chx = session.query(LocationHistory). \
-                       filter(LocationHistory.vehicle_id ==
-                              vehicle_id). \
-                       order_by(LocationHistory.ts.desc()). \
-                       first()
-    new_id = str(uuid4())
-    new_timestamp = func.now()
-    new_location_history_row = LocationHistory(id=new_id,
-                                               vehicle_id=vehicle_id,
-                                               longitude=last_chx.longitude,
-                                               latitude=last_chx.latitude,
-                                               ts=new_timestamp)
-
-    # UPDATE vehicles SET in_use = true WHERE vehicles.id = <vehicle_id>
-    vehicle.in_use = True
-    vehicle.last_checkin = func.now()
-    session.add(new_location_history_row)
-
-    return True  # Just making it explicit that this worked.
+    Arguments:
+        session {.Session} -- The active session for the database connection.
+        vehicle_id {String} -- The vehicle's `id` column.
+        longitude {Float} -- Longitude of the check-in.
+        latitude {Float} -- Latitude of the check-in.
+        event {String} -- What caused the check-in ('add_vehicle',
+            'start_ride' or 'end_ride'); lets rides be rebuilt from history.
+
+    Returns:
+        {DateTime} -- The check-in's timestamp, as written by the server.
+    """
+    location_history = LocationHistory.__table__
+    new_timestamp = session.execute(
+        location_history.insert().
+        values(id=str(uuid4()), vehicle_id=vehicle_id, ts=func.now(),
+               longitude=longitude, latitude=latitude, event=event).
+        returning(location_history.c.ts)).scalar()
+    upsert_current_location_txn(session, vehicle_id, longitude, latitude,
+                                new_timestamp)
+    return new_timestamp
+
+
+def record_locations_txn(session, locations):
+    """
+    Insert a batch of location pings, and move each vehicle's projection to
+    its newest one.
+
+    # SELECT id FROM vehicles WHERE id IN (<vehicle ids>);
+    #
+    # INSERT INTO location_history (id, vehicle_id, ts, longitude, latitude,
+    #                               event)
+    #      VALUES (<uuid>, <vehicle_id>, <ts>, <longitude>, <latitude>,
+    #              'ping'),
+    #             ...;
+    #
+    # INSERT INTO current_locations (vehicle_id, ts, longitude, latitude,
+    #                                geohash)
+    #      VALUES (<newest ping per vehicle>), ...
+    # ON CONFLICT (vehicle_id) DO UPDATE
+    #         SET ts = excluded.ts, ...
+    #       WHERE current_locations.ts < excluded.ts;
+
+    Pings can arrive late or out of order, so the projection only moves
+    forward in time. Pings from vehicles that don't exist are dropped rather
+    than failing the whole batch on the foreign key.
+
+    Arguments:
+        session {.Session} -- The active session for the database connection.
+        locations {list} -- Dictionaries with `vehicle_id`, `longitude`,
+            `latitude` and `ts` keys.
+
+    Returns:
+        {tuple} -- (written, rejected): how many pings were inserted, and how
+            many were dropped because their vehicle doesn't exist.
+    """
+    vehicles = Vehicle.__table__
+    vehicle_ids = {str(location['vehicle_id']) for location in locations}
+    known_ids = {str(row.id) for row in session.execute(
+        select(vehicles.c.id).where(vehicles.c.id.in_(vehicle_ids)))}
+    rows = [location for location in locations
+            if str(location['vehicle_id']) in known_ids]
+    if not rows:
+        return 0, len(locations)
+
+    session.execute(LocationHistory.__table__.insert().values(
+        [{'id': str(uuid4()), 'vehicle_id': str(row['vehicle_id']),
+          'ts': row['ts'], 'longitude': row['longitude'],
+          'latitude': row['latitude'], 'event': 'ping'} for row in rows]))
+
+    # ON CONFLICT can't update the same row twice in one statement.
+    newest = {}
+    for row in rows:
+        vehicle_id = str(row['vehicle_id'])
+        if vehicle_id not in newest or newest[vehicle_id]['ts'] < row['ts']:
+            newest[vehicle_id] = row
+    current_locations = CurrentLocation.__table__
+    statement = insert(current_locations).values(
+        [{'vehicle_id': vehicle_id, 'ts': row['ts'],
+          'longitude': row['longitude'], 'latitude': row['latitude'],
+          'geohash': encode(float(row['longitude']), float(row['latitude']))}
+         for vehicle_id, row in newest.items()])
+    statement = statement.on_conflict_do_update(
+        index_elements=[current_locations.c.vehicle_id],
+        set_={'ts': statement.excluded.ts,
+              'longitude': statement.excluded.longitude,
+              'latitude': statement.excluded.latitude,
+              'geohash': statement.excluded.geohash},
+        where=current_locations.c.ts < statement.excluded.ts)
+    session.execute(statement)
+
+    return len(rows), len(locations) - len(rows)
+
+
+def start_ride_txn(session, vehicle_id):
+    """
+    Start a vehicle ride, if nobody else is riding it.
+
+    One statement, so the `in_use` check and the writes can't be separated
+    by another rider's transaction, and no row is read before it's written:
+
+    # WITH started AS (
+    #          UPDATE vehicles SET in_use = true
+    #           WHERE id = <vehicle_id> AND in_use = false
+    #             AND EXISTS (SELECT * FROM location_history
+    #                          WHERE vehicle_id = <vehicle_id>)
+    #       RETURNING id),
+    #      last_seen AS (
+    #          SELECT longitude, latitude FROM location_history
+    #           WHERE vehicle_id = <vehicle_id>
+    #           ORDER BY ts DESC LIMIT 1),
+    #      checked_in AS (
+    #          INSERT INTO location_history (id, vehicle_id, ts, longitude,
+    #                                        latitude, event)
+    #               SELECT <uuid>, started.id, now(), last_seen.longitude,
+    #                      last_seen.latitude, 'start_ride'
+    #                 FROM started, last_seen
+    #            RETURNING vehicle_id, ts),
+    #      moved AS (
+    #          UPDATE current_locations SET ts = checked_in.ts
+    #            FROM checked_in
+    #           WHERE current_locations.vehicle_id = checked_in.vehicle_id
+    #       RETURNING vehicle_id)
+    # SELECT started.id, checked_in.ts
+    #   FROM started LEFT JOIN checked_in ON ... LEFT JOIN moved ON ...;
+
+    The check-in copies the newest location_history row (what
+    current_locations holds, when the vehicle has a row there), so it's
+    written even for vehicles the projection hasn't been backfilled for.
+    A vehicle with no location at all can't be started.
+
+    Arguments:
+        session {.Session} -- The active session for the database connection.
+        vehicle_id {String} -- The vehicle's `id` column.
+
+    Returns:
+        {True} or {None} -- True once the ride and its 'start_ride'
+            check-in are written; None if the vehicle doesn't exist, is
+            already in use, or has no location.
+    """
+    vehicles = Vehicle.__table__
+    location_history = LocationHistory.__table__
+    current_locations = CurrentLocation.__table__
+
+    started = vehicles.update(). \
+        where(vehicles.c.id == vehicle_id). \
+        where(vehicles.c.in_use == False). \
+        where(exists().where(location_history.c.vehicle_id == vehicle_id)). \
+        values(in_use=True).returning(vehicles.c.id).cte('started')
+    # The vehicle hasn't moved, so the check-in copies its last location.
+    last_seen = select(location_history.c.longitude,
+                       location_history.c.latitude). \
+        where(location_history.c.vehicle_id == vehicle_id). \
+        order_by(location_history.c.ts.desc()).limit(1).cte('last_seen')
+    checked_in = location_history.insert().from_select(
+        ['id', 'vehicle_id', 'ts', 'longitude', 'latitude', 'event'],
+        select(cast(literal(str(uuid4())), UUID), started.c.id, func.now(),
+               last_seen.c.longitude, last_seen.c.latitude,
+               literal('start_ride')).
+        select_from(started.join(last_seen, true()))). \
+        returning(location_history.c.vehicle_id,
+                  location_history.c.ts).cte('checked_in')
+    moved = current_locations.update(). \
+        where(current_locations.c.vehicle_id == checked_in.c.vehicle_id). \
+        values(ts=checked_in.c.ts). \
+        returning(current_locations.c.vehicle_id).cte('moved')
+
+    # Selecting from `moved` makes every CTE part of the statement.
+    row = session.execute(
+        select(started.c.id, checked_in.c.ts).select_from(
+            started.outerjoin(checked_in,
+                              checked_in.c.vehicle_id == started.c.id).
+            outerjoin(moved, moved.c.vehicle_id == started.c.id))).first()
+    if row is None or row.ts is None:
+        return None
+    return True  # The ride and its check-in are both written.
 
 
 def end_ride_txn(session, vehicle_id, new_longitude, new_latitude,
                  new_battery):
     """
-    Update a row of the rides table, and update a row of the vehicles table.
+    End a ride: update the vehicle, and check it in where the ride ended.
+
+    One statement, guarded by `in_use = true`, with no read beforehand:
+
+    # WITH ended AS (
+    #          UPDATE vehicles SET battery = <new_battery>, in_use = false
+    #           WHERE id = <vehicle_id> AND in_use = true
+    #       RETURNING id, vehicle_type),
+    #      checked_in AS (
+    #          INSERT INTO location_history (id, vehicle_id, ts, longitude,
+    #                                        latitude, event)
+    #               SELECT <uuid>, id, now(), <new_longitude>,
+    #                      <new_latitude>, 'end_ride'
+    #                 FROM ended
+    #            RETURNING vehicle_id, ts, longitude, latitude),
+    #      moved AS (
+    #          INSERT INTO current_locations (vehicle_id, ts, longitude,
+    #                                         latitude, geohash)
+    #               SELECT vehicle_id, ts, longitude, latitude, <geohash>
+    #                 FROM checked_in
+    #          ON CONFLICT (vehicle_id) DO UPDATE SET ts = excluded.ts, ...
+    #            RETURNING vehicle_id, ts)
+    # SELECT ended.id, ended.vehicle_type, moved.ts
+    #   FROM ended LEFT JOIN moved ON ...;
 
     Arguments:
         session {.Session} -- The active session for the database connection.
@@ -65,32 +276,55 @@ def end_ride_txn(session, vehicle_id, new_longitude, new_latitude,
         new_battery {Integer} -- The vehicle's battery % when the ride ended
 
     Returns:
-        {Boolean} -- True if the ride ended.
+        {dict} or {False} -- The vehicle's state as written at the end of the
+            ride (same keys as `get_vehicle_txn`), or False if the vehicle
+            wasn't found or wasn't in use.
     """
-    # find the row
-    # SELECT * FROM vehicles WHERE id = <vehicle_id> AND in_use = true;
-    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id). \
-                                     filter(Vehicle.in_use == True).first()
-
-    # Legacy update (from previous schema)
-    vehicle.last_longitude = new_longitude
-    vehicle.last_latitude = new_latitude
-    if vehicle is None:
+    vehicles = Vehicle.__table__
+    location_history = LocationHistory.__table__
+    current_locations = CurrentLocation.__table__
+    new_longitude, new_latitude = float(new_longitude), float(new_latitude)
+
+    ended = vehicles.update(). \
+        where(vehicles.c.id == vehicle_id). \
+        where(vehicles.c.in_use == True). \
+        values(battery=new_battery, in_use=False). \
+        returning(vehicles.c.id, vehicles.c.vehicle_type).cte('ended')
+    checked_in = location_history.insert().from_select(
+        ['id', 'vehicle_id', 'ts', 'longitude', 'latitude', 'event'],
+        select(cast(literal(str(uuid4())), UUID), ended.c.id, func.now(),
+               cast(literal(new_longitude), Float),
+               cast(literal(new_latitude), Float),
+               literal('end_ride'))). \
+        returning(location_history.c.vehicle_id, location_history.c.ts,
+                  location_history.c.longitude,
+                  location_history.c.latitude).cte('checked_in')
+    upsert = insert(current_locations).from_select(
+        ['vehicle_id', 'ts', 'longitude', 'latitude', 'geohash'],
+        select(checked_in.c.vehicle_id, checked_in.c.ts,
+               checked_in.c.longitude, checked_in.c.latitude,
+               literal(encode(new_longitude, new_latitude))))
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[current_locations.c.vehicle_id],
+        set_={'ts': upsert.excluded.ts,
+              'longitude': upsert.excluded.longitude,
+              'latitude': upsert.excluded.latitude,
+              'geohash': upsert.excluded.geohash})
+    moved = upsert.returning(current_locations.c.vehicle_id,
+                             current_locations.c.ts).cte('moved')
+
+    row = session.execute(
+        select(ended.c.id, ended.c.vehicle_type, moved.c.ts).
+        select_from(ended.outerjoin(
+            moved, moved.c.vehicle_id == ended.c.id))).first()
+    if row is None:
         return False
 
-    # FOR THE LAB ("Update end_ride_txn"), WORK HERE.
-    # YOU WILL NEED TO ELIMINATE THE UPDATES TO THE vehicles TABLE THAT
-    # NO LONGER APPLY, AND YOU WILL NEED TO PERFORM AN INSERT TO THE
-    # NEW location_history TABLE.
-    # HELPFUL DOC: https://docs.sqlalchemy.org/en/13/orm/session_api.html#sqlalchemy.orm.session.Session.add
-
-    # Legacy update (from previous schema)
-    vehicle.last_longitude = new_longitude
-    vehicle.last_latitude = new_latitude
-    vehicle.battery = new_battery
-    vehicle.in_use = False
-
-    return True  # Just making it explicit that this worked.
+    # Hand back what was written so callers don't have to read it again.
+    return {'id': str(row.id), 'last_longitude': new_longitude,
+            'last_latitude': new_latitude, 'last_checkin': row.ts,
+            'in_use': False, 'battery': new_battery,
+            'vehicle_type': row.vehicle_type}
 
 
 def add_vehicle_txn(session, vehicle_type, longitude, latitude, battery):
@@ -108,6 +342,9 @@ def add_vehicle_txn(session, vehicle_type, longitude, latitude, battery):
     #    INSERT INTO location_history (id, vehicle_id, ts, longitude, latitude)
     #         VALUES (<uuid>, <vehicle_id>, now(), <longitude>, <latitude>);
     #
+    #    UPSERT INTO current_locations (vehicle_id, ts, longitude, latitude)
+    #         VALUES (<vehicle_id>, now(), <longitude>, <latitude>);
+    #
     # COMMIT;
 
     Arguments:
@@ -118,29 +355,28 @@ def add_vehicle_txn(session, vehicle_type, longitude, latitude, battery):
         battery {Int} -- Battery percantage remaining.
 
     Returns:
-        {dict} -- The vehicle's new UUID and the location_history row's new
-            UUID as {'vehicle_id': <UUID>, 'location_history_id': <UUID>}
+        {dict} -- The vehicle's new UUID and its state as written, as
+            {'vehicle_id': <UUID>, 'vehicle': <dict>}. The vehicle dict has
+            the same keys as `get_vehicle_txn`'s.
     """
-    vehicle_id = uuid4()
-    current_time = func.now()
-    location_history_id = uuid4()
+    vehicle_id = str(uuid4())
 
-    new_vehicle_row = Vehicle(id=str(vehicle_id),
+    new_vehicle_row = Vehicle(id=vehicle_id,
                               in_use=False,
                               vehicle_type=vehicle_type,
                               battery=battery)
-    new_location_history_row = LocationHistory(id=str(location_history_id),
-                                               vehicle_id=str(vehicle_id),
-                                               longitude=longitude,
-                                               latitude=latitude,
-                                               ts=current_time)
 
     session.add(new_vehicle_row)
     session.flush()  # can't let the next row get inserted first.
-    session.add(new_location_history_row)
+    new_timestamp = record_check_in_txn(session, vehicle_id, longitude,
+                                        latitude, 'add_vehicle')
 
-    return {"vehicle_id": str(vehicle_id),
-            "location_history_id": str(location_history_id)}
+    return {"vehicle_id": vehicle_id,
+            "vehicle": {'id': vehicle_id,
+                        'last_longitude': float(longitude),
+                        'last_latitude': float(latitude),
+                        'last_checkin': new_timestamp, 'in_use': False,
+                        'battery': battery, 'vehicle_type': vehicle_type}}
 
 
 def remove_vehicle_txn(session, vehicle_id):
@@ -155,40 +391,73 @@ def remove_vehicle_txn(session, vehicle_id):
         {None} -- vehicle isn't found
         True {Boolean} -- vehicle is deleted
     """
-    # find the row.
-    # SELECT * FROM vehicles WHERE id = <vehicle_id> AND in_use = false;
-    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id). \
-                                     filter(Vehicle.in_use == False).first()
+    # DELETE FROM vehicles WHERE id = <vehicle_id> AND in_use = false
+    #   RETURNING id;
+    # Cascades the delete through location_history on vehicle_id automatically.
+    vehicles = Vehicle.__table__
+    deleted = session.execute(vehicles.delete().
+                              where(vehicles.c.id == vehicle_id).
+                              where(vehicles.c.in_use == False).
+                              returning(vehicles.c.id)).first()
 
-    if vehicle is None:  # Either vehicle is in use or it's been deleted
+    if deleted is None:  # Either vehicle is in use or it's been deleted
         return None
 
-    # Cascades the delete through location_history on vehicle_id automatically.
-    session.query(Vehicle).filter(Vehicle.id == vehicle_id).delete()
-
-    return True  # Should return True when vehicle is deleted.
+    return True  # The RETURNING row confirms the vehicle is deleted.
 
 
-def find_most_recent_timestamp_subquery(session):
+def vehicle_from_row(row):
     """
-    Subquery to find only the most recent location_histroy entry
+    Turns a vehicles JOIN current_locations row (`id`, `in_use`,
+    `vehicle_type`, `battery`, `longitude`, `latitude`, `ts`) into the
+    dictionary the listings return.
+    """
+    return {'id': str(row.id), 'last_longitude': row.longitude,
+            'last_latitude': row.latitude, 'last_checkin': row.ts,
+            'in_use': row.in_use, 'battery': row.battery,
+            'vehicle_type': row.vehicle_type}
+
 
-    Can join to location_history to find the most recent row for any vehicles.
+def vehicles_query(after_id=None, limit=None):
     """
-    # (SELECT vehicle_id, MAX(ts) AS max_ts FROM location_history
-    #   GROUP BY vehicle_id) AS g
-    l = LocationHistory
-    g = session.query(l.vehicle_id, func.max(l.ts).label("max_ts")). \
-                group_by(l.vehicle_id).subquery()
-    return g
+    Builds the listing query, in id order, for streaming:
 
+    SELECT v.id, v.in_use, v.vehicle_type, v.battery,
+           c.longitude, c.latitude, c.ts
+      FROM vehicles AS v
+      JOIN current_locations AS c ON c.vehicle_id = v.id
+     WHERE v.id > <after_id>
+     ORDER BY v.id
+     LIMIT <limit>;
 
-def get_vehicles_txn(session, max_records):
+    Arguments:
+        after_id {String} -- Start after this vehicle id; None for the start.
+        limit {Integer} -- Most rows to return; None for all of them.
+    """
+    vehicles = Vehicle.__table__
+    current_locations = CurrentLocation.__table__
+    query = select(vehicles.c.id, vehicles.c.in_use, vehicles.c.vehicle_type,
+                   vehicles.c.battery, current_locations.c.longitude,
+                   current_locations.c.latitude, current_locations.c.ts). \
+        where(current_locations.c.vehicle_id == vehicles.c.id). \
+        order_by(vehicles.c.id)
+    if after_id is not None:
+        query = query.where(vehicles.c.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_vehicles_txn(session, max_records, after_id=None, before_id=None):
     """
-    Select all rows of the vehicles table.
+    Select one page of rows of the vehicles table, in id order.
 
     * Updated for two-table schema (vehicles & location_history).
     * Single-table query was session.query(Vehicle).limit(max_records).all()
+    * Reads the current_locations projection instead of aggregating
+      location_history with a GROUP BY vehicle_id, MAX(ts) subquery.
+    * Pages with a keyset (the last id seen) rather than OFFSET, so every
+      page is a range scan of the primary key no matter how deep it is.
 
     Was previously
     --------------
@@ -203,62 +472,142 @@ def get_vehicles_txn(session, max_records):
         v.in_use AS in_use,
         v.vehicle_type AS vehicle_type,
         v.battery AS battery,
-        l.ts AS last_checkin,
-        l.latitude AS last_latitude,
-        l.longitude AS last_longitude
+        c.ts AS last_checkin,
+        c.latitude AS last_latitude,
+        c.longitude AS last_longitude
     FROM
         vehicles AS v
     INNER JOIN
-        location_history AS l
-            ON v.id = l.vehicle_id
-    INNER JOIN
-        (
-            SELECT
-                vehicle_id,
-                MAX(ts) AS max_ts
-            FROM
-                location_history
-            GROUP BY
-                vehicle_id
-        ) AS g
-            ON g.vehicle_id = l.vehicle_id
-            AND g.MaxTS = l.ts
+        current_locations AS c
+            ON v.id = c.vehicle_id
+    WHERE v.id > <after_id>
     ORDER BY v.id
-    LIMIT max_records;
+    LIMIT max_records + 1;
 
+    When paging backwards, the filter is `v.id < <before_id>`, the order is
+    `v.id DESC`, and the rows are reversed before they're returned.
 
     Arguments:
         session {.Session} -- The active session for the database connection.
         max_records {Integer} -- Limits the number of records returned.
+        after_id {String} -- Return the page that follows this vehicle id.
+        before_id {String} -- Return the page that precedes this vehicle id.
 
     Returns:
-        {list} -- A list of dictionaries containing vehicle information.
+        {tuple} -- (vehicles, next_id, prev_id): a list of dictionaries
+            containing vehicle information, then the cursors to pass as
+            `after_id` / `before_id` for the next and previous pages (None
+            when there's no such page).
     """
     v = aliased(Vehicle)  # vehicles AS v
-    l = aliased(LocationHistory)  # location_history as l
+    c = aliased(CurrentLocation)  # current_locations AS c
+
+    query = session.query(v.id, v.in_use, v.vehicle_type, v.battery,
+                          c.longitude, c.latitude, c.ts). \
+                    filter(c.vehicle_id == v.id)
+    if before_id is not None:
+        query = query.filter(v.id < before_id).order_by(v.id.desc())
+    else:
+        if after_id is not None:
+            query = query.filter(v.id > after_id)
+        query = query.order_by(v.id)
+
+    # Fetch one extra row to learn whether there's another page that way.
+    vehicles = query.limit(max_records + 1).all()
+    more_rows = len(vehicles) > max_records
+    vehicles = vehicles[:max_records]
+    if before_id is not None:
+        vehicles.reverse()
 
-    # (SELECT vehicle_id, MAX(g.ts) AS max_ts FROM location_history
-    g = find_most_recent_timestamp_subquery(session)
+    # Return the results in a form that will persist.
+    vehicles = [vehicle_from_row(vehicle) for vehicle in vehicles]
+    if not vehicles:
+        return vehicles, None, None
 
-    vehicles = session.query(v.id, v.in_use, v.vehicle_type, v.battery,
-                             l.longitude, l.latitude, l.ts). \
-                       filter(l.vehicle_id == v.id). \
-                       join(g). \
-                       filter(g.c.vehicle_id == l.vehicle_id). \
-                       filter(g.c.max_ts == l.ts). \
-                       order_by(v.id). \
-                       limit(max_records). \
-                       all()
+    if before_id is not None:
+        has_next, has_prev = True, more_rows
+    else:
+        has_next, has_prev = more_rows, after_id is not None
+    next_id = vehicles[-1]['id'] if has_next else None
+    prev_id = vehicles[0]['id'] if has_prev else None
+    return vehicles, next_id, prev_id
 
-    # Return the results in a form that will persist.
-    return list(map(lambda vehicle: {'id': str(vehicle.id),
-                                     'last_longitude': vehicle.longitude,
-                                     'last_latitude': vehicle.latitude,
-                                     'last_checkin': vehicle.ts,
-                                     'in_use': vehicle.in_use,
-                                     'battery': vehicle.battery,
-                                     'vehicle_type': vehicle.vehicle_type},
-                    vehicles))
+
+def find_nearby_vehicles_txn(session, longitude, latitude, radius_km,
+                             max_records, available_only=True):
+    """
+    Find the vehicles closest to a point, within `radius_km`.
+
+    Narrows the candidates with the geohash index first, then lets the
+    database drop the ones outside the radius and return only the nearest
+    `max_records`:
+
+    SELECT v.id, v.in_use, v.vehicle_type, v.battery,
+           c.longitude, c.latitude, c.ts
+      FROM vehicles AS v
+      JOIN current_locations AS c ON c.vehicle_id = v.id
+     WHERE (c.geohash LIKE '<cell 1>%' OR ... OR c.geohash LIKE '<cell 9>%')
+       AND v.in_use = false
+       AND <half chord> <= <half chord of radius_km>
+     ORDER BY <half chord>, v.id
+     LIMIT <max_records>;
+
+    The cells are the point's cell and its neighbors, at the finest geohash
+    precision that still covers the radius (see `util.geohash`). Each LIKE
+    is a prefix range scan of `current_locations_geohash_idx`. The half
+    chord is the haversine formula's inner term, which grows with distance,
+    so filtering and sorting on it needs no asin in SQL; `distance_km` is
+    then computed for the returned rows only.
+
+    Arguments:
+        session {.Session} -- The active session for the database connection.
+        longitude {Float} -- Longitude of the search center.
+        latitude {Float} -- Latitude of the search center.
+        radius_km {Float} -- Search radius, in kilometers.
+        max_records {Integer} -- Maximum number of vehicles returned.
+        available_only {Boolean} -- Skip vehicles that are in use.
+
+    Returns:
+        {list} -- Dictionaries with the same keys as `get_vehicles_txn`'s,
+            plus `distance_km`, nearest first.
+    """
+    v = aliased(Vehicle)  # vehicles AS v
+    c = aliased(CurrentLocation)  # current_locations AS c
+
+    query = session.query(v.id, v.in_use, v.vehicle_type, v.battery,
+                          c.longitude, c.latitude, c.ts). \
+                    filter(c.vehicle_id == v.id)
+    cells = covering_cells(longitude, latitude, radius_km)
+    if cells is not None:  # None: the radius covers too much to narrow.
+        query = query.filter(or_(*[c.geohash.like(cell + '%')
+                                   for cell in cells]))
+    if available_only:
+        query = query.filter(v.in_use == False)
+
+    # sin^2(dlat / 2) + cos(lat1) * cos(lat2) * sin^2(dlon / 2)
+    center_latitude = math.radians(latitude)
+    half_dlat = func.sin((func.radians(c.latitude) - center_latitude) / 2)
+    half_dlon = func.sin((func.radians(c.longitude)
+                          - math.radians(longitude)) / 2)
+    half_chord = (half_dlat * half_dlat
+                  + math.cos(center_latitude) * func.cos(
+                      func.radians(c.latitude)) * half_dlon * half_dlon)
+    max_half_chord = math.sin(
+        min(radius_km / (2 * EARTH_RADIUS_KM), math.pi / 2)) ** 2
+    nearest = query.filter(half_chord <= max_half_chord). \
+                    order_by(half_chord, v.id). \
+                    limit(max_records). \
+                    all()
+    if not nearest:
+        return []
+
+    distances = haversine_km(
+        longitude, latitude,
+        np.array([row.longitude for row in nearest], dtype=float),
+        np.array([row.latitude for row in nearest], dtype=float))
+    return [dict(vehicle_from_row(row),
+                 distance_km=round(float(distance), 3))
+            for row, distance in zip(nearest, distances)]
 
 
 def get_vehicle_txn(session, vehicle_id):
@@ -268,6 +617,7 @@ def get_vehicle_txn(session, vehicle_id):
     * Designed for two-table schema (vehicles & location_history).
     * Previous version's query was
       `session.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
+    * Looks up the vehicle's current_locations row by primary key.
 
     Arguments:
         session {.Session} -- The active session for the database connection.
@@ -278,57 +628,137 @@ def get_vehicle_txn(session, vehicle_id):
                                 queried, or None of no vehicle found.
     """
     v = aliased(Vehicle)  # vehicles AS v
-    l = aliased(LocationHistory)  # location_history as l
-    g = find_most_recent_timestamp_subquery(session)
+    c = aliased(CurrentLocation)  # current_locations AS c
 
     # SELECT columns
     vehicle = session.query(v.id, v.in_use, v.vehicle_type, v.battery,
-                            l.longitude, l.latitude, l.ts). \
-                      filter(l.vehicle_id == v.id). \
-                      filter(l.vehicle_id == vehicle_id). \
-                      join(g). \
-                      filter(g.c.vehicle_id == l.vehicle_id). \
-                      filter(g.c.max_ts == l.ts).order_by(v.id). \
+                            c.longitude, c.latitude, c.ts). \
+                      filter(c.vehicle_id == v.id). \
+                      filter(v.id == vehicle_id). \
                       first()  # LIMIT 1;
 
     # Return the row as a dictionary for flask to populate a page.
     if vehicle is None:
         return None
-
-    return {'id': str(vehicle.id), 'last_longitude': vehicle.longitude,
-            'last_latitude': vehicle.latitude,
-            'last_checkin': vehicle.ts, 'in_use': vehicle.in_use,
-            'battery': vehicle.battery,
-            'vehicle_type': vehicle.vehicle_type}
+    return vehicle_from_row(vehicle)
 
 
 def get_vehicle_and_location_history_txn(session, vehicle_id, max_locations):
     """
     Gets not just the vehicle, but its recent location history.
 
-    Locations ordered by time, starting from most recent.
+    Locations ordered by time, starting from most recent. Both come back from
+    a single statement that returns plain column tuples:
+
+    SELECT v.id, v.in_use, v.battery, v.vehicle_type,
+           l.ts, l.longitude, l.latitude
+      FROM vehicles AS v
+      LEFT JOIN LATERAL (
+                SELECT ts, longitude, latitude
+                  FROM location_history
+                 WHERE vehicle_id = v.id
+                 ORDER BY ts DESC
+                 LIMIT <max_locations>
+           ) AS l ON true
+     WHERE v.id = <vehicle_id>
+     ORDER BY l.ts DESC;
 
     Inputs
     ------
 
     vehcile_id {str(UUID)} -- vehicle identifier
     max_locations {Int} -- maximum number of location_history rows to return
-    """
-    vehicle = session.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
 
-    locations = session.query(LocationHistory). \
-                        filter(LocationHistory.vehicle_id == vehicle_id). \
-                        order_by(LocationHistory.ts.desc()). \
-                        limit(max_locations). \
-                        all()
+    Returns
+    -------
 
-    vehicle_info = {"id": vehicle.id,
+    (vehicle (dict), location_history (list(dict))), or (None, []) if the
+        vehicle isn't in the database.
+    """
+    lh = LocationHistory.__table__
+    l = select(lh.c.ts, lh.c.longitude, lh.c.latitude). \
+            where(lh.c.vehicle_id == Vehicle.id). \
+            order_by(lh.c.ts.desc()). \
+            limit(max_locations). \
+            lateral('l')
+
+    rows = session.query(Vehicle.id, Vehicle.in_use, Vehicle.battery,
+                         Vehicle.vehicle_type, l.c.ts, l.c.longitude,
+                         l.c.latitude). \
+                   outerjoin(l, true()). \
+                   filter(Vehicle.id == vehicle_id). \
+                   order_by(l.c.ts.desc()). \
+                   all()
+
+    if not rows:  # Vehicle not found.
+        return (None, [])
+
+    vehicle = rows[0]
+    vehicle_info = {"id": str(vehicle.id),
                     "in_use": vehicle.in_use,
                     "battery": vehicle.battery,
                     "vehicle_type": vehicle.vehicle_type}
 
-    location_history = list(map(
-        lambda location: {'longitude': location.longitude,
-                          'latitude': location.latitude, 'ts': location.ts},
-        locations))
+    # A vehicle with no history comes back as one row of NULL locations.
+    location_history = [{'longitude': row.longitude,
+                         'latitude': row.latitude, 'ts': row.ts}
+                        for row in rows if row.ts is not None]
     return (vehicle_info, location_history)
+
+
+def get_location_history_txn(session, vehicle_id, start=None, end=None,
+                             resolution=None, limit=None):
+    """
+    Gets a vehicle's location history between two times, oldest first,
+    optionally averaged into time buckets by the database:
+
+    SELECT max(ts) AS ts, avg(longitude) AS longitude,
+           avg(latitude) AS latitude, count(*) AS points
+      FROM location_history
+     WHERE vehicle_id = <vehicle_id> AND ts >= <start> AND ts < <end>
+     GROUP BY floor(extract(epoch FROM ts) / <resolution>)
+     ORDER BY floor(extract(epoch FROM ts) / <resolution>)
+     LIMIT <limit>;
+
+    Rows come back as plain tuples rather than ORM objects.
+
+    Inputs
+    ------
+
+    vehicle_id {str(UUID)} -- vehicle identifier
+    start, end {DateTime} -- the window, [start, end); None leaves that side
+        open
+    resolution {Float} -- bucket width in seconds, or None for raw points
+    limit {Integer} -- most rows to return; None for all of them
+
+    Returns
+    -------
+
+    list of (ts, longitude, latitude, points) tuples. `ts` is the latest
+        reading in the bucket and `points` how many readings it averages
+        (1 for raw points).
+    """
+    lh = LocationHistory.__table__
+    if resolution is None:
+        query = select(lh.c.ts, lh.c.longitude, lh.c.latitude). \
+            order_by(lh.c.ts)
+    else:
+        bucket = cast(func.floor(extract('epoch', lh.c.ts) / resolution),
+                      BigInteger).label('bucket')
+        query = select(func.max(lh.c.ts).label('ts'),
+                       func.avg(lh.c.longitude).label('longitude'),
+                       func.avg(lh.c.latitude).label('latitude'),
+                       func.count().label('points')). \
+            group_by(bucket). \
+            order_by(bucket)
+    query = query.where(lh.c.vehicle_id == vehicle_id)
+    if start is not None:
+        query = query.where(lh.c.ts >= start)
+    if end is not None:
+        query = query.where(lh.c.ts < end)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return [(row.ts, float(row.longitude), float(row.latitude),
+             1 if resolution is None else row.points)
+            for row in session.execute(query)]
@@ -3,7 +3,13 @@
 Runs the MovR web server on your local machine.
 
 Uses the .env file from the current directory to supplement
-    environment variables while running.
+    environment variables while running. Each option below falls back to
+    the setting in web/config.py, which reads the environment variable
+    named there.
+
+`./server.py run` starts Flask's single-process development server. In
+    production, serve `create_app()` with a multi-worker WSGI server; see
+    wsgi.py and gunicorn.conf.py.
 
 Usage:
     ./server.py run [options]
@@ -17,97 +23,345 @@ Options:
                                 the .env file or the DB_URL environment
                                 variable.
     --max-records <number>  Maximum number of records to query when no filter
-                                is specified [default: 20]
+                                is specified. Defaults to MAX_RECORDS, or 20.
+    --pool-size <number>    Connections kept in the pool. Defaults to the
+                                DB_POOL_SIZE environment variable, or 5.
+    --max-overflow <n>      Connections allowed beyond --pool-size. Defaults
+                                to DB_MAX_OVERFLOW, or 10.
+    --pool-pre-ping         Test pooled connections before using them. Also
+                                enabled by DB_POOL_PRE_PING=true.
+    --pool-recycle <secs>   Replace pooled connections older than this.
+                                Defaults to DB_POOL_RECYCLE, or never.
+    --statement-timeout <ms>  Per-statement timeout in milliseconds. Defaults
+                                to DB_STATEMENT_TIMEOUT, or the cluster's.
+    --staleness <mode>      Staleness of read-only queries: strong, follower
+                                (follower_read_timestamp()), or a negative
+                                interval such as -5s. Defaults to STALENESS,
+                                or strong.
+    --browse-staleness <mode>
+                            Staleness of the /vehicles listing, which can
+                                tolerate a few seconds. Defaults to
+                                BROWSE_STALENESS, or strong.
+    --cache                 Cache vehicle lookups and listings in memory.
+                                Also enabled by VEHICLE_CACHE=true.
+    --cache-ttl <secs>      Seconds a cached entry stays valid. Defaults to
+                                VEHICLE_CACHE_TTL, or 5.
+    --cache-size <number>   Maximum cached entries. Defaults to
+                                VEHICLE_CACHE_SIZE, or 10000.
+    --ingest-batch-size <n>  Location pings written per transaction. Defaults
+                                to INGEST_BATCH_SIZE, or 1000.
+    --ingest-flush-ms <ms>  Longest a buffered ping waits to be written.
+                                Defaults to INGEST_FLUSH_MS, or 200.
+    --slow-txn-ms <ms>      Log transactions slower than this many
+                                milliseconds. Defaults to SLOW_TXN_MS.
+    --fragment-cache-size <n>  Rendered vehicle cards kept in memory.
+                                Defaults to FRAGMENT_CACHE_SIZE, or 5000.
+    --metadata-refresh <secs>  Seconds between catalog lookups (table list,
+                                row estimates, schema version) for error
+                                pages and /serverstatus. Defaults to
+                                METADATA_REFRESH, or 60.
 """
 
+import atexit
+from datetime import datetime, timedelta
+from functools import partial
+from uuid import UUID
+
 from docopt import docopt
-from flask import (Flask, flash, redirect, render_template,
-                   url_for)
+from flask import (Blueprint, Flask, Response, current_app, flash, g,
+                   jsonify, redirect, render_template, request, url_for)
 from flask_bootstrap import Bootstrap, WebCDN
 from sqlalchemy.exc import IntegrityError, ProgrammingError
+from werkzeug.local import LocalProxy
 
+from movr.cache import InProcessCache, VehicleCache
+from movr.ingest import LocationBuffer, parse_timestamp
+from movr.instrumentation import Instrumentation
+from movr.metadata import measure_round_trip
 from movr.movr import MovR
 from util.calculations import generate_end_ride_messages
 from util.connect_with_sqlalchemy import (build_sqla_connection_string,
                                           test_connection)
 from util.exception_handling import render_error_page
+from web.api import api
 from web.config import Config
 from web.forms import (EndRideForm, RemoveVehicleForm, SeeVehicleForm,
                        StartRideForm, VehicleForm)
+from web.fragments import (FragmentCache, conditional_response, digest,
+                           vehicle_card_version)
+
+_DEFAULT_ROUTE = 'pages.vehicles'
+
+# The HTML pages. `create_app` registers them, with web/api.py's JSON API.
+pages = Blueprint('pages', __name__)
+
+# The current app's objects, built by `create_app`.
+movr = LocalProxy(lambda: current_app.extensions['movr'])
+instrumentation = LocalProxy(
+    lambda: current_app.extensions['movr_instrumentation'])
+fragment_cache = LocalProxy(
+    lambda: current_app.extensions['movr_fragment_cache'])
+
+# Command line options and the settings they override.
+_OPTION_SETTINGS = [
+    ('--max-records', 'MAX_RECORDS', int),
+    ('--pool-size', 'DB_POOL_SIZE', int),
+    ('--max-overflow', 'DB_MAX_OVERFLOW', int),
+    ('--pool-recycle', 'DB_POOL_RECYCLE', int),
+    ('--statement-timeout', 'DB_STATEMENT_TIMEOUT', int),
+    ('--staleness', 'STALENESS', str),
+    ('--browse-staleness', 'BROWSE_STALENESS', str),
+    ('--cache-ttl', 'VEHICLE_CACHE_TTL', float),
+    ('--cache-size', 'VEHICLE_CACHE_SIZE', int),
+    ('--ingest-batch-size', 'INGEST_BATCH_SIZE', int),
+    ('--ingest-flush-ms', 'INGEST_FLUSH_MS', int),
+    ('--slow-txn-ms', 'SLOW_TXN_MS', int),
+    ('--fragment-cache-size', 'FRAGMENT_CACHE_SIZE', int),
+    ('--metadata-refresh', 'METADATA_REFRESH', float),
+]
+
+
+def create_app(config=None):
+    """
+    Builds the MovR web app.
 
-# Initialize the web server app & load bootstrap
-app = Flask(__name__)
-Bootstrap(app)
-
-# Parse the command line options
-_opts = docopt(__doc__)
-_PORT = int(_opts['--port'])
-_URL = _opts['--url']
-_MAX_RECORDS = _opts['--max-records']
-_DEFAULT_ROUTE = 'vehicles'
-
-# Configure the app
-app.config.from_object(Config)
-
-if _URL is None:  # No --url flag; check for environment variable DB_URI
-    environment_connection_string = app.config.get('DB_URI')
-    CONNECTION_STRING = build_sqla_connection_string(
-        environment_connection_string)
-else:  # url was passed with `--url`
-    CONNECTION_STRING = build_sqla_connection_string(_URL)
-# Load environment variables from .env file
-
-# Instantiate the movr object defined in movr/movr.py
-movr = MovR(CONNECTION_STRING, max_records=_MAX_RECORDS)
-
-app.extensions['bootstrap']['cdns']['bootstrap'] = WebCDN(
-    '//getbootstrap.com/docs/4.5/dist/'
-)
+    Nothing connects to the database here: each process builds its own
+        engine and connection pool on first use (see `MovR.engine`), so a
+        WSGI server can build the app once and fork its workers from it.
+        /readyz reports whether a worker can reach the database.
 
-# Verify connection to database is working.
-# Suggest help if common errors are encountered.
-test_connection(movr.engine)
+    Arguments:
+        config {dict} -- Settings overriding web/config.py's, which come
+            from the environment and the .env file.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    settings = app.config
+
+    # Load bootstrap
+    Bootstrap(app)
+    app.extensions['bootstrap']['cdns']['bootstrap'] = WebCDN(
+        '//getbootstrap.com/docs/4.5/dist/'
+    )
+
+    if settings['VEHICLE_CACHE']:
+        vehicle_cache = VehicleCache(
+            InProcessCache(max_entries=settings['VEHICLE_CACHE_SIZE']),
+            ttl=settings['VEHICLE_CACHE_TTL'])
+    else:
+        vehicle_cache = None
+
+    # Per-transaction metrics, served at /metrics.
+    app_instrumentation = Instrumentation(
+        slow_threshold=(None if settings['SLOW_TXN_MS'] is None
+                        else settings['SLOW_TXN_MS'] / 1000))
+
+    # Instantiate the movr object defined in movr/movr.py
+    app_movr = MovR(build_sqla_connection_string(settings['DB_URI']),
+                    max_records=settings['MAX_RECORDS'],
+                    pool_size=settings['DB_POOL_SIZE'],
+                    max_overflow=settings['DB_MAX_OVERFLOW'],
+                    pool_pre_ping=settings['DB_POOL_PRE_PING'],
+                    pool_recycle=settings['DB_POOL_RECYCLE'],
+                    statement_timeout=settings['DB_STATEMENT_TIMEOUT'],
+                    cache=vehicle_cache,
+                    staleness=settings['STALENESS'],
+                    instrumentation=app_instrumentation,
+                    metadata_refresh=settings['METADATA_REFRESH'])
+
+    # Batches location pings from /api/v1/locations into multi-row writes.
+    location_buffer = LocationBuffer(
+        app_movr, batch_size=settings['INGEST_BATCH_SIZE'],
+        flush_interval=settings['INGEST_FLUSH_MS'] / 1000)
+    atexit.register(location_buffer.close)
+
+    # The routes find these through the app.
+    app.extensions['movr'] = app_movr
+    app.extensions['movr_location_buffer'] = location_buffer
+    app.extensions['movr_instrumentation'] = app_instrumentation
+    # Rendered vehicle cards, keyed on what they show; see web/fragments.py.
+    app.extensions['movr_fragment_cache'] = FragmentCache(
+        InProcessCache(max_entries=settings['FRAGMENT_CACHE_SIZE']))
+
+    app_instrumentation.add_collector(partial(collect_app_metrics, app))
+    app.register_blueprint(pages)
+    app.register_blueprint(api)
+    return app
+
+
+def collect_app_metrics(app):
+    """
+    Gauges for the connection pool and the ingest backlog, and counters for
+        the caches and the ingested pings.
+    """
+    app_movr = app.extensions['movr']
+    pool = app_movr.engine.pool
+    metrics = [('movr_pool_connections', 'gauge',
+                "Connections in the pool, by state.",
+                {(('state', 'checked_out'),): pool.checkedout(),
+                 (('state', 'idle'),): pool.checkedin(),
+                 (('state', 'overflow'),): max(pool.overflow(), 0)})]
+    if app_movr.cache is not None:
+        cache_stats = app_movr.cache.stats()
+        metrics.append(('movr_cache_lookups_total', 'counter',
+                        "Vehicle cache lookups since start, by result.",
+                        {(('result', 'hit'),): cache_stats['hits'],
+                         (('result', 'miss'),): cache_stats['misses']}))
+    fragment_stats = app.extensions['movr_fragment_cache'].stats()
+    metrics.append(('movr_fragment_cache_lookups_total', 'counter',
+                    "Vehicle card renders since start, by result.",
+                    {(('result', 'hit'),): fragment_stats['hits'],
+                     (('result', 'miss'),): fragment_stats['misses']}))
+    buffer_stats = app.extensions['movr_location_buffer'].stats()
+    metrics.append(('movr_ingest_pings_pending', 'gauge',
+                    "Location pings waiting to be written.",
+                    {None: buffer_stats['pending']}))
+    metrics.append(('movr_ingest_pings_total', 'counter',
+                    "Location pings since start, by outcome.",
+                    {(('outcome', outcome),): buffer_stats[outcome]
+                     for outcome in ('written', 'rejected', 'failed')}))
+    return metrics
+
+
+def settings_from_options(opts):
+    """The settings given on the command line, for `create_app`."""
+    settings = {key: cast(opts[option])
+                for option, key, cast in _OPTION_SETTINGS
+                if opts[option] is not None}
+    if opts['--url'] is not None:
+        settings['DB_URI'] = opts['--url']
+    if opts['--pool-pre-ping']:
+        settings['DB_POOL_PRE_PING'] = True
+    if opts['--cache']:
+        settings['VEHICLE_CACHE'] = True
+    return settings
+
+
+def card_forms():
+    """The vehicle card's forms, built once per request, and only if a card
+    has to be rendered."""
+    if 'card_forms' not in g:
+        g.card_forms = {'start_ride_form': StartRideForm(),
+                        'see_vehicle_form': SeeVehicleForm()}
+    return g.card_forms
+
+
+@pages.app_template_global()
+def vehicle_card(vehicle):
+    """Renders a vehicle's card on vehicles.html, from the fragment cache."""
+    return fragment_cache.render(
+        '_vehicle_card.html', vehicle['id'], vehicle_card_version(vehicle),
+        lambda: dict(card_forms(), vehicle=vehicle))
+
+
+def render_vehicles_page(title, some_vehicles, **context):
+    """
+    Renders vehicles.html, or answers 304 if the client already has this
+        version of the page.
+    """
+    etag = digest(fragment_cache.template_version('vehicles.html'),
+                  fragment_cache.template_version('_vehicle_card.html'),
+                  request.full_path, title, sorted(context.items()),
+                  [(vehicle['id'], vehicle_card_version(vehicle))
+                   for vehicle in some_vehicles])
+    last_modified = max((vehicle['last_checkin'] for vehicle in some_vehicles
+                         if vehicle.get('last_checkin') is not None),
+                        default=None)
+    return conditional_response(
+        etag, last_modified,
+        lambda: render_template('vehicles.html', title=title,
+                                vehicles=some_vehicles, **context))
+
+
+def is_uuid(value):
+    """Checks that a string from the query string can be used as a UUID."""
+    try:
+        UUID(value)
+    except ValueError:
+        return False
+    return True
 
 
 # ROUTES
 # Home page
-@app.route('/', methods=['GET'])
-@app.route('/home', methods=['GET'])
+@pages.route('/', methods=['GET'])
+@pages.route('/home', methods=['GET'])
 def home_page():
     """Redirects to appropriate default page."""
     return redirect(url_for(_DEFAULT_ROUTE, _external=True))
 
 
 # Vehicles page
-@app.route('/vehicles', methods=['GET'])
-def vehicles(max_vehicles=_MAX_RECORDS):
+@pages.route('/vehicles', methods=['GET'])
+def vehicles(max_vehicles=None):
+    """
+    Shows the vehicles page, listing one page of vehicles.
+
+    The `after` and `before` query parameters are vehicle ids used as keyset
+        cursors for the next and previous pages.
+    """
+    if max_vehicles is None:
+        max_vehicles = current_app.config['MAX_RECORDS']
+    after_id = request.args.get('after')
+    before_id = request.args.get('before')
+    for cursor in (after_id, before_id):
+        if cursor is not None and not is_uuid(cursor):
+            flash("`{}` is not a valid vehicle id.".format(cursor))
+            return redirect(url_for('pages.vehicles', _external=True))
+    try:
+        some_vehicles, next_id, prev_id = movr.get_vehicles(
+            max_vehicles=max_vehicles, after_id=after_id, before_id=before_id,
+            staleness=current_app.config['BROWSE_STALENESS'])
+        return render_vehicles_page('Vehicles', some_vehicles,
+                                    next_id=next_id, prev_id=prev_id)
+    except ProgrammingError as error:
+        return render_error_page(error, movr)
+
+
+# Nearby vehicles page
+@pages.route('/vehicles/nearby', methods=['GET'])
+def nearby_vehicles():
     """
-    Shows the vehicles page, listing all vehicles.
+    Lists the available vehicles closest to `?longitude=&latitude=`, within
+        `?radius=` kilometers (default 1), nearest first.
     """
     try:
-        start_ride_form = StartRideForm()
-        see_vehicle_form = SeeVehicleForm()
-        some_vehicles = movr.get_vehicles(max_vehicles=max_vehicles)
-        return render_template('vehicles.html',
-                               title='Vehicles',
-                               vehicles=some_vehicles,
-                               start_ride_form=start_ride_form,
-                               see_vehicle_form=see_vehicle_form)
+        longitude = float(request.args['longitude'])
+        latitude = float(request.args['latitude'])
+        radius_km = float(request.args.get('radius', 1))
+    except (KeyError, ValueError):
+        flash("Pass a numeric `longitude`, `latitude` and (optionally) "
+              "`radius` in kilometers to find nearby vehicles.")
+        return redirect(url_for('pages.vehicles', _external=True))
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90
+            and 0 < radius_km <= 1000):
+        flash("Longitude must be between -180 and 180, latitude between -90 "
+              "and 90, and the radius between 0 and 1000 km.")
+        return redirect(url_for('pages.vehicles', _external=True))
+    try:
+        some_vehicles = movr.find_nearby_vehicles(
+            longitude, latitude, radius_km,
+            limit=current_app.config['MAX_RECORDS'],
+            staleness=current_app.config['BROWSE_STALENESS'])
+        return render_vehicles_page('Nearby vehicles', some_vehicles,
+                                    nearby=True)
     except ProgrammingError as error:
         return render_error_page(error, movr)
 
 
 # Single vehicle page
-@app.route('/vehicle/<vehicle_id>', methods=['GET', 'POST'])
+@pages.route('/vehicle/<vehicle_id>', methods=['GET', 'POST'])
 def vehicle(vehicle_id):
     """View information for a single vehicle."""
     start_ride_form = StartRideForm()
     remove_vehicle_form = RemoveVehicleForm()
     this_vehicle, location_history = movr.get_vehicle_and_location_history(
-        vehicle_id, max_locations=_MAX_RECORDS)
+        vehicle_id, max_locations=current_app.config['MAX_RECORDS'])
     if this_vehicle is None:  # not in database
         flash("Vehicle `{}` not found.".format(vehicle_id))
-        return redirect(url_for('vehicles', _external=True))
+        return redirect(url_for('pages.vehicles', _external=True))
     return render_template('vehicle.html',
                            title='Vehicle {}'.format(vehicle_id),
                            vehicle=this_vehicle,
@@ -116,28 +370,57 @@ def vehicle(vehicle_id):
                            remove_vehicle_form=remove_vehicle_form)
 
 
+# Vehicle location history route
+@pages.route('/vehicle/<vehicle_id>/history', methods=['GET'])
+def vehicle_history(vehicle_id):
+    """
+    A vehicle's path as JSON, for maps and analytics.
+
+    Query parameters (all optional):
+        start, end -- ISO 8601 window; defaults to the 24 hours before `end`,
+            which defaults to now.
+        resolution -- Bucket width in seconds [60], or `raw` for every point.
+        tolerance -- Simplify the path to within this many kilometers.
+    """
+    if not is_uuid(vehicle_id):
+        return jsonify(error="`{}` is not a valid vehicle id.".format(
+            vehicle_id)), 400
+    try:
+        end = (parse_timestamp(request.args['end'])
+               if 'end' in request.args else datetime.utcnow())
+        start = (parse_timestamp(request.args['start'])
+                 if 'start' in request.args else end - timedelta(days=1))
+        resolution = request.args.get('resolution', '60')
+        resolution = None if resolution == 'raw' else float(resolution)
+        tolerance = request.args.get('tolerance', type=float)
+        locations = movr.get_location_history(
+            vehicle_id, start=start, end=end, resolution=resolution,
+            tolerance_km=tolerance)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if not locations and movr.get_vehicle(vehicle_id) is None:
+        return jsonify(error="Vehicle `{}` not found.".format(
+            vehicle_id)), 404
+    return jsonify(vehicle_id=vehicle_id, start=start.isoformat(),
+                   end=end.isoformat(), resolution=resolution,
+                   locations=[dict(location,
+                                   ts=location['ts'].isoformat())
+                              for location in locations])
+
+
 # Remove a vehicle
-@app.route('/vehicle/remove/<vehicle_id>', methods=['POST'])
+@pages.route('/vehicle/remove/<vehicle_id>', methods=['POST'])
 def remove_vehicle(vehicle_id):
     """Delete a vehicle from the database."""
     vehicle_deleted = movr.remove_vehicle(vehicle_id)
-    if vehicle_deleted:  # Vehicle looks like it was deleted
-        # Verify that it was actually deleted as required by the lab.
-        if movr.get_vehicle(vehicle_id) is None:  # Vehicle looks deleted
-            flash("Deleted vehicle with id "
-                  "`{id}` from database.".format(id=vehicle_id))
-            return redirect(url_for('vehicles', _external=True))
-        # else vehicle is still in the database.
-        flash(("Vehicle `{}` NOT successfully deleted. Please modify "
-               "remove_vehicle_txn in `movr/transactions.py` to implement "
-               "the correct functionality."
-               ).format(vehicle_id))
-        return redirect(url_for('vehicle', vehicle_id=vehicle_id,
-                                _external=True))
+    if vehicle_deleted:  # DELETE ... RETURNING confirmed the row is gone.
+        flash("Deleted vehicle with id "
+              "`{id}` from database.".format(id=vehicle_id))
+        return redirect(url_for('pages.vehicles', _external=True))
     elif vehicle_deleted is None:  # Vehicle in use or not in database
         flash(("Vehicle `{}` not found in database, or is currently in use. "
                "Cannot delete it.").format(vehicle_id))
-        return redirect(url_for('vehicles', _external=True))
+        return redirect(url_for('pages.vehicles', _external=True))
 
     return render_error_page(RuntimeError(
         ("Attempt to remove vehicle hit unexpected state. "
@@ -150,23 +433,24 @@ def remove_vehicle(vehicle_id):
 
 
 # Start ride route
-@app.route('/ride/start/<vehicle_id>', methods=['POST'])
+@pages.route('/ride/start/<vehicle_id>', methods=['POST'])
 def start_ride(vehicle_id):
     """
     When the user clicks "start ride," perform DB op & redirect to ride page.
     """
     if movr.start_ride(vehicle_id):
         flash('Ride started with vehicle {}.'.format(vehicle_id))
-        return redirect(url_for('ride', vehicle_id=vehicle_id, _external=True))
+        return redirect(url_for('pages.ride', vehicle_id=vehicle_id,
+                                _external=True))
 
     flash('Could not start ride on vehicle {}.'.format(vehicle_id))
     flash('Either the vehicle is actively being ridden, or it has been '
           'deleted from the database.')
-    return redirect(url_for('vehicles', _external=True))
+    return redirect(url_for('pages.vehicles', _external=True))
 
 
 # Ride page
-@app.route('/ride/<vehicle_id>', methods=['GET', 'POST'])
+@pages.route('/ride/<vehicle_id>', methods=['GET', 'POST'])
 def ride(vehicle_id):
     """
     Show the user the form to end a ride.
@@ -175,26 +459,28 @@ def ride(vehicle_id):
     vehicle_at_start = movr.get_vehicle(vehicle_id)
     if vehicle_at_start is None:  # Vehicle not found in database
         flash("Vehicle `{}` not found.".format(vehicle_id))
-        return redirect(url_for('vehicles', _external=True))
+        return redirect(url_for('pages.vehicles', _external=True))
     elif not vehicle_at_start['in_use']:  # Ride hasn't started.
         flash("Cannot view the ride for this vehicle. It is not currently in "
               "use.")
-        return redirect(url_for('vehicle', vehicle_id=vehicle_id,
+        return redirect(url_for('pages.vehicle', vehicle_id=vehicle_id,
                                 _external=True))
 
     if form.validate_on_submit():
         try:
-            if movr.end_ride(vehicle_id, form.longitude.data, form.latitude.data,
-                             form.battery.data):
-                vehicle_at_end = movr.get_vehicle(vehicle_id)
+            vehicle_at_end = movr.end_ride(vehicle_id, form.longitude.data,
+                                           form.latitude.data,
+                                           form.battery.data)
+            if vehicle_at_end:
                 for message in generate_end_ride_messages(vehicle_at_start,
                                                           vehicle_at_end):
                     flash(message)
-                return redirect(url_for('vehicle', vehicle_id=vehicle_id,
+                return redirect(url_for('pages.vehicle', vehicle_id=vehicle_id,
                                         _external=True))
             # else: end_ride didn't work
             flash("Unable to end ride for vehicle `{id}`.".format(id=vehicle_id))
-            return redirect(url_for('ride', vehicle_id=vehicle_id, _external=True))
+            return redirect(url_for('pages.ride', vehicle_id=vehicle_id,
+                                _external=True))
         except ValueError as e:
             return render_error_page(e, movr)
     return render_template('ride.html',
@@ -203,8 +489,47 @@ def ride(vehicle_id):
                            form=form, vehicle=vehicle_at_start, _external=True)
 
 
+# Metrics route
+@pages.route('/metrics', methods=['GET'])
+def metrics():
+    """Per-transaction metrics, in the Prometheus text format."""
+    return Response(instrumentation.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# Server status route
+@pages.route('/serverstatus', methods=['GET'])
+def server_status():
+    """
+    Database health: round-trip latency, pool utilization, schema version and
+        estimated row counts. Answers 503 if the database can't be reached.
+
+    Sends JSON when the client prefers it (`Accept: application/json`).
+    """
+    status = movr.status()
+    code = 200 if status['reachable'] else 503
+    url = movr.engine.url
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(host=url.host, sql_user=url.username,
+                       database=url.database, **status), code
+    return render_template('serverstatus.html', title='Server Status',
+                           host=url.host, sql_user=url.username,
+                           database=url.database, tables=status['tables'],
+                           status=status), code
+
+
+# Liveness route
+@pages.route('/livez', methods=['GET'])
+def livez():
+    """
+    Liveness probe for the load balancer: answers as long as the process can
+        serve requests, without touching the database.
+    """
+    return Response('ok\n', mimetype='text/plain')
+
+
 # Add vehicles route
-@app.route('/vehicles/add', methods=['GET', 'POST'])
+@pages.route('/vehicles/add', methods=['GET', 'POST'])
 def add_vehicle():
     """Add a new vehicle to the fleet."""
     form = VehicleForm()
@@ -217,19 +542,9 @@ def add_vehicle():
         except IntegrityError as e:
             return render_error_page(e, movr)
         vehicle_id = new_info['vehicle_id']
-
-        # check to verify that vehicle was added
-        new_vehicle = movr.get_vehicle(vehicle_id)
-        if new_vehicle is None:  # Insert didn't work
-            flash(("Vehicle with id `{}` "
-                   "NOT successfully added. Edit add_vehicle_txn in "
-                   "movr/transactions.py to add the vehicle to the database."
-                   ).format(vehicle_id))
-            redirect(url_for('add_vehicle', _external=True))
-        else:  # Inserted vehicle was found
-            flash('Vehicle added! \nid: {}'.format(vehicle_id))
-            return redirect(
-                url_for('vehicle', vehicle_id=vehicle_id, _external=True))
+        flash('Vehicle added! \nid: {}'.format(vehicle_id))
+        return redirect(
+            url_for('pages.vehicle', vehicle_id=vehicle_id, _external=True))
 
     # form not properly filled out yet
     return render_template('add_vehicle.html',
@@ -237,5 +552,30 @@ def add_vehicle():
                            form=form)
 
 
+# Readiness route
+@pages.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness probe for the load balancer: 200 once this worker can reach
+        the database, 503 (with the error) until then. The first call opens
+        the worker's first connection.
+    """
+    _, error = measure_round_trip(movr.engine)
+    if error is not None:
+        return Response('not ready: {}\n'.format(error), status=503,
+                        mimetype='text/plain')
+    return Response('ok\n', mimetype='text/plain')
+
+
+def main():
+    """Runs Flask's development server, configured from the command line."""
+    opts = docopt(__doc__)
+    app = create_app(settings_from_options(opts))
+    # Verify connection to database is working.
+    # Suggest help if common errors are encountered.
+    test_connection(app.extensions['movr'].engine)
+    app.run(use_reloader=False, port=int(opts['--port']))
+
+
 if __name__ == '__main__':
-    app.run(use_reloader=False, port=_PORT)
+    main()
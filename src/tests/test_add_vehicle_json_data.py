@@ -0,0 +1,62 @@
+"""
+Tests for the resume checkpoint in util/add_vehicle_json_data.py.
+"""
+import json
+import os
+
+import pytest
+
+from util.add_vehicle_json_data import Checkpoint
+
+SETTINGS = {'source': 'vehicles.csv', 'batch_size': 500,
+            'num_partitions': 2}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'state.json')
+
+
+def test_first_run_has_nothing_done(path):
+    checkpoint = Checkpoint.load(path, SETTINGS)
+    assert not any(checkpoint.is_done(batch) for batch in range(4))
+
+
+def test_committed_batches_are_skipped_per_partition(path):
+    checkpoint = Checkpoint.load(path, SETTINGS)
+    for batch in (0, 2, 4, 1):
+        checkpoint.record(batch, failed=False)
+
+    resumed = Checkpoint.load(path, SETTINGS)
+    assert resumed.committed == {0: 4, 1: 1}
+    assert [batch for batch in range(8) if resumed.is_done(batch)] == \
+        [0, 1, 2, 4]
+
+
+def test_failed_batches_are_retried(path):
+    checkpoint = Checkpoint.load(path, SETTINGS)
+    checkpoint.record(0, failed=True)
+    checkpoint.record(2, failed=False)
+
+    resumed = Checkpoint.load(path, SETTINGS)
+    assert not resumed.is_done(0)
+    assert resumed.is_done(2)
+
+    resumed.record(0, failed=False)
+    assert Checkpoint.load(path, SETTINGS).failed == set()
+
+
+def test_save_replaces_the_state_file(path):
+    Checkpoint.load(path, SETTINGS).record(1, failed=True)
+    with open(path) as state_file:
+        assert json.load(state_file) == {'settings': SETTINGS,
+                                         'committed': {}, 'failed': [1]}
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_changed_settings_refuse_to_resume(path):
+    Checkpoint.load(path, SETTINGS).record(0, failed=False)
+    settings = dict(SETTINGS, num_partitions=4)
+    with pytest.raises(SystemExit, match='--fresh'):
+        Checkpoint.load(path, settings)
+    assert Checkpoint.load(path, settings, fresh=True).committed == {}
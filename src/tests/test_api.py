@@ -0,0 +1,112 @@
+"""
+Tests for the JSON API in web/api.py, against a stand-in for `MovR`.
+"""
+import json
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+from web import api as api_module
+from web.api import api
+
+VEHICLE_ID = '00000000-0000-0000-0000-000000000001'
+
+
+class StubMovR:
+    """Records the calls the routes make, and answers them from memory."""
+    max_records = 20
+
+    def __init__(self):
+        self.calls = []
+        self.vehicle_count = 1
+        self.vehicles_sent = 0
+        self.cursor_closed = False
+
+    def iter_vehicles(self, after_id=None, limit=None):
+        self.calls.append({'after_id': after_id, 'limit': limit})
+        # Holding on to it means only an explicit close() runs its cleanup,
+        # not garbage collection.
+        self.open_cursor = self.cursor()
+        return self.open_cursor
+
+    def cursor(self):
+        """Stands in for the server-side cursor `iter_vehicles` reads."""
+        try:
+            for _ in range(self.vehicle_count):
+                self.vehicles_sent += 1
+                yield {'id': VEHICLE_ID, 'vehicle_type': 'scooter',
+                       'in_use': False, 'battery': 90,
+                       'last_longitude': -74.0, 'last_latitude': 40.7,
+                       'last_checkin': datetime(2024, 5, 1)}
+        finally:
+            self.cursor_closed = True
+
+    def get_location_history(self, vehicle_id, start=None, end=None,
+                             resolution=None, tolerance_km=None):
+        self.calls.append({'vehicle_id': vehicle_id, 'start': start,
+                           'end': end, 'resolution': resolution,
+                           'tolerance_km': tolerance_km})
+        return [{'ts': datetime(2024, 5, 1), 'longitude': -74.0,
+                 'latitude': 40.7, 'points': 3}]
+
+
+@pytest.fixture
+def movr():
+    return StubMovR()
+
+
+@pytest.fixture
+def client(movr):
+    app = Flask(__name__)
+    app.extensions['movr'] = movr
+    app.register_blueprint(api)
+    return app.test_client()
+
+
+def read_ndjson(response):
+    return [json.loads(line) for line in response.data.splitlines()]
+
+
+def test_locations_default_to_one_minute_buckets(client, movr):
+    response = client.get('/api/v1/vehicles/{}/locations'.format(VEHICLE_ID))
+    assert response.status_code == 200
+    assert movr.calls[-1]['resolution'] == 60.0
+    assert read_ndjson(response)[0]['points'] == 3
+
+
+def test_locations_resolution(client, movr):
+    url = '/api/v1/vehicles/{}/locations'.format(VEHICLE_ID)
+    assert client.get(url + '?resolution=300').status_code == 200
+    assert movr.calls[-1]['resolution'] == 300.0
+    assert client.get(url + '?resolution=raw').status_code == 200
+    assert movr.calls[-1]['resolution'] is None
+    assert client.get(url + '?resolution=0').status_code == 400
+
+
+def test_vehicles_are_paged(client, movr):
+    response = client.get('/api/v1/vehicles?fields=id,battery')
+    assert response.status_code == 200
+    assert movr.calls[-1] == {'after_id': None, 'limit': StubMovR.max_records}
+    assert read_ndjson(response) == [{'id': VEHICLE_ID, 'battery': 90}]
+
+    client.get('/api/v1/vehicles?after={}&limit=1000'.format(VEHICLE_ID))
+    assert movr.calls[-1] == {'after_id': VEHICLE_ID, 'limit': 1000}
+    assert client.get('/api/v1/vehicles?limit=1001').status_code == 400
+    assert client.get('/api/v1/vehicles?fields=color').status_code == 400
+
+
+def test_closing_a_stream_early_closes_the_cursor(client, movr):
+    movr.vehicle_count = 1000
+    response = client.get('/api/v1/vehicles?limit=1000', buffered=False)
+    first_batch = next(iter(response.response))
+    assert len(first_batch.splitlines()) == api_module.NDJSON_BATCH
+    assert not movr.cursor_closed
+    response.close()  # What the WSGI server does when the client goes away.
+    assert movr.cursor_closed
+    assert movr.vehicles_sent < movr.vehicle_count
+
+
+def test_finished_stream_closes_the_cursor(client, movr):
+    client.get('/api/v1/vehicles')
+    assert movr.cursor_closed
@@ -0,0 +1,147 @@
+"""
+Tests for the ASGI JSON API in asgi.py, against a stand-in for `AsyncMovR`.
+"""
+import asyncio
+import json
+
+import pytest
+
+from asgi import APIError, MovRApp, route
+
+VEHICLE_ID = '00000000-0000-0000-0000-000000000001'
+
+
+class StubAsyncMovR:
+    """Records the calls the routes make, and answers them from memory."""
+    max_records = 20
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_vehicles(self, max_vehicles=None, after_id=None,
+                           before_id=None):
+        self.calls.append(('get_vehicles', max_vehicles, after_id,
+                           before_id))
+        return [{'id': VEHICLE_ID}], None, None
+
+    async def get_vehicle_and_location_history(self, vehicle_id,
+                                               max_locations=None):
+        self.calls.append(('get_vehicle_and_location_history', vehicle_id,
+                           max_locations))
+        return None, []
+
+    async def start_ride(self, vehicle_id):
+        raise RuntimeError("statement timeout")
+
+    async def end_ride(self, vehicle_id, longitude, latitude, battery):
+        self.calls.append(('end_ride', vehicle_id, longitude, latitude,
+                           battery))
+        return {'id': vehicle_id, 'in_use': False}
+
+
+@pytest.fixture
+def movr():
+    return StubAsyncMovR()
+
+
+def request(movr, method, path, query=b'', body=None):
+    """Runs `route` for one request; returns (status, payload)."""
+    messages = [{'type': 'http.request',
+                 'body': b'' if body is None else json.dumps(body).encode()}]
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query}
+    return asyncio.run(route(movr, scope, receive))
+
+
+def error_status(movr, *args, **kwargs):
+    with pytest.raises(APIError) as error:
+        request(movr, *args, **kwargs)
+    return error.value.status
+
+
+def test_list_vehicles(movr):
+    assert request(movr, 'GET', '/vehicles/') == (
+        200, {'vehicles': [{'id': VEHICLE_ID}], 'next': None, 'prev': None})
+    request(movr, 'GET', '/vehicles',
+            query='after={}&limit=5'.format(VEHICLE_ID).encode())
+    assert movr.calls == [('get_vehicles', 20, None, None),
+                          ('get_vehicles', 5, VEHICLE_ID, None)]
+
+
+def test_list_vehicles_checks_its_parameters(movr):
+    assert error_status(movr, 'GET', '/vehicles', query=b'limit=0') == 400
+    assert error_status(movr, 'GET', '/vehicles', query=b'limit=x') == 400
+    assert error_status(movr, 'GET', '/vehicles', query=b'after=1') == 400
+    assert movr.calls == []
+
+
+def test_unknown_vehicle_is_404(movr):
+    assert error_status(movr, 'GET', '/vehicles/' + VEHICLE_ID) == 404
+
+
+def test_end_ride_reads_the_body(movr):
+    status, payload = request(
+        movr, 'POST', '/vehicles/{}/ride/end'.format(VEHICLE_ID),
+        body={'longitude': -74.0, 'latitude': '40.7', 'battery': 80})
+    assert (status, payload['in_use']) == (200, False)
+    assert movr.calls == [('end_ride', VEHICLE_ID, -74.0, 40.7, 80)]
+    assert error_status(movr, 'POST',
+                        '/vehicles/{}/ride/end'.format(VEHICLE_ID),
+                        body={'longitude': -74.0, 'latitude': 95,
+                              'battery': 80}) == 400
+
+
+def test_unknown_routes(movr):
+    assert error_status(movr, 'GET', '/nowhere') == 404
+    assert error_status(movr, 'GET', '/vehicles/not-a-uuid') == 400
+    assert error_status(movr, 'PUT', '/vehicles') == 405
+    assert error_status(movr, 'GET',
+                        '/vehicles/{}/ride'.format(VEHICLE_ID)) == 405
+
+
+class IncompleteConfig:
+    DB_URI = 'postgresql://root@localhost:26257/movr?sslmode=disable'
+
+
+def call_app(app, scope, incoming):
+    """Runs the ASGI app; returns the messages it sent."""
+    sent = []
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def response(app, method, path):
+    sent = call_app(app, {'type': 'http', 'method': method, 'path': path,
+                          'query_string': b''},
+                    [{'type': 'http.request', 'body': b''}])
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+
+def test_app_turns_errors_into_json(movr):
+    app = MovRApp()
+    app.movr = movr
+    assert response(app, 'GET', '/vehicles/' + VEHICLE_ID) == (
+        404, {'error': "Vehicle `{}` not found.".format(VEHICLE_ID)})
+    assert response(app, 'POST', '/vehicles/{}/ride'.format(VEHICLE_ID)) == (
+        500, {'error': "Internal server error."})
+
+
+def test_incomplete_url_fails_startup_without_prompting():
+    app = MovRApp(IncompleteConfig)
+    sent = call_app(app, {'type': 'lifespan'},
+                    [{'type': 'lifespan.startup'}])
+    assert sent == [{'type': 'lifespan.startup.failed',
+                     'message': "The connection string has no password."}]
+    assert response(app, 'GET', '/vehicles') == (
+        500, {'error': "Internal server error."})
@@ -0,0 +1,111 @@
+"""
+Tests for movr/cache.py.
+"""
+import pytest
+
+from movr import cache
+from movr.cache import MISSING, CacheBackend, InProcessCache, VehicleCache
+
+
+class FakeClock(object):
+    """Stands in for the `time` module, so TTLs can expire on demand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+
+class Loader(object):
+    """Counts how often the cache had to load `value`."""
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+
+def test_entries_expire(clock):
+    store = InProcessCache()
+    store.set('a', 1, ttl=5)
+    store.set('forever', 2, ttl=None)
+    clock.now += 4.9
+    assert store.get('a') == 1
+    clock.now += 0.1
+    assert store.get('a') is MISSING
+    assert store.get('forever') == 2
+    assert len(store) == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    store = InProcessCache(max_entries=2)
+    store.set('a', 1, ttl=None)
+    store.set('b', 2, ttl=None)
+    store.get('a')
+    store.set('c', 3, ttl=None)
+    assert store.get('b') is MISSING
+    assert (store.get('a'), store.get('c')) == (1, 3)
+
+
+def test_counters_are_never_evicted():
+    store = InProcessCache(max_entries=2)
+    assert store.incr('generation') == 1
+    for number in range(10):
+        store.set('entry:{}'.format(number), number, ttl=None)
+    assert store.get('generation') == 1
+    assert store.incr('generation') == 2
+    assert len(store) == 2
+
+
+def test_cached_none_is_a_hit():
+    vehicles = VehicleCache(InProcessCache())
+    loader = Loader(None)
+    assert vehicles.vehicle('missing', loader) is None
+    assert vehicles.vehicle('missing', loader) is None
+    assert loader.calls == 1
+    assert vehicles.stats() == {'hits': 1, 'misses': 1, 'hit_ratio': 0.5}
+
+
+def test_invalidate_drops_the_vehicle_and_every_listing():
+    vehicles = VehicleCache(InProcessCache())
+    vehicle, page = Loader({'id': 'v1'}), Loader(([], None, None))
+    vehicles.vehicle('v1', vehicle)
+    vehicles.listing(10, None, None, page)
+    vehicles.listing(10, None, None, page)
+    assert (vehicle.calls, page.calls) == (1, 1)
+
+    vehicles.invalidate('v1')
+    vehicles.vehicle('v1', vehicle)
+    vehicles.listing(10, None, None, page)
+    assert (vehicle.calls, page.calls) == (2, 2)
+
+
+def test_invalidate_survives_a_full_cache():
+    store = InProcessCache(max_entries=2)
+    vehicles = VehicleCache(store)
+    page = Loader(([], None, None))
+    vehicles.listing(10, None, None, page)
+    vehicles.invalidate_many(['v1', 'v2'])
+    # Fill the cache; the generation must outlive the entries it keys.
+    for number in range(5):
+        vehicles.vehicle('v{}'.format(number), Loader(None))
+    assert store.get(VehicleCache.GENERATION_KEY) == 1
+    vehicles.listing(10, None, None, page)
+    vehicles.listing(10, None, None, page)
+    assert page.calls == 2
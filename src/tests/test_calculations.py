@@ -0,0 +1,67 @@
+"""
+Tests for the vectorized distance and path helpers in util/calculations.py.
+"""
+import numpy as np
+import pytest
+
+from util.calculations import haversine_km, simplify_path, vincenty_km
+
+
+def degrees(whole, minutes, seconds):
+    return whole + minutes / 60 + seconds / 3600
+
+
+def test_vincenty_matches_the_published_example():
+    # Flinders Peak to Buninyong, from Vincenty (1975): 54972.271 m.
+    distance = vincenty_km(degrees(144, 25, 29.52440),
+                           -degrees(37, 57, 3.72030),
+                           degrees(143, 55, 35.38390),
+                           -degrees(37, 39, 10.15610))
+    assert distance == pytest.approx(54.972271, abs=1e-6)
+
+
+def test_vincenty_along_the_equator():
+    # One degree of the equator is the semi-major axis times pi / 180.
+    assert vincenty_km(0, 0, 1, 0) == pytest.approx(6378.137 * np.pi / 180)
+    assert vincenty_km(0, 0, 1, 0) == pytest.approx(haversine_km(0, 0, 1, 0),
+                                                    rel=5e-3)
+
+
+def test_vincenty_broadcasts_and_handles_coincident_points():
+    distances = vincenty_km([0, -74.0], [0, 40.7], [0, -74.0], [0, 40.7])
+    np.testing.assert_array_equal(distances, [0, 0])
+    assert vincenty_km(-74.0, 40.7, [-73.9, -73.8], 40.7).shape == (2,)
+
+
+def test_vincenty_nearly_antipodal_points_are_nan():
+    assert np.isnan(vincenty_km(0, 0, 179.7, 0.5))
+
+
+def test_short_paths_are_kept_whole():
+    np.testing.assert_array_equal(simplify_path([], [], 1), [])
+    np.testing.assert_array_equal(simplify_path([0, 1], [0, 1], 1), [0, 1])
+
+
+def test_straight_line_keeps_its_ends():
+    longitudes = np.linspace(-74.0, -73.9, 11)
+    latitudes = np.linspace(40.7, 40.8, 11)
+    np.testing.assert_array_equal(
+        simplify_path(longitudes, latitudes, 0.001), [0, 10])
+
+
+def test_corner_is_kept():
+    # East for about 1.7 km, then north; the corner is 1.3 km off the
+    # straight line between the ends.
+    longitudes = [-74.00, -73.99, -73.98, -73.98, -73.98]
+    latitudes = [40.70, 40.70, 40.70, 40.71, 40.72]
+    np.testing.assert_array_equal(
+        simplify_path(longitudes, latitudes, 0.1), [0, 2, 4])
+    np.testing.assert_array_equal(
+        simplify_path(longitudes, latitudes, 5), [0, 4])
+
+
+def test_path_over_the_antimeridian_is_continuous():
+    # Without unwrapping, the -180 point would look 40,000 km away.
+    np.testing.assert_array_equal(
+        simplify_path([179.8, 179.9, -180.0, -179.9], [0, 0, 0, 0], 0.01),
+        [0, 3])
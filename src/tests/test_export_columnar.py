@@ -0,0 +1,75 @@
+"""
+Tests for util/export_columnar.py's writer; needs pyarrow
+(requirements-export.txt).
+"""
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+from movr.models import LocationHistory  # noqa: E402
+from util.export_columnar import (PartitionedWriter, arrow_schema,  # noqa
+                                  location_history_query,
+                                  partition_by_day, partition_by_vehicle)
+
+Row = namedtuple('Row', [column.name
+                         for column in LocationHistory.__table__.columns])
+START = datetime(2024, 5, 1, 23)
+
+
+def history(vehicles, pings):
+    """`pings` rows for each of `vehicles` vehicles, ordered as the
+    vehicle partitioning query orders them."""
+    rows = []
+    for vehicle in range(vehicles):
+        vehicle_id = '{:x}{:031x}'.format(vehicle % 16, vehicle)
+        for ping in range(pings):
+            rows.append(Row('{}-{}'.format(vehicle, ping), vehicle_id,
+                            START + timedelta(minutes=30 * ping), -74.0,
+                            40.7, None))
+    return sorted(rows, key=lambda row: (row.vehicle_id, row.ts))
+
+
+def write(tmpdir, rows, partition, chunk_size):
+    writer = PartitionedWriter(
+        str(tmpdir), arrow_schema(LocationHistory.__table__), partition,
+        'part-1.parquet', 'parquet', 'zstd')
+    try:
+        for start in range(0, len(rows), chunk_size):
+            writer.write(rows[start:start + chunk_size])
+    finally:
+        writer.close()
+    return writer
+
+
+def test_vehicles_share_a_file_per_id_prefix(tmpdir):
+    rows = history(vehicles=40, pings=3)
+    writer = write(tmpdir, rows, partition_by_vehicle, chunk_size=7)
+    assert writer.rows == len(rows)
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'vehicle_prefix={:x}'.format(digit) for digit in range(16)]
+    assert len(writer.files) == 16
+
+    table = pq.read_table(os.path.join(str(tmpdir), 'vehicle_prefix=1',
+                                       'part-1.parquet'))
+    vehicle_ids = table.column('vehicle_id').to_pylist()
+    assert vehicle_ids == sorted(vehicle_ids)
+    assert all(vehicle_id.startswith('1') for vehicle_id in vehicle_ids)
+    assert len(set(vehicle_ids)) > 1
+
+
+def test_days_get_one_file_each(tmpdir):
+    rows = sorted(history(vehicles=3, pings=4), key=lambda row: row.ts)
+    writer = write(tmpdir, rows, partition_by_day, chunk_size=5)
+    assert sorted(os.listdir(str(tmpdir))) == ['day=2024-05-01',
+                                               'day=2024-05-02']
+    assert len(writer.files) == 2
+    assert sum(pq.read_table(path).num_rows for path in writer.files) == 12
+
+
+def test_vehicle_query_orders_by_vehicle_first():
+    sql = str(location_history_query('vehicle', None, START))
+    assert 'ORDER BY location_history.vehicle_id, location_history.ts' in sql
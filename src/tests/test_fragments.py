@@ -0,0 +1,111 @@
+"""
+Tests for web/fragments.py, on a bare Flask app with in-memory templates.
+"""
+from datetime import datetime
+
+import pytest
+from flask import Flask, flash
+from jinja2 import DictLoader
+
+from movr.cache import InProcessCache
+from web.fragments import (FragmentCache, conditional_response,
+                           vehicle_card_version)
+
+UPDATED = datetime(2024, 5, 1, 12, 0, 0, 500000)
+UPDATED_HTTP = 'Wed, 01 May 2024 12:00:00 GMT'
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.jinja_loader = DictLoader({'card.html': '<b>{{ battery }}</b>'})
+    app.renders = 0
+
+    def render():
+        app.renders += 1
+        return 'page'
+
+    @app.route('/page')
+    def page():
+        return conditional_response('v1', UPDATED, render)
+
+    @app.route('/flashed')
+    def flashed():
+        flash('Ride ended.')
+        return conditional_response('v1', UPDATED, render)
+
+    return app
+
+
+def test_unconditional_get_is_rendered_and_tagged(app):
+    response = app.test_client().get('/page')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'page'
+    assert response.headers['ETag'] == 'W/"v1"'
+    assert response.headers['Last-Modified'] == UPDATED_HTTP
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+
+@pytest.mark.parametrize('headers', [
+    {'If-None-Match': 'W/"v1"'},
+    {'If-None-Match': '"v0", "v1"'},
+    {'If-Modified-Since': UPDATED_HTTP},
+])
+def test_current_copy_gets_a_304_without_rendering(app, headers):
+    response = app.test_client().get('/page', headers=headers)
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == 'W/"v1"'
+    assert app.renders == 0
+
+
+@pytest.mark.parametrize('headers', [
+    {'If-None-Match': 'W/"v0"'},
+    {'If-Modified-Since': 'Wed, 01 May 2024 11:59:59 GMT'},
+    # If-None-Match wins over a matching If-Modified-Since.
+    {'If-None-Match': 'W/"v0"', 'If-Modified-Since': UPDATED_HTTP},
+])
+def test_stale_copy_is_rendered(app, headers):
+    response = app.test_client().get('/page', headers=headers)
+    assert response.status_code == 200
+    assert app.renders == 1
+
+
+def test_pages_with_flashed_messages_are_never_304(app):
+    response = app.test_client().get(
+        '/flashed', headers={'If-None-Match': 'W/"v1"'})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert app.renders == 1
+
+
+def render_card(app, fragments, battery, version=None):
+    with app.app_context():
+        return str(fragments.render(
+            'card.html', 'vehicle-1',
+            version or vehicle_card_version({'battery': battery}),
+            lambda: {'battery': battery}))
+
+
+def test_fragment_is_rendered_once_per_version(app):
+    fragments = FragmentCache(InProcessCache())
+    assert render_card(app, fragments, 80) == '<b>80</b>'
+    assert render_card(app, fragments, 80) == '<b>80</b>'
+    assert fragments.stats() == {'hits': 1, 'misses': 1}
+
+    # New data means a new version, so the old entry is simply never read.
+    assert render_card(app, fragments, 60) == '<b>60</b>'
+    assert fragments.stats() == {'hits': 1, 'misses': 2}
+
+
+def test_changed_template_misses(app):
+    fragments = FragmentCache(InProcessCache())
+    render_card(app, fragments, 80, version='same')
+    app.jinja_loader.mapping['card.html'] = '<i>{{ battery }}</i>'
+    app.jinja_env.cache.clear()
+    # A new process picks up the new source: a fresh cache of template
+    # versions over the same backend.
+    restarted = FragmentCache(fragments.backend)
+    assert render_card(app, restarted, 80, version='same') == '<i>80</i>'
+    assert restarted.stats() == {'hits': 0, 'misses': 1}
@@ -0,0 +1,109 @@
+"""
+Tests for movr/ingest.py's LocationBuffer, with a stand-in for MovR.
+"""
+import threading
+from datetime import datetime
+
+import pytest
+
+from movr import ingest
+from movr.ingest import BufferFull, LocationBuffer
+
+
+class RecordingMovR(object):
+    """Records each batch; unknown vehicles are rejected, and `fail` makes
+    the write raise."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+        self.wrote = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def record_locations(self, batch):
+        self.release.wait()
+        self.batches.append(batch)
+        self.wrote.set()
+        if self.fail:
+            raise RuntimeError("The database is down.")
+        known = [ping for ping in batch if ping['vehicle_id'] != 'unknown']
+        return len(known), len(batch) - len(known)
+
+
+def pings(count, vehicle_id='v1'):
+    return [{'vehicle_id': vehicle_id, 'longitude': -74.0, 'latitude': 40.7,
+             'ts': datetime(2024, 5, 1)} for _ in range(count)]
+
+
+def test_full_batch_is_written_without_waiting():
+    movr = RecordingMovR()
+    buffer = LocationBuffer(movr, batch_size=3, flush_interval=60, writers=1)
+    buffer.add(pings(3))
+    assert movr.wrote.wait(5)
+    buffer.close()
+    assert [len(batch) for batch in movr.batches] == [3]
+
+
+def test_add_past_max_pending_raises_buffer_full():
+    movr = RecordingMovR()
+    movr.release.clear()  # Writers block, so nothing drains.
+    buffer = LocationBuffer(movr, batch_size=100, flush_interval=60,
+                            max_pending=5, writers=1)
+    buffer.add(pings(4))
+    with pytest.raises(BufferFull):
+        buffer.add(pings(2))
+    assert buffer.pending() == 4
+    buffer.add(pings(1))
+    assert buffer.pending() == 5
+    movr.release.set()
+    buffer.close()
+
+
+def test_close_writes_what_is_waiting():
+    movr = RecordingMovR()
+    buffer = LocationBuffer(movr, batch_size=4, flush_interval=60, writers=2)
+    buffer.add(pings(6) + pings(3, vehicle_id='unknown'))
+    buffer.close()
+    assert sum(len(batch) for batch in movr.batches) == 9
+    assert buffer.stats() == {'pending': 0, 'written': 6, 'rejected': 3,
+                              'failed': 0}
+    with pytest.raises(RuntimeError):
+        buffer.add(pings(1))
+
+
+def test_failed_writes_are_counted_and_the_writer_survives():
+    movr = RecordingMovR(fail=True)
+    buffer = LocationBuffer(movr, batch_size=2, flush_interval=60, writers=1)
+    buffer.add(pings(2))
+    assert movr.wrote.wait(5)
+    movr.fail = False
+    buffer.add(pings(1))
+    buffer.close()
+    assert buffer.stats() == {'pending': 0, 'written': 1, 'rejected': 0,
+                              'failed': 2}
+
+
+def test_close_without_pings_starts_nothing():
+    movr = RecordingMovR()
+    buffer = LocationBuffer(movr)
+    buffer.close()
+    assert movr.batches == []
+
+
+def test_forked_process_starts_its_own_writers(monkeypatch):
+    movr = RecordingMovR()
+    movr.release.clear()
+    buffer = LocationBuffer(movr, batch_size=100, flush_interval=60,
+                            writers=1)
+    buffer.add(pings(2))
+    parent_threads = buffer._threads
+
+    # The child inherits the parent's pending pings, but not its threads.
+    monkeypatch.setattr(ingest.os, 'getpid', lambda: -1)
+    buffer.add(pings(1))
+    assert buffer.pending() == 1
+    assert buffer._threads != parent_threads
+    movr.release.set()
+    buffer.close()
+    assert [len(batch) for batch in movr.batches] == [1]
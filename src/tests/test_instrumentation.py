@@ -0,0 +1,99 @@
+"""
+Tests for movr/instrumentation.py, on an in-memory SQLite engine.
+"""
+import logging
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from movr.instrumentation import Instrumentation
+
+
+class RetryError(Exception):
+    """What psycopg2 raises when CockroachDB asks for a retry."""
+    pgcode = '40001'
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE pings (id INTEGER)")
+    return engine
+
+
+@pytest.fixture
+def instrumentation(engine):
+    instrumentation = Instrumentation(buckets=(0.5, 60))
+    instrumentation.instrument(engine)
+    return instrumentation
+
+
+def test_statements_and_rows_are_counted_per_transaction(engine,
+                                                         instrumentation):
+    with instrumentation.track('insert_txn'):
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO pings VALUES (1), (2)"))
+            connection.execute(text("UPDATE pings SET id = id + 1"))
+    with engine.begin() as connection:  # Not tracked.
+        connection.execute(text("DELETE FROM pings WHERE id = 2"))
+
+    stats = instrumentation.transactions['insert_txn']
+    assert (stats.count, stats.statements, stats.rows) == (1, 2, 4)
+    assert (stats.errors, stats.retries) == (0, 0)
+    assert stats.bucket_counts == [1, 0]
+
+
+def test_errors_and_retries_are_counted(instrumentation):
+    with pytest.raises(ValueError):
+        with instrumentation.track('start_ride_txn'):
+            for _ in range(2):
+                instrumentation._on_error(
+                    SimpleNamespace(original_exception=RetryError()))
+            instrumentation._on_error(
+                SimpleNamespace(original_exception=RuntimeError()))
+            raise ValueError("Gave up.")
+    stats = instrumentation.transactions['start_ride_txn']
+    assert (stats.count, stats.errors, stats.retries) == (1, 1, 2)
+
+
+def test_slow_transactions_are_logged(caplog):
+    instrumentation = Instrumentation(slow_threshold=0)
+    with caplog.at_level(logging.WARNING, logger='movr.instrumentation'):
+        with instrumentation.track('get_vehicles_txn'):
+            pass
+    assert "Slow transaction get_vehicles_txn" in caplog.text
+
+
+def test_render(engine, instrumentation):
+    with instrumentation.track('insert_txn'):
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO pings VALUES (1)"))
+    instrumentation.add_collector(lambda: [
+        ('movr_ingest_pings_pending', 'gauge', "Pings waiting.", {None: 3}),
+        ('movr_cache_lookups_total', 'counter', "Lookups.",
+         {(('result', 'hit'),): 5})])
+
+    lines = instrumentation.render().splitlines()
+    assert lines[:2] == [
+        "# HELP movr_transaction_duration_seconds Time spent in each "
+        "transaction, including retries.",
+        "# TYPE movr_transaction_duration_seconds histogram"]
+    for line in [
+            'movr_transaction_duration_seconds_bucket{transaction='
+            '"insert_txn",le="0.5"} 1',
+            'movr_transaction_duration_seconds_bucket{transaction='
+            '"insert_txn",le="60"} 1',
+            'movr_transaction_duration_seconds_bucket{transaction='
+            '"insert_txn",le="+Inf"} 1',
+            'movr_transaction_duration_seconds_count{transaction='
+            '"insert_txn"} 1',
+            '# TYPE movr_transaction_retries_total counter',
+            'movr_transaction_errors_total{transaction="insert_txn"} 0',
+            'movr_transaction_statements_total{transaction="insert_txn"} 1',
+            'movr_transaction_rows_total{transaction="insert_txn"} 1',
+            '# TYPE movr_ingest_pings_pending gauge',
+            'movr_ingest_pings_pending 3',
+            'movr_cache_lookups_total{result="hit"} 5']:
+        assert line in lines
@@ -0,0 +1,63 @@
+"""
+Tests for movr/metadata.py's cached catalog lookups.
+"""
+import pytest
+
+from movr import metadata
+from movr.metadata import CachedValue
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(metadata, 'time', clock)
+    return clock
+
+
+class Loader(object):
+    """Returns 1, 2, 3, ... on each call, or raises if `fail` is set."""
+    __name__ = 'load_tables'
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("The cluster is down.")
+        return self.calls
+
+
+def test_value_is_loaded_once_per_interval(clock):
+    loader = Loader()
+    value = CachedValue(loader, refresh_interval=60, default=0)
+    assert value.age() is None
+    assert (value.get(), value.get()) == (1, 1)
+    clock.now += 59
+    assert value.get() == 1
+    assert value.age() == 59
+    clock.now += 1
+    assert value.get() == 2
+    assert loader.calls == 2
+
+
+def test_failed_refresh_keeps_the_last_value_for_an_interval(clock):
+    loader = Loader()
+    value = CachedValue(loader, refresh_interval=60)
+    value.get()
+    loader.fail = True
+    clock.now += 60
+    assert value.get() == 1
+    assert isinstance(value.error, RuntimeError)
+    # The failure is cached too, so the cluster isn't asked again at once.
+    assert value.get() == 1
+    assert loader.calls == 2
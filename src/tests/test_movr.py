@@ -0,0 +1,206 @@
+"""
+Tests for the `MovR` and `AsyncMovR` wrappers that don't need a cluster.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+
+from movr import movr as movr_module
+from movr.async_movr import AsyncMovR
+from movr.movr import (MovR, as_of_system_time, location_history_reader,
+                       run_read_only_transaction, set_transaction_statement)
+
+URL = 'cockroachdb://root@localhost:26257/movr?sslmode=disable'
+VEHICLE_ID = '00000000-0000-0000-0000-000000000001'
+START = datetime(2024, 5, 1)
+
+
+@pytest.fixture
+def session():
+    """A location_history with five raw points for VEHICLE_ID."""
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE location_history (id TEXT PRIMARY KEY, "
+            "vehicle_id TEXT, ts TIMESTAMP, longitude FLOAT, latitude FLOAT, "
+            "event TEXT)")
+        for minute in range(5):
+            connection.exec_driver_sql(
+                "INSERT INTO location_history VALUES (?, ?, ?, ?, 40.7, NULL)",
+                (str(minute), VEHICLE_ID, START + timedelta(minutes=minute),
+                 -74.0 + minute / 100))
+    return sessionmaker(bind=engine)()
+
+
+def test_reader_fetches_one_point_past_max_points(session):
+    assert len(location_history_reader(VEHICLE_ID, max_points=3)(session)) \
+        == 4
+    assert len(location_history_reader(VEHICLE_ID, max_points=None)(
+        session)) == 5
+
+
+def test_reader_checks_the_resolution():
+    with pytest.raises(ValueError):
+        location_history_reader(VEHICLE_ID, resolution=0)
+
+
+def test_get_location_history(session):
+    movr = MovR(URL)
+    movr._read = lambda name, callback, staleness: callback(session)
+    assert len(movr.get_location_history(VEHICLE_ID, max_points=None)) == 5
+    assert movr.get_location_history(VEHICLE_ID, max_points=5)[0] == {
+        'ts': START, 'longitude': -74.0, 'latitude': 40.7, 'points': 1}
+    with pytest.raises(ValueError):
+        movr.get_location_history(VEHICLE_ID, max_points=4)
+
+
+def test_async_get_location_history(session):
+    movr = AsyncMovR(URL)
+
+    async def read(name, callback, staleness):
+        return callback(session)
+
+    movr._read = read
+    points = asyncio.run(movr.get_location_history(VEHICLE_ID,
+                                                   max_points=None))
+    assert len(points) == 5
+    with pytest.raises(ValueError):
+        asyncio.run(movr.get_location_history(VEHICLE_ID, max_points=4))
+
+
+def test_engine_is_built_on_first_use_once_per_process(monkeypatch):
+    pid = [100]
+    monkeypatch.setattr(movr_module.os, 'getpid', lambda: pid[0])
+    movr = MovR(URL, pool_size=3)
+    assert movr._engine is None  # Building MovR doesn't connect.
+
+    engine = movr.engine
+    assert engine.pool.size() == 3
+    assert movr.engine is engine
+    assert movr.sessionmaker.kw['bind'] is engine
+
+    # A forked worker gets its own engine and pool, and leaves the
+    # parent's connections alone.
+    pid[0] = 101
+    worker_engine = movr.engine
+    assert worker_engine is not engine
+    assert movr.sessionmaker.kw['bind'] is worker_engine
+    assert movr.metadata.engine is worker_engine
+    assert movr._inherited_engine is engine
+    assert movr.engine is worker_engine
+
+
+@pytest.mark.parametrize('staleness, sql', [
+    (None, 'SET TRANSACTION READ ONLY'),
+    ('strong', 'SET TRANSACTION READ ONLY'),
+    ('follower', 'SET TRANSACTION READ ONLY, '
+                 'AS OF SYSTEM TIME follower_read_timestamp()'),
+    ('-5s', "SET TRANSACTION READ ONLY, AS OF SYSTEM TIME '-5s'"),
+])
+def test_set_transaction_statement(staleness, sql):
+    assert str(set_transaction_statement(staleness)) == sql
+
+
+@pytest.mark.parametrize('staleness', ['5s', 'yesterday', "-5s'; DROP"])
+def test_unknown_staleness_is_rejected(staleness):
+    with pytest.raises(ValueError):
+        as_of_system_time(staleness)
+    with pytest.raises(ValueError):
+        MovR(URL, staleness=staleness)
+
+
+class PgError(Exception):
+    """Stands in for psycopg2's exception, with its `pgcode`."""
+
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+class ReadSession(object):
+    """Records the statements a read-only transaction ran, and how it
+    ended."""
+
+    def __init__(self):
+        self.executed = []
+        self.outcome = None
+        self.closed = False
+
+    def execute(self, statement):
+        self.executed.append(str(statement))
+
+    def commit(self):
+        self.outcome = 'commit'
+
+    def rollback(self):
+        self.outcome = 'rollback'
+
+    def close(self):
+        self.closed = True
+
+
+class ReadSessionFactory(object):
+    def __init__(self):
+        self.sessions = []
+
+    def __call__(self):
+        self.sessions.append(ReadSession())
+        return self.sessions[-1]
+
+
+def failing_reads(*pgcodes):
+    """A callback raising DBAPIErrors with `pgcodes`, then returning 'ok'."""
+    errors = list(pgcodes)
+
+    def callback(session):
+        if errors:
+            raise DBAPIError('SELECT ...', {}, PgError(errors.pop(0)))
+        return 'ok'
+    return callback
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(movr_module.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_read_only_transaction_restarts_on_40001(sleeps):
+    factory = ReadSessionFactory()
+    assert run_read_only_transaction(factory, failing_reads('40001', '40001'),
+                                     staleness='-5s') == 'ok'
+    assert [session.outcome for session in factory.sessions] == [
+        'rollback', 'rollback', 'commit']
+    assert all(session.closed for session in factory.sessions)
+    # SET TRANSACTION is the first statement of every attempt.
+    assert all(session.executed == [
+        "SET TRANSACTION READ ONLY, AS OF SYSTEM TIME '-5s'"]
+        for session in factory.sessions)
+    assert sleeps == [0.01, 0.02]
+
+
+def test_read_only_transaction_gives_up(sleeps):
+    factory = ReadSessionFactory()
+    with pytest.raises(DBAPIError):
+        run_read_only_transaction(factory, failing_reads('40001', '40001'),
+                                  max_retries=1)
+    assert len(factory.sessions) == 2
+    with pytest.raises(DBAPIError):
+        run_read_only_transaction(factory, failing_reads('42P01'))
+    assert len(factory.sessions) == 3
+
+
+def test_reads_use_the_default_staleness_unless_overridden(monkeypatch):
+    seen = []
+    monkeypatch.setattr(
+        movr_module, 'run_read_only_transaction',
+        lambda factory, callback, staleness: seen.append(staleness))
+    movr = MovR(URL, staleness='follower')
+    movr._read('get_vehicle_txn', None, None)
+    movr._read('get_vehicle_txn', None, '-10s')
+    assert seen == ['follower', '-10s']
@@ -0,0 +1,85 @@
+"""
+Tests for util/ride_statistics.py, on an in-memory SQLite location_history.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+
+from util.calculations import haversine_km
+from util.ride_statistics import RideBuilder, read_chunks
+
+START = datetime(2024, 5, 1, 12)
+VEHICLE_1 = '00000000-0000-0000-0000-000000000001'
+VEHICLE_2 = '00000000-0000-0000-0000-000000000002'
+VEHICLE_3 = '00000000-0000-0000-0000-000000000003'
+
+# (vehicle_id, minutes after START, longitude, event)
+CHECK_INS = [
+    # Two rides, each with a check-in part way through.
+    (VEHICLE_1, 0, 0.00, 'add_vehicle'),
+    (VEHICLE_1, 10, 0.00, 'start_ride'),
+    (VEHICLE_1, 15, 0.01, None),
+    (VEHICLE_1, 20, 0.03, 'end_ride'),
+    (VEHICLE_1, 30, 0.03, 'start_ride'),
+    (VEHICLE_1, 35, 0.02, None),
+    (VEHICLE_1, 40, 0.02, 'end_ride'),
+    # A ride that never ended isn't summarized, and doesn't run on into
+    # the next vehicle's rows.
+    (VEHICLE_2, 0, 1.00, 'start_ride'),
+    (VEHICLE_2, 5, 1.01, None),
+    (VEHICLE_3, 0, 2.00, 'end_ride'),
+    (VEHICLE_3, 10, 2.00, 'start_ride'),
+    (VEHICLE_3, 20, 2.05, 'end_ride'),
+]
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE location_history (id TEXT PRIMARY KEY, "
+            "vehicle_id TEXT, ts TIMESTAMP, longitude FLOAT, latitude FLOAT, "
+            "event TEXT)")
+        # Inserted newest first, so the order has to come from the query.
+        for number, (vehicle_id, minutes, longitude, event) in reversed(
+                list(enumerate(CHECK_INS))):
+            connection.exec_driver_sql(
+                "INSERT INTO location_history VALUES (?, ?, ?, ?, 0.0, ?)",
+                ('{:036d}'.format(number), vehicle_id,
+                 START + timedelta(minutes=minutes), longitude, event))
+    return engine
+
+
+def km(*longitudes):
+    return float(sum(haversine_km(longitudes[:-1], 0, longitudes[1:], 0)))
+
+
+def build(engine, chunk_size):
+    builder = RideBuilder()
+    return [ride for rows in read_chunks(engine, chunk_size)
+            for ride in builder.add_chunk(rows)]
+
+
+def test_chunks_cover_the_table_in_order(engine):
+    chunks = list(read_chunks(engine, 5))
+    assert [len(rows) for rows in chunks] == [5, 5, 2]
+    rows = [row for rows in chunks for row in rows]
+    assert [(row.vehicle_id, row.ts) for row in rows] == [
+        (vehicle_id, START + timedelta(minutes=minutes))
+        for vehicle_id, minutes, _, _ in CHECK_INS]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 100])
+def test_rides_dont_depend_on_chunk_size(engine, chunk_size):
+    rides = build(engine, chunk_size)
+    assert [ride[:3] + (ride[4],) for ride in rides] == [
+        (VEHICLE_1, START + timedelta(minutes=10),
+         START + timedelta(minutes=20), 3),
+        (VEHICLE_1, START + timedelta(minutes=30),
+         START + timedelta(minutes=40), 3),
+        (VEHICLE_3, START + timedelta(minutes=10),
+         START + timedelta(minutes=20), 2)]
+    assert [ride[3] for ride in rides] == pytest.approx(
+        [km(0.00, 0.01, 0.03), km(0.03, 0.02, 0.02), km(2.00, 2.05)])
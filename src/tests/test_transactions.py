@@ -0,0 +1,270 @@
+"""
+Tests for movr/transactions.py that don't need a cluster.
+
+Read queries run against an in-memory SQLite database with the same tables;
+statements that only CockroachDB (or Postgres) can run are checked by
+compiling them.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+from movr.transactions import (add_vehicle_txn, end_ride_txn,
+                               find_nearby_vehicles_txn, get_vehicle_txn,
+                               get_vehicles_txn, remove_vehicle_txn,
+                               start_ride_txn)
+from util.calculations import haversine_km
+from util.geohash import encode
+
+VEHICLE_IDS = ['00000000-0000-0000-0000-{:012d}'.format(number)
+               for number in range(1, 8)]
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE vehicles (id TEXT PRIMARY KEY, in_use BOOLEAN, "
+            "vehicle_type TEXT, battery INTEGER)")
+        connection.exec_driver_sql(
+            "CREATE TABLE current_locations (vehicle_id TEXT PRIMARY KEY, "
+            "ts TIMESTAMP, longitude FLOAT, latitude FLOAT, geohash TEXT)")
+        for vehicle_id in VEHICLE_IDS:
+            connection.exec_driver_sql(
+                "INSERT INTO vehicles VALUES (?, 0, 'scooter', 50)",
+                (vehicle_id,))
+            connection.exec_driver_sql(
+                "INSERT INTO current_locations VALUES "
+                "(?, ?, -74.0, 40.7, NULL)",
+                (vehicle_id, datetime(2024, 5, 1)))
+    return sessionmaker(bind=engine)()
+
+
+def page_ids(page):
+    return [vehicle['id'] for vehicle in page[0]]
+
+
+def test_first_page(session):
+    page = get_vehicles_txn(session, 3)
+    assert page_ids(page) == VEHICLE_IDS[:3]
+    assert page[1:] == (VEHICLE_IDS[2], None)
+
+
+def test_middle_page(session):
+    page = get_vehicles_txn(session, 3, after_id=VEHICLE_IDS[2])
+    assert page_ids(page) == VEHICLE_IDS[3:6]
+    assert page[1:] == (VEHICLE_IDS[5], VEHICLE_IDS[3])
+
+
+def test_last_page_has_no_next(session):
+    page = get_vehicles_txn(session, 3, after_id=VEHICLE_IDS[5])
+    assert page_ids(page) == VEHICLE_IDS[6:]
+    assert page[1:] == (None, VEHICLE_IDS[6])
+
+
+def test_exactly_full_last_page_has_no_next(session):
+    page = get_vehicles_txn(session, 3, after_id=VEHICLE_IDS[3])
+    assert page_ids(page) == VEHICLE_IDS[4:]
+    assert page[1:] == (None, VEHICLE_IDS[4])
+
+
+def test_past_the_end(session):
+    assert get_vehicles_txn(session, 3, after_id=VEHICLE_IDS[-1]) == \
+        ([], None, None)
+
+
+def test_previous_page_is_in_id_order(session):
+    page = get_vehicles_txn(session, 3, before_id=VEHICLE_IDS[6])
+    assert page_ids(page) == VEHICLE_IDS[3:6]
+    assert page[1:] == (VEHICLE_IDS[5], VEHICLE_IDS[3])
+
+
+def test_previous_page_reaching_the_start_has_no_prev(session):
+    page = get_vehicles_txn(session, 3, before_id=VEHICLE_IDS[2])
+    assert page_ids(page) == VEHICLE_IDS[:2]
+    assert page[1:] == (VEHICLE_IDS[1], None)
+
+
+def test_pages_cover_every_vehicle_once(session):
+    seen, after_id = [], None
+    while True:
+        vehicles, after_id, _ = get_vehicles_txn(session, 2,
+                                                 after_id=after_id)
+        seen.extend(vehicle['id'] for vehicle in vehicles)
+        if after_id is None:
+            break
+    assert seen == VEHICLE_IDS
+
+
+def test_get_vehicle(session):
+    assert get_vehicle_txn(session, VEHICLE_IDS[0]) == {
+        'id': VEHICLE_IDS[0], 'last_longitude': -74.0, 'last_latitude': 40.7,
+        'last_checkin': datetime(2024, 5, 1), 'in_use': False, 'battery': 50,
+        'vehicle_type': 'scooter'}
+    assert get_vehicle_txn(session, 'missing') is None
+
+
+# (longitude, latitude, in_use), north of (-74.0, 40.7) by about 0, 0.5, 1,
+# 1.5, 2.5 and 10 km.
+NEARBY = [(-74.0, 40.7, 0), (-74.0, 40.7045, 0), (-74.0, 40.709, 1),
+          (-74.0, 40.7135, 0), (-74.0, 40.7225, 0), (-74.0, 40.79, 0)]
+
+
+@pytest.fixture
+def nearby_session(session):
+    for vehicle_id, (longitude, latitude, in_use) in zip(VEHICLE_IDS, NEARBY):
+        session.execute(
+            text("UPDATE vehicles SET in_use = :in_use WHERE id = :id"),
+            {'in_use': in_use, 'id': vehicle_id})
+        session.execute(
+            text("UPDATE current_locations SET longitude = :longitude, "
+                 "latitude = :latitude, geohash = :geohash "
+                 "WHERE vehicle_id = :id"),
+            {'longitude': longitude, 'latitude': latitude,
+             'geohash': encode(longitude, latitude), 'id': vehicle_id})
+    # The seventh vehicle has no geohash, so no cell can match it.
+    return session
+
+
+def nearby_ids(vehicles):
+    return [VEHICLE_IDS.index(vehicle['id']) for vehicle in vehicles]
+
+
+def test_nearby_is_filtered_and_sorted_by_distance(nearby_session):
+    vehicles = find_nearby_vehicles_txn(nearby_session, -74.0, 40.7, 2, 10)
+    assert nearby_ids(vehicles) == [0, 1, 3]
+    for vehicle in vehicles:
+        assert vehicle['distance_km'] == round(float(haversine_km(
+            -74.0, 40.7, vehicle['last_longitude'],
+            vehicle['last_latitude'])), 3)
+    assert set(vehicles[0]) == {
+        'id', 'last_longitude', 'last_latitude', 'last_checkin', 'in_use',
+        'battery', 'vehicle_type', 'distance_km'}
+
+
+def test_nearby_returns_only_the_nearest(nearby_session):
+    vehicles = find_nearby_vehicles_txn(nearby_session, -74.0, 40.7135, 5, 2,
+                                        available_only=False)
+    assert nearby_ids(vehicles) == [3, 2]
+
+
+def test_nearby_limit_is_applied_in_sql(nearby_session):
+    statements = []
+    event.listen(nearby_session.get_bind(), 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    find_nearby_vehicles_txn(nearby_session, -74.0, 40.7, 2, 10)
+    sql = ' '.join(statements[-1].split())
+    assert 'ORDER BY' in sql
+    assert sql.endswith('LIMIT ? OFFSET ?')
+
+
+def test_nothing_nearby(nearby_session):
+    assert find_nearby_vehicles_txn(nearby_session, 0.0, 0.0, 2, 10) == []
+
+
+class RecordingSession(object):
+    """Compiles what it's asked to execute, and answers with `row`."""
+
+    def __init__(self, row=None):
+        self.row = row
+        self.sql = None
+        self.statements = []
+        self.added = []
+
+    def execute(self, statement):
+        self.sql = ' '.join(str(statement.compile(
+            dialect=postgresql.dialect())).split())
+        self.statements.append(self.sql)
+        return self
+
+    def first(self):
+        return self.row
+
+    def scalar(self):
+        return self.row
+
+    def add(self, instance):
+        self.added.append(instance)
+
+    def flush(self):
+        pass
+
+
+StartedRow = namedtuple('StartedRow', ['id', 'ts'])
+EndedRow = namedtuple('EndedRow', ['id', 'vehicle_type', 'ts'])
+
+
+def test_start_ride_is_one_guarded_statement():
+    session = RecordingSession()
+    start_ride_txn(session, VEHICLE_IDS[0])
+    sql = session.sql
+    assert sql.startswith('WITH started AS (UPDATE vehicles SET in_use=')
+    for cte in ('started', 'last_seen', 'checked_in', 'moved'):
+        assert '{} AS ('.format(cte) in sql
+    assert 'vehicles.in_use = false' in sql
+    assert 'EXISTS (SELECT * FROM location_history' in sql
+    assert 'ORDER BY location_history.ts DESC LIMIT' in sql
+    assert 'FROM started JOIN last_seen ON true' in sql
+    assert sql.count('RETURNING') == 3
+
+
+def test_start_ride_result():
+    assert start_ride_txn(RecordingSession(), VEHICLE_IDS[0]) is None
+    assert start_ride_txn(RecordingSession(StartedRow(VEHICLE_IDS[0], None)),
+                          VEHICLE_IDS[0]) is None
+    started = StartedRow(VEHICLE_IDS[0], datetime(2024, 5, 1))
+    assert start_ride_txn(RecordingSession(started), VEHICLE_IDS[0]) is True
+
+
+def test_end_ride_is_one_guarded_statement():
+    session = RecordingSession()
+    end_ride_txn(session, VEHICLE_IDS[0], -74.0, 40.7, 80)
+    sql = session.sql
+    assert sql.startswith('WITH ended AS (UPDATE vehicles SET')
+    for cte in ('ended', 'checked_in', 'moved'):
+        assert '{} AS ('.format(cte) in sql
+    assert 'vehicles.in_use = true' in sql
+    assert 'ON CONFLICT (vehicle_id) DO UPDATE SET' in sql
+    assert sql.count('RETURNING') == 3
+
+
+def test_end_ride_result():
+    assert end_ride_txn(RecordingSession(), VEHICLE_IDS[0],
+                        -74.0, 40.7, 80) is False
+    ts = datetime(2024, 5, 1)
+    session = RecordingSession(EndedRow(VEHICLE_IDS[0], 'scooter', ts))
+    assert end_ride_txn(session, VEHICLE_IDS[0], '-74.0', '40.7', 80) == {
+        'id': VEHICLE_IDS[0], 'last_longitude': -74.0, 'last_latitude': 40.7,
+        'last_checkin': ts, 'in_use': False, 'battery': 80,
+        'vehicle_type': 'scooter'}
+
+
+def test_add_vehicle_returns_the_written_state():
+    ts = datetime(2024, 5, 1)
+    session = RecordingSession(ts)
+    added = add_vehicle_txn(session, 'scooter', '-74.0', '40.7', 90)
+    vehicle_id = added['vehicle_id']
+    assert [row.id for row in session.added] == [vehicle_id]
+    assert added['vehicle'] == {
+        'id': vehicle_id, 'last_longitude': -74.0, 'last_latitude': 40.7,
+        'last_checkin': ts, 'in_use': False, 'battery': 90,
+        'vehicle_type': 'scooter'}
+    history, current = session.statements
+    assert history.startswith('INSERT INTO location_history')
+    assert history.endswith('RETURNING location_history.ts')
+    assert current.startswith('INSERT INTO current_locations')
+
+
+def test_remove_vehicle_is_one_guarded_delete():
+    session = RecordingSession()
+    assert remove_vehicle_txn(session, VEHICLE_IDS[0]) is None
+    assert session.statements == [
+        'DELETE FROM vehicles WHERE vehicles.id = %(id_1)s '
+        'AND vehicles.in_use = false RETURNING vehicles.id']
+    deleted = RecordingSession(StartedRow(VEHICLE_IDS[0], None))
+    assert remove_vehicle_txn(deleted, VEHICLE_IDS[0]) is True
@@ -0,0 +1,70 @@
+"""
+Tests for web/validation.py, the request checks both JSON APIs share.
+"""
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+import pytest
+
+from web.validation import (APIError, json_default, parse_limit,
+                            parse_new_vehicle, parse_number, parse_ride_end,
+                            parse_uuid)
+
+VEHICLE_ID = '00000000-0000-0000-0000-000000000001'
+
+
+def error_message(function, *args):
+    with pytest.raises(APIError) as error:
+        function(*args)
+    assert error.value.status == 400
+    return error.value.message
+
+
+def test_parse_uuid():
+    assert parse_uuid(VEHICLE_ID.upper()) == VEHICLE_ID
+    assert error_message(parse_uuid, 'abc') == \
+        "`abc` is not a valid vehicle id."
+
+
+def test_parse_number():
+    assert parse_number({'x': '1.5'}, 'x', 0, 2) == 1.5
+    assert parse_number({}, 'x', 0, 2, default=1.0) == 1.0
+    assert error_message(parse_number, {}, 'x', 0, 2) == "`x` is required."
+    assert error_message(parse_number, {'x': 'a'}, 'x', 0, 2) == \
+        "`x` must be a number."
+    assert error_message(parse_number, {'x': 3}, 'x', 0, 2) == \
+        "`x` must be between 0 and 2."
+
+
+def test_parse_limit():
+    assert parse_limit({}, 20) == 20
+    assert parse_limit({'limit': '1000'}, 20) == 1000
+    assert error_message(parse_limit, {'limit': '1001'}, 20) == \
+        "`limit` must be between 1 and 1000."
+
+
+def test_parse_new_vehicle():
+    assert parse_new_vehicle({'longitude': -74, 'latitude': '40.7',
+                              'battery': '90'}) == {
+        'vehicle_type': 'scooter', 'longitude': -74.0, 'latitude': 40.7,
+        'battery': 90}
+    assert error_message(parse_new_vehicle,
+                         {'vehicle_type': 'bike', 'longitude': 0,
+                          'latitude': 0, 'battery': 0}) == \
+        "Unknown vehicle type `bike`."
+
+
+def test_parse_ride_end():
+    assert parse_ride_end({'longitude': 1, 'latitude': 2, 'battery': 3}) == \
+        (1.0, 2.0, 3)
+    assert error_message(parse_ride_end, {'longitude': 1, 'latitude': 2}) == \
+        "`battery` is required."
+
+
+def test_json_default():
+    assert json_default(UUID(VEHICLE_ID)) == VEHICLE_ID
+    assert json_default(datetime(2024, 5, 1)) == '2024-05-01T00:00:00'
+    assert json_default(Decimal('1.5')) == 1.5
+    with pytest.raises(TypeError):
+        json_default(object())
@@ -2,88 +2,385 @@
 """
 Update the movr.vehicles table to rewrite the vehicle_info column into JSON.
 
+Streams a pipe (`|`) delimited CSV of `id|json` rows and writes them in
+batches, one parameterized `UPDATE ... FROM (VALUES ...)` statement per batch.
+Batches are dealt round-robin to worker processes through bounded queues, so
+the reader blocks when the workers fall behind and memory use stays flat no
+matter how large the file is.
+
+Progress is checkpointed to a local state file: the last committed batch of
+each worker's partition, plus any batches that failed. Re-running with the
+same options skips committed batches and retries failed ones.
+
 Usage:
     ./add_vehicle_json_data.py [options]
 
 Options:
     -h --help               Show this text.
     --url <url>             URL given by CockroachCloud.
-    -n <num>                Number of prarallel processes to use [default: 30]
+    --file <path>           Read the CSV from a local file instead of the
+                                public course URL. The file is memory-mapped
+                                when possible.
+    -n <num>                Number of worker processes [default: 4]
+    --queue-size <number>   Batches buffered per worker [default: 2]
+    --batch-size <number>   Rows per UPDATE statement [default: 500]
+    --max-retries <number>  Retries per batch on serialization errors
+                                [default: 10]
+    --state <path>          Checkpoint file used to resume an interrupted run
+                                [default: add_vehicle_json_data.state.json]
+    --fresh                 Ignore (and overwrite) an existing state file.
 """
 
+import codecs
 import csv
-from multiprocessing import Process
-
+import json
+import mmap
+import os
+import queue
+import time
+import urllib.request
 from datetime import datetime
+from multiprocessing import Process, Queue
+
 from docopt import docopt
-import urllib.request
-import codecs
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 
 import connect_with_sqlalchemy as sqla
 
+CSV_URL = ("https://cockroach-university-public.s3.amazonaws.com/"
+           "10000row_json_column.csv")
+
+# SQLSTATE CockroachDB uses to ask the client to retry the transaction.
+RETRY_SQLSTATE = '40001'
 
-def update_row(engine, table_name, primary_key, column_to_update, new_value):
+
+def read_rows(filename=None):
     """
-    Performs an update of a row in the database.
+    Streams (primary_key, json) pairs from the CSV, one row at a time.
 
     Inputs
     ------
-    engine (sqlalchemy.engine.base.Engine): SQLAlchemy engine connected to a
-        CockroachDB cluster.
-    table_name (string): Name of the table you are updating
-    primary_key (string): Representation of the UUID for id of the row.
-    column_name (string): Name of the column you're working with.
-    new_value (string): String representation of the new value you're adding
-        to the row.
+    filename (str): Path to a local CSV. If None, the public course CSV is
+        streamed over HTTP. Either way it should be pipe (`|`) delimited and
+        include only the Primary Key (in string format) and the JSON data you
+        want to add in the new column.
+    """
+    if filename is None:
+        stream = codecs.iterdecode(urllib.request.urlopen(CSV_URL), 'utf-8')
+        for row in csv.reader(stream, delimiter='|'):
+            yield row[0], row[1]
+        return
+
+    for row in csv.reader(read_lines(filename), delimiter='|'):
+        yield row[0], row[1]
+
 
+def read_lines(filename):
     """
-    return engine.execute(("UPDATE {table} SET {column} = '{value}' "
-                           "WHERE id = '{primary_key_value}'"
-                           ).format(table=table_name, column=column_to_update,
-                                    primary_key_value=primary_key,
-                                    value=new_value))
+    Yields the decoded lines of a local file, memory-mapping it if possible.
 
+    Mapping lets the OS page the file in and out on demand instead of copying
+    it through Python's read buffers. Empty files and files that can't be
+    mapped (pipes, some network filesystems) are read normally instead.
+    """
+    with open(filename, 'rb') as raw_file:
+        try:
+            mapped = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            for line in raw_file:
+                yield line.decode('utf-8')
+            return
+
+        with mapped:
+            for line in iter(mapped.readline, b''):
+                yield line.decode('utf-8')
 
-def import_csv():
+
+def batched(rows, batch_size):
+    """
+    Groups an iterable of rows into lists of at most `batch_size` rows.
     """
-    Imports a CSV and returns a dictionary of key: value pairs.
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    Inputs
-    ------
-    filename (str): name of the CSV file. This should be pipe (`|`) delimited
-        and include only the Primary Key (in string format) and the JSON data
-        you want to add in the new column
+
+def build_batch_update(table_name, column_to_update, batch):
+    """
+    Builds one parameterized UPDATE for a whole batch of rows.
+
+    UPDATE <table> AS t SET <column> = CAST(d.value AS JSONB)
+      FROM (VALUES (:id_0, :value_0), (:id_1, :value_1), ...) AS d (id, value)
+     WHERE t.id = CAST(d.id AS UUID);
+
+    Only the table and column names are formatted into the SQL; every value
+    is a bind parameter.
+
+    Returns
+    -------
+    (statement (sqlalchemy.sql.elements.TextClause), parameters (dict))
     """
-    id_to_json = {}
+    placeholders = []
+    parameters = {}
+    for i, (primary_key, new_value) in enumerate(batch):
+        placeholders.append("(:id_{i}, :value_{i})".format(i=i))
+        parameters['id_{}'.format(i)] = primary_key
+        parameters['value_{}'.format(i)] = new_value
+
+    statement = text(("UPDATE {table} AS t "
+                      "SET {column} = CAST(d.value AS JSONB) "
+                      "FROM (VALUES {values}) AS d (id, value) "
+                      "WHERE t.id = CAST(d.id AS UUID)"
+                      ).format(table=table_name, column=column_to_update,
+                               values=", ".join(placeholders)))
+    return statement, parameters
 
-    url = "https://cockroach-university-public.s3.amazonaws.com/10000row_json_column.csv"
-    ftpstream = urllib.request.urlopen(url)
-    csvfile = csv.reader(codecs.iterdecode(ftpstream, 'utf-8'), delimiter='|')
 
-    for row in csvfile:
-        id_to_json[row[0]] = row[1]
-        
-    return id_to_json
+def is_retryable(error):
+    """
+    Checks if a database error is a serialization failure worth retrying.
+    """
+    return getattr(error.orig, 'pgcode', None) == RETRY_SQLSTATE
 
 
-def subdivide_dict(dictionary, num_subdivisions):
+def execute_with_retry(engine, statement, parameters, max_retries):
     """
-    Distributes the k: v pairs in dict to N dicts.
+    Runs a statement in its own transaction, retrying serialization errors.
+
+    Backs off exponentially between attempts, starting at 10ms.
+
+    Returns
+    -------
+    retries (int): Number of times the statement had to be retried.
     """
-    subdicts = [{} for i in range(num_subdivisions)]
-    for i, k in enumerate(dictionary.keys()):
-        sub_index = i % num_subdivisions
-        subdicts[sub_index][k] = dictionary[k]
-    return subdicts
+    for retries in range(max_retries + 1):
+        try:
+            with engine.begin() as connection:
+                connection.execute(statement, parameters)
+            return retries
+        except DBAPIError as error:
+            if not is_retryable(error) or retries == max_retries:
+                raise
+            time.sleep(0.01 * 2 ** retries)
 
 
-def update_csv(one_csv, table_name, column_to_update, sqla_url):
+def update_worker(batches, results, sqla_url, table_name, column_to_update,
+                  max_retries):
     """
-    Updates a column of a dict based on another column.
+    Worker process: writes batches from its queue until it reads `None`.
+
+    Queue items are (batch_index, batch) pairs. Each batch is reported on
+    `results` as (batch_index, rows, retries, failed), so a batch that exhausts
+    its retries doesn't take the worker down with it.
     """
     engine = sqla.build_engine(sqla_url)
-    for k, v in one_csv.items():
-        result = update_row(engine, table_name, k, column_to_update, v)
+    for batch_index, batch in iter(batches.get, None):
+        statement, parameters = build_batch_update(table_name,
+                                                   column_to_update, batch)
+        try:
+            retries = execute_with_retry(engine, statement, parameters,
+                                         max_retries)
+            results.put((batch_index, len(batch), retries, False))
+        except DBAPIError as error:
+            print("  Batch {} ({} rows) failed: {}".format(
+                batch_index, len(batch), error))
+            results.put((batch_index, len(batch), 0, True))
+    engine.dispose()
+
+
+def put_with_backpressure(batches, batch, worker):
+    """
+    Blocks until the worker's bounded queue has room for `batch`.
+
+    Gives up if the worker has died, rather than waiting on it forever.
+    """
+    while True:
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if not worker.is_alive():
+                raise RuntimeError(("Worker {} exited with code {} before "
+                                    "finishing its batches."
+                                    ).format(worker.name, worker.exitcode))
+
+
+class Checkpoint:
+    """
+    Tracks which batches are committed, and saves that to a JSON state file.
+
+    Worker `p` handles batches `p`, `p + n`, `p + 2n`, ... in order, so the
+    highest committed batch index of each partition is enough to know which
+    of its batches are done. Failed batches are listed separately so the next
+    run retries them.
+    """
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.committed = {}
+        self.failed = set()
+
+    @classmethod
+    def load(cls, path, settings, fresh=False):
+        """
+        Reads the state file at `path`, if there is one.
+
+        `settings` (source, batch size and partition count) must match the
+            saved run's, or the batch numbering wouldn't line up.
+        """
+        checkpoint = cls(path, settings)
+        if fresh or not os.path.exists(path):
+            return checkpoint
+
+        with open(path) as state_file:
+            state = json.load(state_file)
+        if state['settings'] != settings:
+            raise SystemExit(("State file `{path}` was written with "
+                              "{saved}, but this run uses {current}. Re-run "
+                              "with the same options, or pass --fresh to "
+                              "start over.").format(path=path,
+                                                    saved=state['settings'],
+                                                    current=settings))
+        checkpoint.committed = {int(partition): batch_index for
+                                partition, batch_index in
+                                state['committed'].items()}
+        checkpoint.failed = set(state['failed'])
+        return checkpoint
+
+    def partition(self, batch_index):
+        """The worker partition a batch belongs to."""
+        return batch_index % self.settings['num_partitions']
+
+    def is_done(self, batch_index):
+        """Checks if a batch was committed by an earlier run."""
+        return (batch_index not in self.failed
+                and batch_index <= self.committed.get(
+                    self.partition(batch_index), -1))
+
+    def record(self, batch_index, failed):
+        """Marks a batch committed or failed, and saves the state file."""
+        if failed:
+            self.failed.add(batch_index)
+        else:
+            self.failed.discard(batch_index)
+            partition = self.partition(batch_index)
+            self.committed[partition] = max(
+                batch_index, self.committed.get(partition, -1))
+        self.save()
+
+    def save(self):
+        """Writes the state file atomically, so a crash can't corrupt it."""
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as state_file:
+            json.dump({'settings': self.settings,
+                       'committed': self.committed,
+                       'failed': sorted(self.failed)}, state_file)
+        os.replace(temporary_path, self.path)
+
+
+class Progress:
+    """
+    Tallies worker results, checkpoints them, and prints rows/sec.
+    """
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.batches = 0
+        self.rows = 0
+        self.retries = 0
+        self.retried = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start = time.monotonic()
+
+    def skip(self, rows):
+        """Counts rows from a batch an earlier run already committed."""
+        self.skipped += rows
+
+    def record(self, batch_index, rows, retries, failed):
+        """Adds one batch's result to the tally and prints the totals."""
+        self.checkpoint.record(batch_index, failed)
+        self.batches += 1
+        self.rows += rows
+        self.retries += retries
+        if retries:
+            self.retried += rows
+        if failed:
+            self.failed += rows
+        print("  ... {rows} rows, {rate:.0f} rows/sec, {retries} retries, "
+              "{failed} failed".format(
+                  rows=self.rows,
+                  rate=self.rows / (time.monotonic() - self.start),
+                  retries=self.retries, failed=self.failed))
+
+    def drain(self, results):
+        """Records every result that's already waiting, without blocking."""
+        while True:
+            try:
+                self.record(*results.get_nowait())
+            except queue.Empty:
+                return
+
+    def wait_for(self, results, batch_count, workers):
+        """Blocks until `batch_count` batches have reported in."""
+        while self.batches < batch_count:
+            try:
+                self.record(*results.get(timeout=1))
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("All workers exited with {} batches "
+                                       "unreported.".format(
+                                           batch_count - self.batches))
+
+
+def update_in_parallel(rows, sqla_url, table_name, column_to_update,
+                       batch_size, max_retries, num_processes, queue_size,
+                       checkpoint):
+    """
+    Deals batches of `rows` round-robin to `num_processes` workers.
+
+    At most `queue_size` batches wait in each worker's queue, so roughly
+    `num_processes * (queue_size + 1) * batch_size` rows are in memory at
+    once, however long the input is. Batches `checkpoint` marks as done are
+    read but not sent.
+
+    Returns
+    -------
+    progress (Progress): Final tally of rows, retries and failed rows.
+    """
+    results = Queue()
+    queues = [Queue(maxsize=queue_size) for _ in range(num_processes)]
+    workers = [Process(target=update_worker,
+                       args=(batches, results, sqla_url, table_name,
+                             column_to_update, max_retries))
+               for batches in queues]
+    for worker in workers:
+        worker.start()
+
+    progress = Progress(checkpoint)
+    batch_count = 0
+    for batch_index, batch in enumerate(batched(rows, batch_size)):
+        if checkpoint.is_done(batch_index):
+            progress.skip(len(batch))
+            continue
+        partition = checkpoint.partition(batch_index)
+        put_with_backpressure(queues[partition], (batch_index, batch),
+                              workers[partition])
+        batch_count += 1
+        progress.drain(results)
+
+    for batches, worker in zip(queues, workers):
+        put_with_backpressure(batches, None, worker)
+
+    progress.wait_for(results, batch_count, workers)
+    for worker in workers:
+        worker.join()
+    return progress
 
 
 def main():
@@ -94,30 +391,37 @@ def main():
     sqla_url = sqla.build_sqla_connection_string(url)
     engine = sqla.build_engine(sqla_url)
     sqla.test_connection(engine)
+    engine.dispose()  # Workers build their own; don't fork open connections.
 
-    num_processes = int(opts['-n'])
-    # import CSV & update columns
-    my_csv = import_csv()
-    sub_csvs = subdivide_dict(my_csv, num_processes)
     table_name = "movr.vehicles"
     column_to_update = "vehicle_info"
-    processes = []
 
-    # break up the workload among N processes
-    for csv_partition in sub_csvs:
-        p = Process(target=update_csv, args=(csv_partition, table_name,
-                                             column_to_update, sqla_url))
-        processes.append(p)
-        p.start()
+    batch_size = int(opts['--batch-size'])
+    num_processes = int(opts['-n'])
+    settings = {'source': opts['--file'] or CSV_URL,
+                'batch_size': batch_size,
+                'num_partitions': num_processes}
+    checkpoint = Checkpoint.load(opts['--state'], settings,
+                                 fresh=opts['--fresh'])
 
     start_time = datetime.now()
     print("Started at: {}".format(start_time))
-    for p in processes:
-        p.join()
+    progress = update_in_parallel(
+        read_rows(opts['--file']), sqla_url, table_name, column_to_update,
+        batch_size, int(opts['--max-retries']), num_processes,
+        int(opts['--queue-size']), checkpoint)
 
     end_time = datetime.now()
     print("Ended at: {}".format(end_time))
     duration = end_time - start_time
+    print("Updated {} rows.".format(progress.rows - progress.failed))
+    print("  Skipped (committed by an earlier run): {}".format(
+        progress.skipped))
+    print("  Retried: {} ({} retries)".format(progress.retried,
+                                              progress.retries))
+    print("  Failed: {}".format(progress.failed))
+    if progress.failed:
+        print("Re-run with the same options to retry the failed batches.")
     print("Total time: {}".format(duration))
 
 
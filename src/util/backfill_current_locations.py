@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Builds the movr.current_locations projection from movr.location_history.
+
+Walks the vehicles table in primary key order, a batch at a time, and upserts
+each vehicle's most recent location_history row, with its geohash. Safe to
+re-run; safe to run while the app is serving traffic.
+
+Run from the `src` directory:
+    python -m util.backfill_current_locations --url <url> [options]
+
+Usage:
+    backfill_current_locations.py --url <url> [options]
+    backfill_current_locations.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             URL given by CockroachCloud.
+    --batch-size <number>   Vehicles per transaction [default: 500]
+"""
+
+from datetime import datetime
+
+from docopt import docopt
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_cockroachdb import run_transaction
+
+from util.connect_with_sqlalchemy import (build_engine,
+                                          build_sqla_connection_string,
+                                          test_connection)
+
+# Smaller than every UUID, so the first batch starts at the beginning.
+_FIRST_VEHICLE_ID = '00000000-0000-0000-0000-000000000000'
+
+_NEXT_VEHICLE_IDS = text(
+    "SELECT id FROM vehicles WHERE id > CAST(:after_id AS UUID) "
+    "ORDER BY id LIMIT :batch_size")
+
+_UPSERT_LATEST_LOCATIONS = text(
+    "UPSERT INTO current_locations (vehicle_id, ts, longitude, latitude, "
+    "geohash) "
+    "SELECT DISTINCT ON (vehicle_id) vehicle_id, ts, longitude, latitude, "
+    "st_geohash(st_makepoint(longitude, latitude), 9) "
+    "FROM location_history "
+    "WHERE vehicle_id BETWEEN CAST(:first_id AS UUID) "
+    "AND CAST(:last_id AS UUID) "
+    "ORDER BY vehicle_id, ts DESC")
+
+
+def backfill_batch_txn(session, after_id, batch_size):
+    """
+    Upserts current_locations for the next `batch_size` vehicles.
+
+    Inputs
+    ------
+    session (sqlalchemy.orm.session.Session): The active session.
+    after_id (str): Only vehicles with an id greater than this are handled.
+    batch_size (int): Maximum number of vehicles handled.
+
+    Returns
+    -------
+    (last_id, count): Id of the last vehicle handled (None when there are no
+        vehicles left) and the number of vehicles handled.
+    """
+    vehicle_ids = [str(row.id) for row in session.execute(
+        _NEXT_VEHICLE_IDS, {'after_id': after_id, 'batch_size': batch_size})]
+    if not vehicle_ids:
+        return None, 0
+
+    session.execute(_UPSERT_LATEST_LOCATIONS, {'first_id': vehicle_ids[0],
+                                               'last_id': vehicle_ids[-1]})
+    return vehicle_ids[-1], len(vehicle_ids)
+
+
+def backfill(engine, batch_size):
+    """
+    Runs `backfill_batch_txn` until every vehicle has been handled.
+
+    Each batch is its own transaction, so a failure only loses the batch in
+    flight; re-running the command repeats work but never corrupts it.
+    """
+    session_factory = sessionmaker(bind=engine)
+    after_id = _FIRST_VEHICLE_ID
+    total = 0
+    while True:
+        last_id, count = run_transaction(
+            session_factory,
+            lambda session: backfill_batch_txn(session, after_id, batch_size))
+        if last_id is None:
+            return total
+        total += count
+        after_id = last_id
+        print("  ... {} vehicles backfilled (through `{}`).".format(total,
+                                                                  last_id))
+
+
+def main():
+    opts = docopt(__doc__)
+
+    sqla_url = build_sqla_connection_string(opts['--url'])
+    engine = build_engine(sqla_url)
+    test_connection(engine)
+
+    start_time = datetime.now()
+    print("Started at: {}".format(start_time))
+    total = backfill(engine, int(opts['--batch-size']))
+
+    end_time = datetime.now()
+    print("Backfilled {} vehicles.".format(total))
+    print("Total time: {}".format(end_time - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,14 @@
+import numpy as np
 from geopy.distance import distance
 
+# Mean Earth radius (IUGG), used by the haversine formula.
+EARTH_RADIUS_KM = 6371.0088
+
+# WGS-84 ellipsoid, used by Vincenty's formula (as geopy's geodesic is).
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B_KM = WGS84_A_KM * (1 - WGS84_F)
+
 
 def calculate_distance(longitude_1, latitude_1, longitude_2, latitude_2):
     """
@@ -40,12 +49,17 @@ def calculate_duration_hours(start_time, end_time):
 
 
 def calculate_velocity(start_longitude, start_latitude, start_time,
-                       end_longitude, end_latitude, end_time):
+                       end_longitude, end_latitude, end_time,
+                       distance_traveled=None):
     """
     Finds the magnitude of the velicty, in kilometers per hour.
+
+    Pass `distance_traveled` (km) if you've already measured it, to skip
+    computing the same geodesic distance twice.
     """
-    distance_traveled = calculate_distance(start_longitude, start_latitude,
-                                           end_longitude, end_latitude)
+    if distance_traveled is None:
+        distance_traveled = calculate_distance(start_longitude, start_latitude,
+                                               end_longitude, end_latitude)
     duration = calculate_duration_hours(start_time, end_time)
     if duration == 0:
         raise ValueError("Cannot calculate an average velocity when the time"
@@ -53,6 +67,242 @@ def calculate_velocity(start_longitude, start_latitude, start_time,
     return distance_traveled / duration
 
 
+def haversine_km(longitudes_1, latitudes_1, longitudes_2, latitudes_2):
+    """
+    Great-circle distances, in km, between arrays of points on a sphere.
+
+    Within about 0.5% of the ellipsoidal distance, and much cheaper than it.
+
+    Inputs
+    ------
+
+    longitudes_1, latitudes_1 (array-like): Coordinates of the first points,
+        in degrees.
+
+    longitudes_2, latitudes_2 (array-like): Coordinates of the second points,
+        in degrees. Broadcast against the first points.
+
+    Returns
+    -------
+
+    numpy.ndarray of distances in kilometers.
+    """
+    lon_1, lat_1, lon_2, lat_2 = (np.radians(np.asarray(values, dtype=float))
+                                  for values in (longitudes_1, latitudes_1,
+                                                 longitudes_2, latitudes_2))
+    half_chord = (np.sin((lat_2 - lat_1) / 2) ** 2
+                  + np.cos(lat_1) * np.cos(lat_2)
+                  * np.sin((lon_2 - lon_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(half_chord, 0, 1)))
+
+
+def vincenty_km(longitudes_1, latitudes_1, longitudes_2, latitudes_2,
+                max_iterations=200, tolerance=1e-12):
+    """
+    Ellipsoidal (WGS-84) distances, in km, between arrays of points.
+
+    Vectorized form of Vincenty's inverse formula: every pair is iterated
+    together, and pairs drop out of the update as they converge. Nearly
+    antipodal pairs that don't converge come back as NaN.
+
+    Inputs
+    ------
+
+    longitudes_1, latitudes_1 (array-like): Coordinates of the first points,
+        in degrees.
+
+    longitudes_2, latitudes_2 (array-like): Coordinates of the second points,
+        in degrees. Broadcast against the first points.
+
+    Returns
+    -------
+
+    numpy.ndarray of distances in kilometers.
+    """
+    lon_1, lat_1, lon_2, lat_2 = np.broadcast_arrays(
+        *(np.radians(np.asarray(values, dtype=float))
+          for values in (longitudes_1, latitudes_1, longitudes_2,
+                         latitudes_2)))
+    reduced_1 = np.arctan((1 - WGS84_F) * np.tan(lat_1))
+    reduced_2 = np.arctan((1 - WGS84_F) * np.tan(lat_2))
+    sin_u1, cos_u1 = np.sin(reduced_1), np.cos(reduced_1)
+    sin_u2, cos_u2 = np.sin(reduced_2), np.cos(reduced_2)
+
+    lon_difference = lon_2 - lon_1
+    lambda_ = lon_difference.copy()
+    sin_sigma = np.zeros_like(lambda_)
+    cos_sigma = np.ones_like(lambda_)
+    sigma = np.zeros_like(lambda_)
+    cos_sq_alpha = np.ones_like(lambda_)
+    cos_2sigma_m = np.zeros_like(lambda_)
+    active = np.ones(lambda_.shape, dtype=bool)
+
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+        new_sin_sigma = np.hypot(cos_u2 * sin_lambda,
+                                 cos_u1 * sin_u2
+                                 - sin_u1 * cos_u2 * cos_lambda)
+        new_cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+        new_sigma = np.arctan2(new_sin_sigma, new_cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(new_sin_sigma == 0, 0.0,
+                                 cos_u1 * cos_u2 * sin_lambda
+                                 / new_sin_sigma)
+            new_cos_sq_alpha = 1 - sin_alpha ** 2
+            # Both points on the equator: cos_2sigma_m is undefined; use 0.
+            new_cos_2sigma_m = np.where(
+                new_cos_sq_alpha == 0, 0.0,
+                new_cos_sigma - 2 * sin_u1 * sin_u2 / new_cos_sq_alpha)
+        c = WGS84_F / 16 * new_cos_sq_alpha * (4 + WGS84_F
+                                               * (4 - 3 * new_cos_sq_alpha))
+        new_lambda = lon_difference + (1 - c) * WGS84_F * sin_alpha * (
+            new_sigma + c * new_sin_sigma * (
+                new_cos_2sigma_m + c * new_cos_sigma
+                * (-1 + 2 * new_cos_2sigma_m ** 2)))
+
+        sin_sigma = np.where(active, new_sin_sigma, sin_sigma)
+        cos_sigma = np.where(active, new_cos_sigma, cos_sigma)
+        sigma = np.where(active, new_sigma, sigma)
+        cos_sq_alpha = np.where(active, new_cos_sq_alpha, cos_sq_alpha)
+        cos_2sigma_m = np.where(active, new_cos_2sigma_m, cos_2sigma_m)
+        converged = np.abs(new_lambda - lambda_) <= tolerance
+        lambda_ = np.where(active, new_lambda, lambda_)
+        active &= ~converged
+
+    u_sq = cos_sq_alpha * (WGS84_A_KM ** 2 - WGS84_B_KM ** 2) / WGS84_B_KM ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+        - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2)
+        * (-3 + 4 * cos_2sigma_m ** 2)))
+    distances = WGS84_B_KM * a * (sigma - delta_sigma)
+    return np.where(active, np.nan, distances)
+
+
+DISTANCE_METHODS = {'haversine': haversine_km, 'vincenty': vincenty_km}
+
+
+def calculate_distances(longitudes_1, latitudes_1, longitudes_2, latitudes_2,
+                        method='haversine'):
+    """
+    Distances, in km, between arrays of points.
+
+    Inputs
+    ------
+
+    method (str): 'haversine' (fast, spherical) or 'vincenty' (ellipsoidal).
+    """
+    try:
+        distance_function = DISTANCE_METHODS[method]
+    except KeyError:
+        raise ValueError("Unknown distance method `{}`; expected one of {}."
+                         .format(method, sorted(DISTANCE_METHODS)))
+    return distance_function(longitudes_1, latitudes_1, longitudes_2,
+                             latitudes_2)
+
+
+def calculate_path_distances(longitudes, latitudes, method='haversine'):
+    """
+    Distances, in km, between consecutive points of a path.
+
+    Returns
+    -------
+
+    numpy.ndarray one element shorter than the inputs. Sum it for the path
+        length.
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    return calculate_distances(longitudes[:-1], latitudes[:-1],
+                               longitudes[1:], latitudes[1:], method=method)
+
+
+def calculate_durations_hours(start_times, end_times):
+    """
+    Elapsed hours between arrays of datetimes (or numpy datetime64s).
+    """
+    start_times = np.asarray(start_times, dtype='datetime64[us]')
+    end_times = np.asarray(end_times, dtype='datetime64[us]')
+    return (end_times - start_times) / np.timedelta64(1, 'h')
+
+
+def calculate_speeds(distances_km, durations_hours):
+    """
+    Average speeds, in km/h. Zero-length intervals give NaN rather than
+        raising, so one bad pair doesn't sink a whole batch.
+    """
+    distances_km = np.asarray(distances_km, dtype=float)
+    durations_hours = np.asarray(durations_hours, dtype=float)
+    speeds = np.full(np.broadcast(distances_km, durations_hours).shape,
+                     np.nan)
+    np.divide(distances_km, durations_hours, out=speeds,
+              where=durations_hours != 0)
+    return speeds
+
+
+def simplify_path(longitudes, latitudes, tolerance_km):
+    """
+    Douglas-Peucker simplification: keeps the points needed to draw a path
+        to within `tolerance_km` of the original.
+
+    Distances are measured on an equirectangular projection centered on the
+    path, which is accurate to well under 1% over the few hundred kilometers
+    a vehicle covers.
+
+    Inputs
+    ------
+
+    longitudes, latitudes (array-like): The path's points, in order, in
+        degrees.
+
+    tolerance_km (float): Largest distance a dropped point may be from the
+        simplified path.
+
+    Returns
+    -------
+
+    numpy.ndarray of the indices of the points to keep, in order. The first
+        and last points are always kept.
+    """
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+    count = len(longitudes)
+    if count <= 2:
+        return np.arange(count)
+
+    km_per_degree = np.radians(1) * EARTH_RADIUS_KM
+    # Unwrap longitudes so a path over the antimeridian stays continuous.
+    unwrapped = np.degrees(np.unwrap(np.radians(longitudes)))
+    x = unwrapped * km_per_degree * np.cos(np.radians(np.mean(latitudes)))
+    y = latitudes * km_per_degree
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:  # Iterative, so long paths can't hit the recursion limit.
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length_sq = dx * dx + dy * dy
+        # Distance to the segment (not the infinite line), so points beyond
+        # either end are measured to that end.
+        t = (np.clip((px * dx + py * dy) / length_sq, 0, 1)
+             if length_sq > 0 else 0.0)
+        distances = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_km:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep)
+
+
 def generate_end_ride_messages(vehicle_at_start, vehicle_at_end):
     """
     End this ride.
@@ -85,7 +335,8 @@ def generate_end_ride_messages(vehicle_at_start, vehicle_at_end):
     ride_minutes = round(calculate_duration_minutes(start_time, end_time), 2)
     average_velocity = round(calculate_velocity(start_longitude, start_latitude,
                                                 start_time, end_longitude,
-                                                end_latitude, end_time), 2)
+                                                end_latitude, end_time,
+                                                distance_traveled), 2)
 
     # Redirect to vehicles & notify user of ride summary.
     messages = [("You have completed your ride on vehicle {id}."
@@ -19,7 +19,7 @@ from os.path import expanduser
 from urllib.parse import parse_qs, urlparse
 
 from docopt import docopt
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
 
@@ -38,9 +38,10 @@ def show_databases(engine):
 
     Returns
     -------
-    Databases (sqlalchemy.engine.result.ResultProxy)
+    Databases (list of sqlalchemy.engine.Row)
     """
-    return engine.execute("SHOW DATABASES")
+    with engine.connect() as connection:
+        return connection.execute(text("SHOW DATABASES")).fetchall()
 
 
 def print_error_text(error):
@@ -213,17 +214,18 @@ def test_connection(engine):
                         "Original error text:\n\n----------{}".format(error))
 
 
-def get_database(url):
+def get_database(url, interactive=True):
     """
     Parses the database from the url.
 
     This is done because `defaultdb` is the database given by the url string,
         but often a script will require a database name that is linked to its
-        purpose. This script gives the user a chance to change it.
+        purpose. This script gives the user a chance to change it (unless
+        `interactive` is False).
     """
     parsed_url = urlparse(url)
     database = parsed_url.path[1:]  # '/dbname' -> 'dbname'
-    if database == 'defaultdb':
+    if database == 'defaultdb' and interactive:
         input_db = input("WARNING: Your database is listed as defaultdb. "
                          "Please input another (such as `movr` if this was a "
                          "mistake. (hit enter to keep it as `defaultdb`).\n")
@@ -234,9 +236,14 @@ def get_database(url):
     return database
 
 
-def build_sqla_connection_string(cockroach_cloud_url, timeout=10):
+def build_sqla_connection_string(cockroach_cloud_url, timeout=10,
+                                 interactive=True):
     """
     Builds a connection string for a SQLAlchemy engine from the CC url.
+
+    Missing pieces (the password, the certs directory) are asked for on the
+        command line. With `interactive=False` they raise a ValueError
+        instead, for servers that have no one to ask.
     """
     cloud_parse = urlparse(cockroach_cloud_url)
     if (
@@ -248,11 +255,12 @@ def build_sqla_connection_string(cockroach_cloud_url, timeout=10):
 
     scheme = 'cockroachdb'
     username = cloud_parse.username
-    password = prevalidate_password(cloud_parse.password)
+    password = prevalidate_password(cloud_parse.password, interactive)
     hostname = cloud_parse.hostname
     port = cloud_parse.port
-    database = get_database(cockroach_cloud_url)
-    querystring = build_querystring(cloud_parse.query, connect_timeout=timeout)
+    database = get_database(cockroach_cloud_url, interactive)
+    querystring = build_querystring(cloud_parse.query, connect_timeout=timeout,
+                                    interactive=interactive)
 
     sqla_url = ('{scheme}://{username}:{password}@{hostname}:{port}/'
                 '{database}?{querystring}'
@@ -263,7 +271,7 @@ def build_sqla_connection_string(cockroach_cloud_url, timeout=10):
     return sqla_url
 
 
-def build_querystring(query, connect_timeout=10):
+def build_querystring(query, connect_timeout=10, interactive=True):
     """
     Cleans the querystring for SQLAlchemy from the cockroach sql querystring.
 
@@ -279,6 +287,9 @@ def build_querystring(query, connect_timeout=10):
                               "querystring parameter.").format(field=field,
                                                                value=value))
     if '<certs_dir>' in query:  # they didn't set it locally
+        if not interactive:
+            raise ValueError("Replace '<certs_dir>' in the connection string "
+                             "with the directory holding the .crt file.")
         print("String literal '<certs_dir>' found for .crt directory.")
         query = query.replace('<certs_dir>', get_certs_dir())
 
@@ -304,10 +315,12 @@ def get_certs_dir():
     return input("  Input directory where the .ca cert is located: ")
 
 
-def prevalidate_password(password):
+def prevalidate_password(password, interactive=True):
     """
     Parses password & asks user to re-input if it looks fishy.
     """
+    if not interactive and password in (None, '<password>'):
+        raise ValueError("The connection string has no password.")
     if password is None:
         return get_password()
     if password == '<password>':
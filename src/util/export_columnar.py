@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Exports movr.vehicles and movr.location_history to compressed columnar
+files (Parquet or Arrow IPC) for analytics.
+
+Rows are streamed through a server-side cursor, --chunk-size at a time, and
+written as they arrive, so memory use doesn't depend on the table size.
+location_history is written as a Hive-style partitioned dataset, one
+directory per day (`day=2024-05-01/`) or per first hex digit of the vehicle
+id (`vehicle_prefix=a/`), which pyarrow.dataset, DuckDB and Spark can read
+directly. Grouping vehicles keeps a run to at most 16 files however many
+vehicles the fleet has; within a file rows are sorted by vehicle, so
+Parquet's row-group statistics still let readers skip most of it when
+looking for one vehicle. vehicles is small and has no timestamp, so each run
+rewrites it as a single file.
+
+Exports are incremental on `ts`. Each run exports location_history rows
+newer than the last run's high-water mark (kept in --state-file) and no
+newer than --lag seconds ago, so transactions still in flight when the run
+starts are picked up by the next one. Each run adds one new file per
+partition it touches. Files are written to a staging directory and moved
+into place before the state file is updated, so an interrupted run leaves
+the dataset and the high-water mark as they were. Rows that arrive with a
+`ts` older than the high-water mark (late, batched device pings) aren't
+picked up; re-export with --full, or from an earlier --since, to include
+them.
+
+Needs pyarrow, which isn't in requirement.txt. From the `src` directory:
+    pip install -r ../requirements-export.txt
+
+Run from the `src` directory:
+    python -m util.export_columnar --url <url> --output <dir> [options]
+
+Usage:
+    export_columnar.py --url <url> --output <dir> [options]
+    export_columnar.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             URL given by CockroachCloud.
+    --output <dir>          Directory the datasets are written to.
+    --format <format>       parquet or arrow [default: parquet]
+    --compression <codec>   zstd, lz4, snappy or gzip (snappy and gzip are
+                                Parquet only) [default: zstd]
+    --partition-by <key>    Partition location_history by day or vehicle
+                                (id prefix) [default: day]
+    --chunk-size <number>   Rows fetched from the cursor at a time
+                                [default: 50000]
+    --state-file <file>     Where the high-water mark is kept. Defaults to
+                                export_state.json in --output.
+    --since <ts>            Export location_history rows after this ISO 8601
+                                timestamp, instead of the saved mark.
+    --full                  Ignore the saved mark and export everything.
+    --lag <secs>            Leave rows this recent for the next run
+                                [default: 60]
+    --staleness <mode>      Read as of this long ago (see MovR's staleness),
+                                so the export doesn't contend with writes
+                                [default: -10s]
+"""
+
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from docopt import docopt
+from sqlalchemy import Boolean, DateTime, Float, Integer, select
+from sqlalchemy.sql.expression import func
+
+from movr.models import LocationHistory, Vehicle
+from movr.movr import set_transaction_statement
+from util.connect_with_sqlalchemy import (build_engine,
+                                          build_sqla_connection_string,
+                                          test_connection)
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401 -- Makes `pa.ipc` available.
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed to write files; checked in `main`.
+    pa = pq = None
+
+EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def arrow_type(column):
+    """
+    Maps a model column to an Arrow type. UUIDs (and anything else not
+        listed) are written as strings.
+    """
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    return pa.string()
+
+
+def arrow_schema(table):
+    """Returns the Arrow schema for a model's table."""
+    return pa.schema([pa.field(column.name, arrow_type(column))
+                      for column in table.columns])
+
+
+def to_arrow(rows, schema):
+    """
+    Converts a chunk of result rows to an Arrow table, column by column.
+    """
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value)
+                      for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def open_writer(path, schema, file_format, compression):
+    """Opens a Parquet or Arrow IPC file writer; both have `write_table`."""
+    if file_format == 'parquet':
+        return pq.ParquetWriter(path, schema, compression=compression)
+    return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(
+        compression=compression))
+
+
+def stream_chunks(engine, query, chunk_size, staleness):
+    """
+    Yields the rows of `query`, `chunk_size` at a time, from a server-side
+        cursor in one read-only transaction.
+
+    Reading as of a past time (`staleness`) keeps the long scan from
+        blocking, or being pushed by, concurrent writes.
+    """
+    with engine.begin() as connection:
+        connection.execute(set_transaction_statement(staleness))
+        result = connection.execution_options(stream_results=True). \
+            execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+class PartitionedWriter:
+    """
+    Writes ordered chunks to one file per partition.
+
+    Rows must arrive grouped by partition (the query orders by the partition
+        key), so only one file is open at a time.
+
+    Arguments:
+        directory {String} -- The table's staging directory.
+        schema {Schema} -- The table's Arrow schema.
+        partition {function} -- Maps a row to its partition directory name
+            (e.g. 'day=2024-05-01'), or None for an unpartitioned table.
+        file_name {String} -- Name of each partition's file.
+        file_format {String} -- parquet or arrow.
+        compression {String} -- The codec.
+    """
+    def __init__(self, directory, schema, partition, file_name, file_format,
+                 compression):
+        self.directory = directory
+        self.schema = schema
+        self.partition = partition
+        self.file_name = file_name
+        self.file_format = file_format
+        self.compression = compression
+        self.files = []
+        self.rows = 0
+        self._key = None
+        self._writer = None
+
+    def _switch(self, key):
+        self.close()
+        directory = (self.directory if key is None
+                     else os.path.join(self.directory, key))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.file_name)
+        self._writer = open_writer(path, self.schema, self.file_format,
+                                   self.compression)
+        self._key = key
+        self.files.append(path)
+
+    def write(self, rows):
+        start = 0
+        keys = ([None] * len(rows) if self.partition is None
+                else [self.partition(row) for row in rows])
+        for index in range(1, len(rows) + 1):
+            if index < len(rows) and keys[index] == keys[start]:
+                continue
+            if self._writer is None or keys[start] != self._key:
+                self._switch(keys[start])
+            self._writer.write_table(to_arrow(rows[start:index],
+                                              self.schema))
+            start = index
+        self.rows += len(rows)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def partition_by_day(row):
+    return 'day={}'.format(row.ts.date().isoformat())
+
+
+def partition_by_vehicle(row):
+    return 'vehicle_prefix={}'.format(str(row.vehicle_id)[0])
+
+
+def location_history_query(partition_by, since, until):
+    """
+    Selects location_history rows with `since < ts <= until`, ordered so
+        each partition's rows are together.
+    """
+    lh = LocationHistory.__table__
+    query = select(lh).where(lh.c.ts <= until)
+    if since is not None:
+        query = query.where(lh.c.ts > since)
+    if partition_by == 'vehicle':
+        return query.order_by(lh.c.vehicle_id, lh.c.ts, lh.c.id)
+    return query.order_by(lh.c.ts, lh.c.id)
+
+
+def export_table(engine, query, table, partition, staging, file_name, opts):
+    """
+    Streams one query into the staging directory.
+
+    Returns
+    -------
+    PartitionedWriter, with the files written and the row count.
+    """
+    writer = PartitionedWriter(os.path.join(staging, table.name),
+                               arrow_schema(table), partition, file_name,
+                               opts['--format'], opts['--compression'])
+    start = time.monotonic()
+    try:
+        for rows in stream_chunks(engine, query, int(opts['--chunk-size']),
+                                  opts['--staleness']):
+            writer.write(rows)
+            print("  ... {table}: {rows} rows, {rate:.0f} rows/sec".format(
+                table=table.name, rows=writer.rows,
+                rate=writer.rows / (time.monotonic() - start)))
+    finally:
+        writer.close()
+    return writer
+
+
+def publish(staging, output):
+    """Moves every staged file to the same place under `output`."""
+    for directory, _, files in os.walk(staging):
+        target = os.path.join(output, os.path.relpath(directory, staging))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(directory, name),
+                       os.path.join(target, name))
+    shutil.rmtree(staging)
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(path, state):
+    """Writes the state file atomically."""
+    temporary = '{}.tmp'.format(path)
+    with open(temporary, 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def main():
+    opts = docopt(__doc__)
+    if pa is None:
+        raise SystemExit("The export needs pyarrow: pip install -r "
+                         "../requirements-export.txt")
+    if opts['--format'] not in EXTENSIONS:
+        raise SystemExit("--format must be parquet or arrow.")
+    partition = {'day': partition_by_day,
+                 'vehicle': partition_by_vehicle}.get(opts['--partition-by'])
+    if partition is None:
+        raise SystemExit("--partition-by must be day or vehicle.")
+
+    sqla_url = build_sqla_connection_string(opts['--url'])
+    engine = build_engine(sqla_url)
+    test_connection(engine)
+
+    output = opts['--output']
+    state_path = opts['--state-file'] or os.path.join(output,
+                                                      'export_state.json')
+    os.makedirs(output, exist_ok=True)
+    state = load_state(state_path)
+    history_state = state.get('location_history', {})
+    if history_state and history_state.get('partition_by') != \
+            opts['--partition-by']:
+        raise SystemExit(("{} was partitioned by {}; export to a new "
+                          "directory to change it.").format(
+                              output, history_state.get('partition_by')))
+
+    if opts['--full']:
+        since = None
+    elif opts['--since']:
+        since = datetime.fromisoformat(opts['--since'])
+    elif history_state.get('exported_through'):
+        since = datetime.fromisoformat(history_state['exported_through'])
+    else:
+        since = None
+    with engine.connect() as connection:
+        now = connection.execute(select(func.now())).scalar()
+    # ts columns hold naive UTC timestamps.
+    until = now.astimezone(timezone.utc).replace(tzinfo=None) - timedelta(
+        seconds=int(opts['--lag']))
+
+    start_time = datetime.now()
+    print("Started at: {}".format(start_time))
+    print("Exporting location_history rows with ts in ({}, {}].".format(
+        since or '-infinity', until))
+
+    run_id = '{:%Y%m%dT%H%M%S}-{}'.format(start_time, uuid4().hex[:8])
+    extension = EXTENSIONS[opts['--format']]
+    staging = os.path.join(output, '_staging-{}'.format(run_id))
+    try:
+        vehicles = Vehicle.__table__
+        vehicle_writer = export_table(
+            engine, select(vehicles).order_by(vehicles.c.id),
+            vehicles, None, staging, 'vehicles.{}'.format(extension), opts)
+        history_writer = export_table(
+            engine, location_history_query(opts['--partition-by'], since,
+                                           until),
+            LocationHistory.__table__, partition, staging,
+            'part-{}.{}'.format(run_id, extension), opts)
+        publish(staging, output)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    state['location_history'] = {
+        'exported_through': until.isoformat(),
+        'partition_by': opts['--partition-by'],
+        'last_run': run_id,
+        'last_run_rows': history_writer.rows}
+    save_state(state_path, state)
+
+    end_time = datetime.now()
+    print("Wrote {} vehicles and {} location_history rows ({} files) to "
+          "{}.".format(vehicle_writer.rows, history_writer.rows,
+                       len(history_writer.files), output))
+    print("Total time: {}".format(end_time - start_time))
+
+
+if __name__ == '__main__':
+    main()
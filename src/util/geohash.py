@@ -0,0 +1,137 @@
+"""
+Geohash cell ids for MovR's nearby-vehicle search.
+
+A geohash names a cell of a recursive longitude/latitude grid as a base-32
+string; every extra character splits the cell 32 ways. Points in the same
+cell share a prefix, so "every vehicle in cell `9q8yy`" is a prefix range
+scan of an index on the geohash column.
+"""
+import math
+
+from util.calculations import EARTH_RADIUS_KM
+
+# Stored precision: 9 characters is a cell of about 5 m x 5 m, fine enough
+# that any coarser cell used by a search is a prefix of it.
+GEOHASH_PRECISION = 9
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Kilometers per degree of latitude (and of longitude at the equator).
+_KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def encode(longitude, latitude, precision=GEOHASH_PRECISION):
+    """
+    Finds the geohash of a point.
+
+    Inputs
+    ------
+
+    longitude (float): Longitude coordinate of the point.
+
+    latitude (float): Latitude coordinate of the point.
+
+    precision (int): Number of characters in the geohash.
+
+    Returns
+    -------
+
+    The geohash (str).
+    """
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    characters = []
+    bits = 0
+    bit_count = 0
+    even_bit = True  # Bits alternate, starting with longitude.
+    while len(characters) < precision:
+        value, value_range = ((longitude, lon_range) if even_bit
+                              else (latitude, lat_range))
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even_bit = not even_bit
+        bit_count += 1
+        if bit_count == 5:
+            characters.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(characters)
+
+
+def cell_size_degrees(precision):
+    """
+    Returns
+    -------
+
+    (width, height): The size, in degrees of longitude and latitude, of a
+        geohash cell with `precision` characters.
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 360.0 / 2 ** lon_bits, 180.0 / 2 ** lat_bits
+
+
+def precision_for_radius(radius_km, latitude):
+    """
+    Finds the finest geohash precision whose cells are at least `radius_km`
+        wide and tall at `latitude`, so a circle of that radius around any
+        point in a cell lies within the cell and its 8 neighbors.
+
+    Returns
+    -------
+
+    The precision (int), or 0 if even a 1-character cell is too small.
+    """
+    # Cells are narrowest at the circle's edge nearest a pole.
+    edge_latitude = min(abs(latitude) + radius_km / _KM_PER_DEGREE, 89.9)
+    longitude_scale = math.cos(math.radians(edge_latitude))
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        width, height = cell_size_degrees(precision)
+        if (height * _KM_PER_DEGREE >= radius_km
+                and width * _KM_PER_DEGREE * longitude_scale >= radius_km):
+            return precision
+    return 0
+
+
+def covering_cells(longitude, latitude, radius_km):
+    """
+    Finds geohash cells that together contain every point within
+        `radius_km` of (longitude, latitude): the point's cell at
+        `precision_for_radius`, and its neighbors.
+
+    Inputs
+    ------
+
+    longitude (float): Longitude coordinate of the center.
+
+    latitude (float): Latitude coordinate of the center.
+
+    radius_km (float): Search radius, in kilometers.
+
+    Returns
+    -------
+
+    A sorted list of geohash prefixes (str), or None when the radius is so
+        large that the whole table has to be searched.
+    """
+    precision = precision_for_radius(radius_km, latitude)
+    if precision == 0:
+        return None
+    width, height = cell_size_degrees(precision)
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        neighbor_latitude = latitude + lat_step * height
+        if not -90 <= neighbor_latitude <= 90:  # Past a pole.
+            continue
+        for lon_step in (-1, 0, 1):
+            # Wrap across the antimeridian.
+            neighbor_longitude = ((longitude + lon_step * width + 180) % 360
+                                  - 180)
+            cells.add(encode(neighbor_longitude, neighbor_latitude,
+                             precision))
+    return sorted(cells)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Rebuilds movr.ride_summaries from movr.location_history.
+
+Reads location_history in (vehicle_id, ts) order, a chunk at a time, pairs
+each `start_ride` check-in with the vehicle's next `end_ride` check-in, and
+measures the full path between them (including any check-ins in between).
+Summaries are upserted in bulk, so the job can be re-run at any time.
+
+Each chunk is its own short query that resumes after the last row of the
+previous one, so memory use is bounded by --chunk-size no matter how large
+the table is. Apply migrations/0005 first: its (vehicle_id, ts, id) index
+makes each chunk a range scan instead of a scan and sort of the rest of the
+table.
+
+Run from the `src` directory:
+    python -m util.ride_statistics --url <url> [options]
+
+Usage:
+    ride_statistics.py --url <url> [options]
+    ride_statistics.py --help
+
+Options:
+    -h --help               Show this text.
+    --url <url>             URL given by CockroachCloud.
+    --chunk-size <number>   location_history rows read per query
+                                [default: 50000]
+    --write-size <number>   Summaries written per UPSERT [default: 1000]
+    --method <method>       Distance formula: haversine or vincenty
+                                [default: haversine]
+"""
+
+import time
+from datetime import datetime
+
+import numpy as np
+from docopt import docopt
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from movr.models import LocationHistory, RideSummary
+from util.calculations import (calculate_distances,
+                               calculate_durations_hours, calculate_speeds)
+from util.connect_with_sqlalchemy import (build_engine,
+                                          build_sqla_connection_string,
+                                          test_connection)
+
+
+def read_chunks(engine, chunk_size):
+    """
+    Yields location_history in (vehicle_id, ts, id) order, `chunk_size` rows
+        at a time.
+
+    Each chunk is fetched by a separate keyset query
+        (`WHERE (vehicle_id, ts, id) > <last row> ... LIMIT <chunk_size>`), so
+        no transaction stays open across the whole table. The order matches
+        location_history_vehicle_id_ts_id_idx, so each query reads just its
+        chunk from the index.
+    """
+    lh = LocationHistory.__table__
+    order = (lh.c.vehicle_id, lh.c.ts, lh.c.id)
+    query = select(lh.c.vehicle_id, lh.c.ts, lh.c.longitude, lh.c.latitude,
+                   lh.c.event, lh.c.id).order_by(*order).limit(chunk_size)
+    last_row = None
+    while True:
+        chunk_query = query
+        if last_row is not None:
+            chunk_query = query.where(tuple_(*order) > tuple_(
+                last_row.vehicle_id, last_row.ts, last_row.id))
+        with engine.connect() as connection:
+            rows = connection.execute(chunk_query).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_row = rows[-1]
+
+
+class RideBuilder:
+    """
+    Turns ordered location_history chunks into finished rides.
+
+    A ride that's still open at the end of a chunk is carried into the next
+        one as (vehicle_id, start_ts, kilometers so far, points so far).
+    """
+    def __init__(self, method='haversine'):
+        self.method = method
+        self.last_point = None  # (vehicle_id, longitude, latitude)
+        self.open_ride = None
+
+    def add_chunk(self, rows):
+        """
+        Returns a list of finished rides as
+            (vehicle_id, start_ts, end_ts, distance_km, points) tuples.
+        """
+        vehicle_ids = np.array([str(row.vehicle_id) for row in rows])
+        longitudes = np.array([row.longitude for row in rows], dtype=float)
+        latitudes = np.array([row.latitude for row in rows], dtype=float)
+        events = np.array([row.event for row in rows], dtype=object)
+
+        # Distance from each row to the row before it (the previous chunk's
+        # last row, for the first one), or 0 where the vehicle changes.
+        if self.last_point is None:
+            previous_vehicle, previous_lon, previous_lat = None, np.nan, np.nan
+        else:
+            previous_vehicle, previous_lon, previous_lat = self.last_point
+        previous_vehicles = np.concatenate(([previous_vehicle],
+                                            vehicle_ids[:-1]))
+        new_vehicle = vehicle_ids != previous_vehicles
+        segments = calculate_distances(
+            np.concatenate(([previous_lon], longitudes[:-1])),
+            np.concatenate(([previous_lat], latitudes[:-1])),
+            longitudes, latitudes, method=self.method)
+        segments[new_vehicle] = 0
+        cumulative = np.cumsum(segments)
+
+        # Only rows that start or end a ride, or start a new vehicle, need to
+        # be looked at one by one; everything else is in `cumulative`.
+        rides = []
+        boundaries = np.flatnonzero(new_vehicle | (events == 'start_ride')
+                                    | (events == 'end_ride'))
+        for i in boundaries:
+            if new_vehicle[i]:
+                self.open_ride = None  # Previous vehicle's ride never ended.
+            if events[i] == 'start_ride':
+                self.open_ride = (vehicle_ids[i], rows[i].ts, 0.0, 1,
+                                  cumulative[i], i)
+            elif events[i] == 'end_ride' and self.open_ride is not None:
+                vehicle_id, start_ts, carried_km, carried_points, base, \
+                    start_index = self.open_ride
+                rides.append((vehicle_id, start_ts, rows[i].ts,
+                              carried_km + cumulative[i] - base,
+                              carried_points + i - start_index))
+                self.open_ride = None
+
+        if self.open_ride is not None:  # Carry it into the next chunk.
+            vehicle_id, start_ts, carried_km, carried_points, base, \
+                start_index = self.open_ride
+            self.open_ride = (vehicle_id, start_ts,
+                              carried_km + cumulative[-1] - base,
+                              carried_points + len(rows) - 1 - start_index,
+                              0.0, -1)
+        self.last_point = (vehicle_ids[-1], longitudes[-1], latitudes[-1])
+        return rides
+
+
+def write_summaries(engine, rides):
+    """
+    Upserts a batch of rides into ride_summaries with one statement.
+
+    Durations and speeds for the whole batch are computed together.
+    """
+    vehicle_ids, start_times, end_times, distances, points = zip(*rides)
+    hours = calculate_durations_hours(start_times, end_times)
+    speeds = calculate_speeds(distances, hours)
+    values = [{'vehicle_id': str(vehicle_id),
+               'start_ts': start_ts,
+               'end_ts': end_ts,
+               'distance_km': round(float(distance_km), 3),
+               'duration_minutes': float(duration * 60),
+               'average_speed_kmh': (None if np.isnan(speed)
+                                     else round(float(speed), 2)),
+               'points': int(point_count)}
+              for vehicle_id, start_ts, end_ts, distance_km, point_count,
+              duration, speed in zip(vehicle_ids, start_times, end_times,
+                                     distances, points, hours, speeds)]
+
+    statement = insert(RideSummary.__table__).values(values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[RideSummary.vehicle_id, RideSummary.start_ts],
+        set_={column: statement.excluded[column] for column in
+              ('end_ts', 'distance_km', 'duration_minutes',
+               'average_speed_kmh', 'points')})
+    with engine.begin() as connection:
+        connection.execute(statement)
+
+
+def build_ride_summaries(engine, chunk_size, write_size, method):
+    """
+    Streams location_history, rebuilding and writing every completed ride.
+
+    Returns
+    -------
+    (rows_read, rides_written)
+    """
+    builder = RideBuilder(method=method)
+    pending = []
+    rows_read = 0
+    rides_written = 0
+    start = time.monotonic()
+    for rows in read_chunks(engine, chunk_size):
+        rows_read += len(rows)
+        pending.extend(builder.add_chunk(rows))
+        while len(pending) >= write_size:
+            write_summaries(engine, pending[:write_size])
+            rides_written += write_size
+            pending = pending[write_size:]
+        print("  ... {rows} rows read, {rides} rides written, "
+              "{rate:.0f} rows/sec".format(
+                  rows=rows_read, rides=rides_written,
+                  rate=rows_read / (time.monotonic() - start)))
+    if pending:
+        write_summaries(engine, pending)
+        rides_written += len(pending)
+    return rows_read, rides_written
+
+
+def main():
+    opts = docopt(__doc__)
+
+    sqla_url = build_sqla_connection_string(opts['--url'])
+    engine = build_engine(sqla_url)
+    test_connection(engine)
+
+    start_time = datetime.now()
+    print("Started at: {}".format(start_time))
+    rows_read, rides_written = build_ride_summaries(
+        engine, int(opts['--chunk-size']), int(opts['--write-size']),
+        opts['--method'])
+
+    end_time = datetime.now()
+    print("Read {} location_history rows; wrote {} ride summaries.".format(
+        rows_read, rides_written))
+    print("Total time: {}".format(end_time - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Versioned JSON API, mounted at /api/v1 next to the HTML pages.
+
+The routes mirror the `MovR` methods. Listings (vehicles, nearby vehicles,
+a vehicle's locations) are NDJSON, one object per line; single objects are
+plain JSON. Parameters and bodies are checked by web/validation.py, which
+asgi.py shares. /vehicles streams from a server-side cursor, one page
+(?limit=, at most 1000) per request; clients page on with ?after=<last id>,
+so no request holds a transaction open for the whole table. Nearby vehicles
+and location paths are read in full and then written out; ?limit= and the
+bucket width keep them bounded. Every response can be trimmed with
+`?fields=a,b,c` and is gzip or Brotli compressed when the client accepts it
+(Brotli needs the optional `brotli` package).
+
+    GET    /vehicles                 NDJSON; ?after=<id>, ?limit=
+    POST   /vehicles                 Add a vehicle: {"vehicle_type",
+                                         "longitude", "latitude", "battery"}
+    GET    /vehicles/nearby          NDJSON; ?longitude=, ?latitude=,
+                                         ?radius= (km), ?limit=
+    GET    /vehicles/<id>            The vehicle.
+    DELETE /vehicles/<id>            Remove a vehicle that isn't in use.
+    GET    /vehicles/<id>/locations  NDJSON path; ?start=, ?end=,
+                                         ?resolution= (seconds or raw),
+                                         ?tolerance= (km)
+    POST   /vehicles/<id>/ride       Start a ride.
+    POST   /vehicles/<id>/ride/end   End a ride: {"longitude", "latitude",
+                                         "battery"}
+    POST   /locations                Bulk location pings (JSON or NDJSON).
+
+The app must put its `MovR` in `app.extensions['movr']`, and the ingest
+buffer in `app.extensions['movr_location_buffer']`.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+from itertools import chain
+
+from flask import Blueprint, Response, current_app, request
+
+from movr.ingest import (BufferFull, IngestError, parse_locations,
+                         parse_timestamp)
+from web.validation import (APIError, json_default, parse_limit,
+                            parse_new_vehicle, parse_number, parse_ride_end,
+                            parse_uuid)
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available.
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+VEHICLE_FIELDS = ('id', 'vehicle_type', 'in_use', 'battery',
+                  'last_longitude', 'last_latitude', 'last_checkin')
+NEARBY_FIELDS = VEHICLE_FIELDS + ('distance_km',)
+LOCATION_FIELDS = ('ts', 'longitude', 'latitude', 'points')
+
+# Smaller bodies aren't worth compressing.
+MIN_COMPRESS_BYTES = 1024
+# NDJSON lines encoded (and compressed) together.
+NDJSON_BATCH = 200
+
+
+@api.errorhandler(APIError)
+def handle_api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+
+def get_movr():
+    return current_app.extensions['movr']
+
+
+def encode(payload):
+    return json.dumps(payload, default=json_default,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def choose_encoding():
+    """The best compression the client accepts: br, gzip, or None."""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+class Compressor:
+    """Incremental gzip or Brotli, flushed after every chunk."""
+    def __init__(self, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor()
+            self.process = compressor.process
+            self.flush = compressor.flush
+            self.finish = compressor.finish
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip
+            self.process = compressor.compress
+            self.flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+
+
+def json_response(payload, status=200):
+    """A compact JSON response, compressed if it's large enough."""
+    body = encode(payload)
+    response = Response(body, status=status, mimetype='application/json')
+    encoding = choose_encoding()
+    if encoding is not None and len(body) >= MIN_COMPRESS_BYTES:
+        compressor = Compressor(encoding)
+        response.set_data(compressor.process(body) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def ndjson_response(items, fields=None):
+    """
+    Streams `items` as NDJSON, compressing as it goes.
+
+    The first item is fetched before the response starts, so a failure to
+        reach the database is still a proper error response rather than a
+        truncated stream. Closing the response closes `items` too, even if
+        the client went away part way through: for `MovR.iter_vehicles`
+        that's what ends the transaction and returns the connection.
+    """
+    source = iter(items)
+    first = next(source, None)
+    items = chain([first], source) if first is not None else iter(())
+    encoding = choose_encoding()
+
+    def lines():
+        batch = []
+        for item in items:
+            batch.append(encode(select_fields(item, fields)))
+            if len(batch) >= NDJSON_BATCH:
+                yield b'\n'.join(batch) + b'\n'
+                batch = []
+        if batch:
+            yield b'\n'.join(batch) + b'\n'
+
+    def compressed(chunks):
+        compressor = Compressor(encoding)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+    response = Response(lines() if encoding is None else compressed(lines()),
+                        mimetype='application/x-ndjson')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if hasattr(source, 'close'):
+        response.call_on_close(source.close)
+    return response
+
+
+def parse_fields(allowed):
+    """Reads `?fields=a,b`, checking every name is in `allowed`."""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = sorted(set(names) - set(allowed))
+    if unknown:
+        raise APIError(400, "Unknown fields: {}. Choose from {}.".format(
+            ', '.join(unknown), ', '.join(allowed)))
+    return names
+
+
+def select_fields(item, fields):
+    if fields is None:
+        return item
+    return {name: item.get(name) for name in fields}
+
+
+def read_json():
+    """The request body, which must be a JSON object."""
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        raise APIError(400, "The request body must be a JSON object.")
+    return body
+
+
+@api.route('/vehicles', methods=['GET'])
+def list_vehicles():
+    fields = parse_fields(VEHICLE_FIELDS)
+    after_id = request.args.get('after')
+    after_id = None if after_id is None else parse_uuid(after_id)
+    movr = get_movr()
+    limit = parse_limit(request.args, movr.max_records)
+    return ndjson_response(movr.iter_vehicles(after_id=after_id,
+                                              limit=limit), fields)
+
+
+@api.route('/vehicles', methods=['POST'])
+def add_vehicle():
+    new_info = get_movr().add_vehicle(**parse_new_vehicle(read_json()))
+    return json_response(new_info, 201)
+
+
+@api.route('/vehicles/nearby', methods=['GET'])
+def nearby_vehicles():
+    fields = parse_fields(NEARBY_FIELDS)
+    movr = get_movr()
+    return ndjson_response(movr.find_nearby_vehicles(
+        parse_number(request.args, 'longitude', -180, 180),
+        parse_number(request.args, 'latitude', -90, 90),
+        parse_number(request.args, 'radius', 0.001, 1000, default=1.0),
+        limit=parse_limit(request.args, movr.max_records)), fields)
+
+
+@api.route('/vehicles/<vehicle_id>', methods=['GET'])
+def show_vehicle(vehicle_id):
+    fields = parse_fields(VEHICLE_FIELDS)
+    vehicle = get_movr().get_vehicle(parse_uuid(vehicle_id))
+    if vehicle is None:
+        raise APIError(404, "Vehicle `{}` not found.".format(vehicle_id))
+    return json_response(select_fields(vehicle, fields))
+
+
+@api.route('/vehicles/<vehicle_id>', methods=['DELETE'])
+def remove_vehicle(vehicle_id):
+    vehicle_id = parse_uuid(vehicle_id)
+    if not get_movr().remove_vehicle(vehicle_id):
+        raise APIError(409, ("Vehicle `{}` not found in database, or is "
+                             "currently in use.").format(vehicle_id))
+    return json_response({'vehicle_id': vehicle_id, 'deleted': True})
+
+
+@api.route('/vehicles/<vehicle_id>/locations', methods=['GET'])
+def vehicle_locations(vehicle_id):
+    vehicle_id = parse_uuid(vehicle_id)
+    fields = parse_fields(LOCATION_FIELDS)
+    try:
+        end = (parse_timestamp(request.args['end'])
+               if 'end' in request.args else datetime.utcnow())
+        start = (parse_timestamp(request.args['start'])
+                 if 'start' in request.args else end - timedelta(days=1))
+    except ValueError as error:
+        raise APIError(400, str(error))
+    resolution = (None if request.args.get('resolution') == 'raw' else
+                  parse_number(request.args, 'resolution', 0.001, 10 ** 9,
+                               default=60.0))
+    tolerance = (parse_number(request.args, 'tolerance', 0, 10 ** 4)
+                 if 'tolerance' in request.args else None)
+    movr = get_movr()
+    try:
+        locations = movr.get_location_history(
+            vehicle_id, start=start, end=end, resolution=resolution,
+            tolerance_km=tolerance)
+    except ValueError as error:  # Too many points for the window.
+        raise APIError(400, str(error))
+    if not locations and movr.get_vehicle(vehicle_id) is None:
+        raise APIError(404, "Vehicle `{}` not found.".format(vehicle_id))
+    return ndjson_response(locations, fields)
+
+
+@api.route('/vehicles/<vehicle_id>/ride', methods=['POST'])
+def start_ride(vehicle_id):
+    vehicle_id = parse_uuid(vehicle_id)
+    if not get_movr().start_ride(vehicle_id):
+        raise APIError(409, ("Could not start ride on vehicle `{}`. Either "
+                             "it's in use, or it has been deleted."
+                             ).format(vehicle_id))
+    return json_response({'vehicle_id': vehicle_id, 'in_use': True})
+
+
+@api.route('/vehicles/<vehicle_id>/ride/end', methods=['POST'])
+def end_ride(vehicle_id):
+    vehicle_id = parse_uuid(vehicle_id)
+    vehicle_at_end = get_movr().end_ride(vehicle_id,
+                                         *parse_ride_end(read_json()))
+    if not vehicle_at_end:
+        raise APIError(409, "Unable to end ride for vehicle `{}`.".format(
+            vehicle_id))
+    return json_response(vehicle_at_end)
+
+
+@api.route('/locations', methods=['POST'])
+def ingest_locations():
+    """
+    Accepts a batch of location pings from vehicles.
+
+    The body is JSON (a list of pings, or {"locations": [...]}) or NDJSON
+        (`Content-Type: application/x-ndjson`, one ping per line). Each ping
+        has `vehicle_id`, `longitude`, `latitude` and, optionally, `ts`.
+
+    Pings are buffered and written in batches (202 Accepted). With
+        `?sync=true` they're written before the response (200), which
+        reports how many were written and how many named unknown vehicles.
+    """
+    try:
+        locations = parse_locations(request.get_data(), request.mimetype)
+    except IngestError as error:
+        raise APIError(400, str(error))
+
+    if request.args.get('sync', '').lower() in ('1', 'true', 'yes'):
+        written, rejected = get_movr().record_locations(locations)
+        return json_response({'written': written, 'rejected': rejected})
+    try:
+        current_app.extensions['movr_location_buffer'].add(locations)
+    except BufferFull as error:
+        response = json_response({'error': str(error)}, 503)
+        response.headers['Retry-After'] = '1'
+        return response
+    return json_response({'accepted': len(locations)}, 202)
@@ -9,6 +9,14 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path=Path('.env'), override=True)
 
 
+def _flag(name):
+    return environ.get(name, 'false').lower() in ('1', 'true', 'yes')
+
+
+def _optional_int(name):
+    return int(environ[name]) if environ.get(name) else None
+
+
 class Config:
     """
     Flask configuration class.
@@ -16,3 +24,24 @@ class Config:
     SECRET_KEY = environ['SECRET_KEY']
     # API_KEY = environ['API_KEY']
     DB_URI = environ['DB_URI']
+
+    # Connection pool tuning. Each can be overridden on the command line.
+    DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_PRE_PING = _flag('DB_POOL_PRE_PING')
+    DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', -1))
+    # Milliseconds; unset keeps the cluster's default.
+    DB_STATEMENT_TIMEOUT = _optional_int('DB_STATEMENT_TIMEOUT')
+
+    # Application settings; `./server.py --help` describes each one.
+    MAX_RECORDS = int(environ.get('MAX_RECORDS', 20))
+    STALENESS = environ.get('STALENESS', 'strong')
+    BROWSE_STALENESS = environ.get('BROWSE_STALENESS', 'strong')
+    VEHICLE_CACHE = _flag('VEHICLE_CACHE')
+    VEHICLE_CACHE_TTL = float(environ.get('VEHICLE_CACHE_TTL', 5))
+    VEHICLE_CACHE_SIZE = int(environ.get('VEHICLE_CACHE_SIZE', 10000))
+    INGEST_BATCH_SIZE = int(environ.get('INGEST_BATCH_SIZE', 1000))
+    INGEST_FLUSH_MS = int(environ.get('INGEST_FLUSH_MS', 200))
+    SLOW_TXN_MS = _optional_int('SLOW_TXN_MS')
+    FRAGMENT_CACHE_SIZE = int(environ.get('FRAGMENT_CACHE_SIZE', 5000))
+    METADATA_REFRESH = float(environ.get('METADATA_REFRESH', 60))
@@ -0,0 +1,125 @@
+"""
+Caches rendered template fragments, and answers conditional GETs.
+
+`FragmentCache` keeps the HTML of small, repeated templates (the vehicle
+card) keyed on what they show, so a page of hundreds of vehicles renders
+only the cards that changed. `conditional_response` lets browsers and CDNs
+revalidate a page with If-None-Match / If-Modified-Since and get a 304
+without the page being rendered at all.
+"""
+import hashlib
+import threading
+from datetime import timezone
+
+from flask import Response, current_app, render_template, request, session
+from markupsafe import Markup
+
+from movr.cache import MISSING
+
+
+def digest(*parts):
+    """A short, stable hash of `parts` (compared by their repr)."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class FragmentCache:
+    """
+    Renders templates through a cache.
+
+    Entries are keyed on the template's source, an identifying key and a
+        version stamp, so a changed template or changed data simply misses;
+        nothing has to be invalidated.
+
+    Arguments:
+        backend {CacheBackend} -- Where rendered HTML is stored (see
+            movr/cache.py).
+        ttl {float} -- Seconds an entry is kept.
+    """
+    def __init__(self, backend, ttl=600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._template_versions = {}
+        self._lock = threading.Lock()
+
+    def template_version(self, name):
+        """A digest of the template's source, computed once per process."""
+        version = self._template_versions.get(name)
+        if version is None:
+            source, _, _ = current_app.jinja_env.loader.get_source(
+                current_app.jinja_env, name)
+            version = self._template_versions[name] = digest(source)
+        return version
+
+    def render(self, name, key, version, context):
+        """
+        Returns the rendered template, rendering it only on a miss.
+
+        Arguments:
+            name {String} -- The template.
+            key {String} -- What the fragment is for, e.g. the vehicle id.
+            version {String} -- Changes whenever the fragment's data does.
+            context {function} -- Returns the template's variables; only
+                called on a miss, so expensive ones (forms) are built lazily.
+        """
+        cache_key = 'fragment:{}:{}:{}:{}'.format(
+            name, self.template_version(name), key, version)
+        html = self.backend.get(cache_key)
+        with self._lock:
+            if html is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if html is MISSING:
+            html = render_template(name, **context())
+            self.backend.set(cache_key, html, self.ttl)
+        return Markup(html)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def vehicle_card_version(vehicle):
+    """Version stamp covering everything the vehicle card shows."""
+    return digest(vehicle.get('vehicle_type'), vehicle.get('last_longitude'),
+                  vehicle.get('last_latitude'), vehicle.get('battery'),
+                  vehicle.get('in_use'), vehicle.get('distance_km'),
+                  vehicle.get('last_checkin'))
+
+
+def conditional_response(etag, last_modified, render):
+    """
+    Answers a GET with 304 Not Modified if the client's copy is current,
+        and otherwise with `render()`, tagged for revalidation.
+
+    Pages with flashed messages are always rendered (and not tagged): the
+        messages are shown once, so that copy must not be reused.
+
+    Arguments:
+        etag {String} -- Changes whenever the page would.
+        last_modified {DateTime} -- Naive UTC time of the newest data on the
+            page, or None.
+        render {function} -- Renders the page.
+    """
+    if session.get('_flashes'):
+        return render()
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0,
+                                              tzinfo=timezone.utc)
+
+    if request.if_none_match:  # Takes precedence over If-Modified-Since.
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (last_modified is not None
+                        and request.if_modified_since is not None
+                        and last_modified <= request.if_modified_since)
+    response = Response(status=304) if not_modified else current_app. \
+        make_response(render())
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Caches may store the page, but must check it's current before use.
+    response.cache_control.no_cache = True
+    return response
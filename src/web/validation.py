@@ -0,0 +1,93 @@
+"""
+Request validation and JSON encoding shared by MovR's two JSON APIs:
+/api/v1 (web/api.py, on Flask) and asgi.py. Both raise `APIError` and turn
+it into a JSON error response, so the same bad request gets the same answer
+from either one.
+"""
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+# Most objects a listing returns; the default is `MovR.max_records`.
+MAX_LIMIT = 1000
+
+VEHICLE_TYPES = ('scooter',)
+
+
+class APIError(Exception):
+    """Turned into a JSON error response with the given status."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def json_default(value):
+    """Serializes the non-JSON types the `*_txn` functions return."""
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError("Can't serialize {!r}".format(value))
+
+
+def parse_uuid(value):
+    """Returns `value` as a UUID string, or raises a 400 error."""
+    try:
+        return str(UUID(value))
+    except (TypeError, ValueError):
+        raise APIError(400, "`{}` is not a valid vehicle id.".format(value))
+
+
+def parse_number(source, field, low, high, cast=float, default=None):
+    """Reads a number from a JSON body or the query string, checking it's
+    in [low, high]."""
+    if field not in source:
+        if default is not None:
+            return default
+        raise APIError(400, "`{}` is required.".format(field))
+    try:
+        value = cast(source[field])
+    except (TypeError, ValueError):
+        raise APIError(400, "`{}` must be a number.".format(field))
+    if not low <= value <= high:
+        raise APIError(400, "`{}` must be between {} and {}.".format(
+            field, low, high))
+    return value
+
+
+def parse_limit(source, default):
+    """Reads `limit` (1 to MAX_LIMIT) from the query string."""
+    return parse_number(source, 'limit', 1, MAX_LIMIT, cast=int,
+                        default=default)
+
+
+def parse_new_vehicle(body):
+    """
+    Checks an add-vehicle body: {"vehicle_type", "longitude", "latitude",
+        "battery"}. `vehicle_type` defaults to 'scooter'.
+
+    Returns:
+        {dict} -- Keyword arguments for `add_vehicle`.
+    """
+    vehicle_type = body.get('vehicle_type', 'scooter')
+    if vehicle_type not in VEHICLE_TYPES:
+        raise APIError(400, "Unknown vehicle type `{}`.".format(vehicle_type))
+    return {'vehicle_type': vehicle_type,
+            'longitude': parse_number(body, 'longitude', -180, 180),
+            'latitude': parse_number(body, 'latitude', -90, 90),
+            'battery': parse_number(body, 'battery', 0, 100, cast=int)}
+
+
+def parse_ride_end(body):
+    """
+    Checks an end-ride body: {"longitude", "latitude", "battery"}.
+
+    Returns:
+        (longitude, latitude, battery)
+    """
+    return (parse_number(body, 'longitude', -180, 180),
+            parse_number(body, 'latitude', -90, 90),
+            parse_number(body, 'battery', 0, 100, cast=int))
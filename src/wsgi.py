@@ -0,0 +1,16 @@
+"""
+WSGI entry point for running MovR's web server with several worker
+processes. Run it from the `src` directory, e.g. with gunicorn (settings in
+gunicorn.conf.py):
+
+    gunicorn wsgi:app
+
+The app is configured from the .env file and environment variables (see
+web/config.py). Building it doesn't connect to the database, so the server
+can build it once and fork the workers from it; each worker opens its own
+connection pool on first use. Point the load balancer's readiness check at
+/readyz and its liveness check at /livez.
+"""
+from server import create_app
+
+app = create_app()